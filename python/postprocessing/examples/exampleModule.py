@@ -13,6 +13,7 @@ class exampleProducer(Module):
     def endJob(self):
         pass
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        inputTree.declareInputs(["nElectron", "Electron_*", "nMuon", "Muon_*", "nJet", "Jet_*"]) # the jet selection can use any jet variable
         self.out = wrappedOutputTree
         self.out.branch("EventMass",  "F");
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
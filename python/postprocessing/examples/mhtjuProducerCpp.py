@@ -22,6 +22,7 @@ class mhtjuProducerCpp(Module): # MHT producer, unclean jets only (no lepton ove
     def endJob(self):
         pass
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        inputTree.declareInputs(["nJet", "Jet_pt", "Jet_phi"])
         self.initReaders(inputTree) # initReaders must be called in beginFile
         self.out = wrappedOutputTree
         self.out.branch("MHTju_pt",  "F");
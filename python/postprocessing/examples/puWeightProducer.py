@@ -29,6 +29,7 @@ class puWeightProducer(Module):
     def endJob(self):
         pass
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        inputTree.declareInputs([self.nvtxVar])
         self.out = wrappedOutputTree
         self.out.branch(self.name, "F")
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
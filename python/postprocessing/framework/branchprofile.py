@@ -0,0 +1,49 @@
+import os
+import json
+import hashlib
+
+_simpleTypes = (str, unicode, int, long, float, bool, type(None))
+
+def _isSimple(value):
+    if isinstance(value, _simpleTypes): return True
+    if isinstance(value, (list, tuple)): return all(_isSimple(v) for v in value)
+    if isinstance(value, dict): return all(_isSimple(k) and _isSimple(v) for k,v in value.iteritems())
+    return False
+
+def moduleConfigKey(modules):
+    """Return a key identifying the configuration of a list of modules.
+
+       It is built from the classes of the modules and from their attributes of simple types (numbers, strings,
+       and lists or dictionaries of them), as other attributes (ROOT objects, functions) are not stable across jobs"""
+    config = []
+    for m in modules:
+        attrs = sorted((k, v) for k,v in vars(m).iteritems() if _isSimple(v))
+        config.append((m.__class__.__module__, m.__class__.__name__, attrs))
+    return hashlib.sha1(repr(config)).hexdigest()
+
+class BranchProfile:
+    """Branches read by a configuration of modules, learned during the first nEvents events of a job
+       and saved in a small JSON file in directory, so that later files and jobs can set up all the
+       readers and the TTreeCache for them before the event loop"""
+    def __init__(self, directory, modules, nEvents=1000):
+        self.nEvents = nEvents
+        self.fileName = os.path.join(directory, "branches_%s.json" % moduleConfigKey(modules))
+        self.modules = [ m.__class__.__name__ for m in modules ]
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory): raise # otherwise created meanwhile by another process
+    def load(self):
+        """Return the list of branches of the profile, or None if there is none yet"""
+        try:
+            with open(self.fileName) as profileFile:
+                return json.load(profileFile)['branches']
+        except (IOError, ValueError, KeyError):
+            return None
+    def save(self, branches):
+        tmpFileName = "%s.%d.tmp" % (self.fileName, os.getpid())
+        with open(tmpFileName, "w") as profileFile:
+            json.dump({ 'modules':self.modules, 'branches':sorted(branches) }, profileFile, indent=1)
+        os.rename(tmpFileName, self.fileName)
+        print "Saved the %d branches read by the modules in %s" % (len(branches), self.fileName)
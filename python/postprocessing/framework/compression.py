@@ -0,0 +1,28 @@
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+# names of the algorithms accepted in the compression strings, and of the corresponding ROOT::ECompressionAlgorithm
+_compressionAlgos = { "LZMA":"kLZMA", "ZLIB":"kZLIB", "LZ4":"kLZ4", "ZSTD":"kZSTD" }
+
+def parseCompression(compression):
+    """Return the ROOT algorithm and the level of a compression string "algo:level" (e.g. "LZMA:9"), or (None, 0) for "none".
+
+       LZ4 and ZSTD can only be used if the ROOT build supports them"""
+    if compression == "none": return (None, 0)
+    try:
+        (algo, level) = compression.split(":")
+        level = int(level)
+    except ValueError:
+        raise RuntimeError("Invalid compression '%s': it's not none or (algo):(level)" % compression)
+    if algo not in _compressionAlgos:
+        raise RuntimeError("Unsupported compression %s (supported: %s)" % (algo, ", ".join(sorted(_compressionAlgos))))
+    ROOT.gInterpreter.ProcessLine("#include <Compression.h>")
+    rootAlgo = getattr(ROOT.ROOT, _compressionAlgos[algo], None)
+    if rootAlgo == None:
+        raise RuntimeError("Compression %s is not supported by this ROOT version" % algo)
+    return (rootAlgo, level)
+
+def compressionSettings(compression):
+    """Return the compression settings (100*algorithm+level) of a compression string, as used by TFile"""
+    (algo, level) = parseCompression(compression)
+    return ROOT.ROOT.CompressionSettings(algo, level) if level else 0
@@ -3,44 +3,116 @@ import os
 from PhysicsTools.NanoAODTools.postprocessing.framework.postprocessor import *
 import sys
 import re
+import json
+import time
+from multiprocessing.pool import ThreadPool
 import PSet
 
-def inputFiles():
+_aaaPrefix="root://cms-xrd-global.cern.ch/"
+
+# open of a file with a timeout, returning the time it took or -1 if it failed;
+# it is run in several threads at once, without the Python lock
+_probeCode = """
+#include <TFile.h>
+#include <TStopwatch.h>
+#include <string>
+double nanoaodProbeFile(const char * url, int timeout) {
+  std::string u(url);
+  u += (u.find('?') == std::string::npos ? "?TIMEOUT=" : "&TIMEOUT=") + std::to_string(timeout);
+  TStopwatch w;
+  w.Start();
+  TFile * f = TFile::Open(u.c_str());
+  double t = w.RealTime();
+  bool ok = f && !f->IsZombie() && f->IsOpen();
+  if (f) { f->Close(); delete f; }
+  return ok ? t : -1;
+}
+"""
+_probeCodeDeclared = False
+
+def probeFiles(urls, timeout=30, nThreads=8):
+   """Open the files at once in nThreads threads, and return the time it took for each of them (-1 if it failed or timed out)"""
+   global _probeCodeDeclared
+   import ROOT
+   if not _probeCodeDeclared:
+      ROOT.ROOT.EnableThreadSafety()
+      ROOT.gInterpreter.Declare(_probeCode)
+      ROOT.nanoaodProbeFile._threaded = True # release the Python lock while it runs
+      _probeCodeDeclared = True
+   pool=ThreadPool(max(1,min(nThreads,len(urls))))
+   ret=pool.map(lambda url : ROOT.nanoaodProbeFile(url, timeout), urls)
+   pool.close()
+   return ret
+
+def lfn2pfn(lfns):
+   """Convert LFNs to PFNs with a single call of edmFileUtil (or one per file, if its output can't be matched to the inputs)"""
+   if not lfns: return []
+   pfns=[ l.strip() for l in os.popen("edmFileUtil -d %s" % " ".join(lfns)).read().split("\n") if l.strip() ]
+   if len(pfns) != len(lfns):
+      print "Unexpected output of edmFileUtil for %d files, converting them one by one" % len(lfns)
+      pfns=[ re.sub("\n","",os.popen("edmFileUtil -d %s"%(lfn)).read()) for lfn in lfns ]
+   return pfns
+
+class ProbeCache:
+   """Results of the PFN conversion and of the probes of the input files at a site, saved in a JSON file
+      in directory, so that the following jobs at the same site don't need to probe the same files again"""
+   def __init__(self, directory, site, maxAge=24*3600):
+      self.fileName=os.path.join(directory, "probes_%s.json" % re.sub("[^A-Za-z0-9_-]","_",site))
+      self.maxAge=maxAge
+      try:
+         with open(self.fileName) as cacheFile:
+            self.entries=json.load(cacheFile)
+      except (IOError, ValueError):
+         self.entries={}
+   def get(self, lfn):
+      entry=self.entries.get(lfn, None)
+      if entry and time.time()-entry['time'] < self.maxAge: return entry
+      return None
+   def put(self, lfn, pfn, latency):
+      self.entries[lfn]={ 'pfn':pfn, 'latency':latency, 'time':time.time() }
+   def save(self):
+      tmpFileName="%s.%d.tmp" % (self.fileName, os.getpid())
+      try:
+         with open(tmpFileName, "w") as cacheFile:
+            json.dump(self.entries, cacheFile, indent=1)
+         os.rename(tmpFileName, self.fileName)
+      except (IOError, OSError), e:
+         print "Could not save the probe cache %s: %s" % (self.fileName, e)
+
+def inputFiles(maxLatency=10., timeout=30, nThreads=8, cacheDir=None):
+   """Return the input files of the CRAB job, as PFNs for the ones that can be opened locally in less than maxLatency seconds,
+      and through AAA/xrootd for the others.
+
+      The PFNs are resolved with a single call of edmFileUtil and probed in nThreads threads, with a timeout of timeout seconds;
+      the results are cached per site in cacheDir (default: the NANOAODTOOLS_PROBE_CACHE environment variable, if set)"""
    print "ARGV:",sys.argv
    JobNumber=sys.argv[1]
-   crabFiles=PSet.process.source.fileNames
+   crabFiles=list(PSet.process.source.fileNames)
    print crabFiles
-   firstInput = crabFiles[0]
-   tested=False
-   forceaaa=False
+   if os.getenv("GLIDECLIENT_Group","") in ("overflow", "overflow_conservative"):
+      print "Data is not local, using AAA/xrootd"
+      return [ _aaaPrefix+f for f in crabFiles ]
    print "--------------- using edmFileUtil to convert PFN to LFN -------------------------"
-   for i in xrange(0,len(crabFiles)) :
-     if os.getenv("GLIDECLIENT_Group","") != "overflow" and  os.getenv("GLIDECLIENT_Group","") != "overflow_conservative" and not forceaaa:
-       print "Data is local"
-       pfn=os.popen("edmFileUtil -d %s"%(crabFiles[i])).read()
-       pfn=re.sub("\n","",pfn)
-       print crabFiles[i],"->",pfn
-       if not tested:
-         print "Testing file open"
-         import ROOT
-         testfile=ROOT.TFile.Open(pfn)
-         if testfile and testfile.IsOpen() :
-            print "Test OK"
-            crabFiles[i]=pfn
-            testfile.Close()
-            #tested=True
-         else :
-            print "Test open failed, forcing AAA"
-            crabFiles[i]="root://cms-xrd-global.cern.ch/"+crabFiles[i]
-            forceaaa=True
-       else :
-            crabFiles[i]=pfn
-
-
-     else:
-       print "Data is not local, using AAA/xrootd"
-       crabFiles[i]="root://cms-xrd-global.cern.ch/"+crabFiles[i]
-   return crabFiles
+   if cacheDir == None: cacheDir=os.getenv("NANOAODTOOLS_PROBE_CACHE", None)
+   cache=ProbeCache(cacheDir, os.getenv("GLIDEIN_CMSSite", "unknown")) if cacheDir else None
+   cached=dict((f, cache.get(f)) for f in crabFiles if cache and cache.get(f))
+   todo=[ f for f in crabFiles if f not in cached ]
+   pfns=lfn2pfn(todo)
+   latencies=probeFiles(pfns, timeout, nThreads) if pfns else []
+   for lfn,pfn,latency in zip(todo,pfns,latencies):
+      cached[lfn]={ 'pfn':pfn, 'latency':latency }
+      if cache: cache.put(lfn, pfn, latency)
+   if cache and todo: cache.save()
+   ret=[]
+   for lfn in crabFiles:
+      entry=cached[lfn]
+      if entry['latency'] >= 0 and entry['latency'] < maxLatency:
+         print "Data is local:",lfn,"->",entry['pfn'],"(opened in %.1f s)" % entry['latency']
+         ret.append(entry['pfn'])
+      else:
+         print "Data is not local or slow:",lfn,"(%s), using AAA/xrootd" % ("failed to open" if entry['latency'] < 0 else "opened in %.1f s" % entry['latency'])
+         ret.append(_aaaPrefix+lfn)
+   return ret
 
 def runsAndLumis():
     if hasattr(PSet.process.source, "lumisToProcess"):
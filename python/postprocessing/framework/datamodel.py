@@ -1,24 +1,61 @@
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
-from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import InputTree 
+from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import InputTree, JaggedArray
+from PhysicsTools.NanoAODTools.postprocessing.framework.expression import Expression, ExpressionError
 
-class Event:
+class _Slots(object):
+    """Base class of objects with __slots__, where the attributes set by the modules are stored in a dictionary (_attrs)
+       that is only created when the first one is set"""
+    __slots__ = ('_attrs',)
+    def __setattr__(self,name,value):
+        if name in self._fixedSlots:
+            object.__setattr__(self,name,value)
+            return
+        if self._attrs is None: object.__setattr__(self,'_attrs',{})
+        self._attrs[name] = value
+    def __delattr__(self,name):
+        if name in self._fixedSlots:
+            object.__delattr__(self,name)
+        elif self._attrs is None or name not in self._attrs:
+            raise AttributeError(name)
+        else:
+            del self._attrs[name]
+
+class Event(_Slots):
     """Class that allows seeing an entry of a PyROOT TTree as an Event"""
+    __slots__ = ('_tree', '_entry', '_collections')
+    _fixedSlots = frozenset(__slots__ + _Slots.__slots__)
     def __init__(self,tree,entry):
+        self._attrs = None
         self._tree = tree
         self._entry = entry
+        self._collections = {} # Collections of this entry, shared by all the modules
         self._tree.gotoEntry(entry)
     def __getattr__(self,name):
-        if name in self.__dict__: return self.__dict__[name]
+        if name[:2] == "__" and name[-2:] == "__":
+            raise AttributeError(name)
+        if self._attrs is not None and name in self._attrs: return self._attrs[name]
         return self._tree.readBranch(name)
     def __getitem__(self,attr):
         return self.__getattr__(attr)
     def eval(self,expr):
         """Evaluate an expression, as TTree::Draw would do. 
 
-           This is added for convenience, but it may perform poorly and the implementation is not bulletproof,
-           so it's better to rely on reading values, collections or objects directly
+           Expressions in the subset supported by expression.Expression are evaluated from the values read for this entry,
+           others with a TTreeFormula. This is added for convenience, but it's better to rely on reading values, collections
+           or objects directly, or to evaluate expressions on chunks of entries in analyzeBatch
         """ 
+        if not hasattr(self._tree, '_compiledExprs'):
+            self._tree._compiledExprs = {}
+        if expr not in self._tree._compiledExprs:
+            try:
+                self._tree._compiledExprs[expr] = Expression(expr)
+            except ExpressionError:
+                self._tree._compiledExprs[expr] = None
+        if self._tree._compiledExprs[expr] != None:
+            return self._tree._compiledExprs[expr].evalEvent(self)
+        return self._evalFormula(expr)
+    def _evalFormula(self,expr):
         if not hasattr(self._tree, '_exprs'):
             self._tree._exprs = {}
             # remove useless warning about EvalInstance()
@@ -39,28 +76,32 @@ class Event:
             self._tree.entry = self._entry
             #self._tree._exprs[expr].SetQuickLoad(False)
         else:
-            self._tree.gotoEntry(entry)
+            self._tree.gotoEntry(self._entry)
             formula = self._tree._exprs[expr]
         if "[" in expr: # unclear why this is needed, but otherwise for some arrays x[i] == 0 for all i > 0
             formula.GetNdata()
         return formula.go()
 
-class Object:
-    """Class that allows seeing a set branches plus possibly an index as an Object"""
+class Object(_Slots):
+    """Class that allows seeing a set branches plus possibly an index as an Object.
+
+       Values are not stored in the object: for indexed objects they are taken from the columns of the
+       array branches, which are read only once per entry and shared by all the objects of the collection"""
+    __slots__ = ('_event', '_prefix', '_index')
+    _fixedSlots = frozenset(__slots__ + _Slots.__slots__)
     def __init__(self,event,prefix,index=None):
+        self._attrs = None
         self._event = event
         self._prefix = prefix+"_"
         self._index = index
     def __getattr__(self,name):
-        if name in self.__dict__: return self.__dict__[name]
         if name[:2] == "__" and name[-2:] == "__":
-            raise AttributeError
-        val = getattr(self._event,self._prefix+name)
+            raise AttributeError(name)
+        if self._attrs is not None and name in self._attrs: return self._attrs[name]
         if self._index != None:
-            val = val[self._index]
-        val = ord(val) if type(val)==str else val # convert char to integer number
-        self.__dict__[name] = val ## cache
-        return val
+            return self._event._tree.readColumn(self._prefix+name)[self._index]
+        val = getattr(self._event,self._prefix+name)
+        return ord(val) if type(val)==str else val # convert char to integer number
     def __getitem__(self,attr):
         return self.__getattr__(attr)
     def p4(self):
@@ -74,21 +115,74 @@ class Object:
     def __str__(self):
         return self.__repr__()
 
-class Collection:
-    def __init__(self,event,prefix,lenVar=None):
+class Collection(object):
+    """Class that allows seeing the objects of a set of array branches as a list of Objects.
+
+       Within an Event, creating again a Collection with the same prefix and length returns the existing one,
+       so the Objects are created only once per entry whatever the number of modules using them"""
+    __slots__ = ('_event', '_prefix', '_len', '_cache')
+    def __new__(cls,event,prefix,lenVar=None):
+        n = getattr(event,lenVar if lenVar != None else "n"+prefix)
+        collections = event._collections if isinstance(event,Event) else None
+        key = (cls, prefix, lenVar, n) # the length can have been changed by a previous module
+        if collections != None and key in collections: return collections[key]
+        self = object.__new__(cls)
         self._event = event
         self._prefix = prefix
-        if lenVar != None:
-            self._len = getattr(event,lenVar)
-        else:
-            self._len = getattr(event,"n"+prefix)
+        self._len = n
         self._cache = {}
+        if collections != None: collections[key] = self
+        return self
+    def __init__(self,event,prefix,lenVar=None):
+        pass # everything is done in __new__, which may return an existing Collection
     def __getitem__(self,index):
         if type(index) == int and index in self._cache: return self._cache[index]
         if index >= self._len: raise IndexError, "Invalid index %r (len is %r) at %s" % (index,self._len,self._prefix)
         ret = Object(self._event,self._prefix,index=index)
         if type(index) == int: self._cache[index] = ret
         return ret
+    def __iter__(self):
+        for i in xrange(self._len):
+            yield self[i]
     def __len__(self):
         return self._len
 
+
+class Chunk:
+    """Class that allows seeing a range [start, stop) of entries of a PyROOT TTree as NumPy arrays.
+
+       chunk[name] returns a NumPy array with one value per entry for single-value branches,
+       and a JaggedArray for variable-length array branches. Columns produced by batch modules
+       are added with addColumns and can be read in the same way by the following modules.
+       The arrays read from the tree are only valid while this chunk is being processed.
+       alive tells which entries were not rejected by the previous modules (None if not known).
+    """
+    def __init__(self,tree,start,stop,alive=None):
+        self._tree = tree
+        self.start = start
+        self.stop = stop
+        self.size = stop-start
+        self.alive = alive
+        self._columns = {}
+    def __len__(self):
+        return self.size
+    def __getattr__(self,name):
+        if name[:1] == "_": raise AttributeError(name)
+        return self.__getitem__(name)
+    def __getitem__(self,name):
+        if name not in self._columns:
+            self._columns[name] = self._read(name)
+        return self._columns[name]
+    def __contains__(self,name):
+        return name in self._columns or bool(self._tree.GetBranch(name))
+    def addColumns(self,columns):
+        self._columns.update(columns)
+    def load(self,names):
+        """Read at once all the branches in names that were not read yet"""
+        missing = [ n for n in names if n not in self._columns ]
+        if missing: self._columns.update(self._tree.readChunk(missing, self.start, self.stop))
+    def event(self,index):
+        """Return the index-th entry of the chunk as an Event"""
+        return Event(self._tree,self.start+index)
+    def _read(self,name):
+        return self._tree.readChunk([name], self.start, self.stop)[name]
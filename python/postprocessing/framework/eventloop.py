@@ -1,6 +1,8 @@
-from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Event
-from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import clearExtraBranches
-import sys, time
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Event, Chunk
+from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import clearExtraBranches, JaggedArray
+from PhysicsTools.NanoAODTools.postprocessing.framework.instrumentation import instrument
+import sys, time, itertools
+import numpy as np
 
 class Module:
     def __init__(self):
@@ -11,39 +13,200 @@ class Module:
         pass
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         pass
+    # Modules should declare in beginFile the input branches they read (or wildcard patterns), e.g.
+    #        inputTree.declareInputs(["nJet", "Jet_pt", "Jet_eta"])
+    # If all the modules do so, all the readers are made once before the event loop, and the input branches
+    # that are neither declared nor copied to the output are disabled. Undeclared reads are reported.
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         pass
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
         pass
+    # Modules can optionally define
+    #    def analyzeBatch(self, chunk):
+    # to process a chunk of entries at once (see datamodel.Chunk) instead of calling analyze for each event.
+    # It must return a tuple (mask, columns): mask is a boolean NumPy array with one element per entry of
+    # the chunk (or None to accept all of them), columns a dictionary of output branch name -> values
+    # (a NumPy array with one value per entry, or a datamodel.JaggedArray for branches with a lenVar).
+    # chunk.alive tells which entries were not rejected by the previous modules: only those are analyzed in the per-event path.
+    # The output branches must be created in beginFile as usual.
 
-def eventLoop(modules, inputFile, outputFile, inputTree, wrappedOutputTree, maxEvents=-1, eventRange=None, progress=(10000,sys.stdout), filterOutput=True): 
-    for m in modules: 
+def eventLoop(modules, inputFile, outputFile, inputTree, wrappedOutputTree, maxEvents=-1, eventRange=None, progress=(10000,sys.stdout), filterOutput=True, chunkSize=10000, branchProfile=None, instrumentation=None):
+    if instrumentation != None:
+        modules, wrappedOutputTree = instrument(instrumentation, modules, inputTree, wrappedOutputTree)
+    undeclared = []
+    for m in modules:
+        inputTree._inputsDeclared = False
         m.beginFile(inputFile, outputFile, inputTree, wrappedOutputTree)
+        if not inputTree._inputsDeclared: undeclared.append(m)
+    # for modules that do not declare their inputs, the branches read by previous jobs can be used instead
+    learned = branchProfile.load() if (undeclared and branchProfile) else None
+    if learned != None:
+        print "Using the branches read by previous jobs with the same modules, from %s" % branchProfile.fileName
+        inputTree.declareInputs(learned)
+    elif undeclared:
+        print "Modules %s do not declare their inputs: keeping all the input branches active" % ", ".join(getattr(m, '_module', m).__class__.__name__ for m in undeclared)
+    # the input branches copied to the output tree are needed as well
+    inputTree.activateInputs(keep = [ b.GetName() for b in wrappedOutputTree.tree().GetListOfBranches() ], deactivate = (not undeclared or learned != None))
+    learning = bool(undeclared and branchProfile and learned == None)
 
     t0 = time.clock(); tlast = t0; doneEvents = 0; acceptedEvents = 0
     entries = inputTree.entries
 
-    for i in xrange(entries) if eventRange == None else eventRange:
-        if maxEvents > 0 and i >= maxEvents-1: break
-        e = Event(inputTree,i)
-        clearExtraBranches(inputTree)
-        doneEvents += 1
-        ret = True
-        for m in modules: 
-            ret = m.analyze(e) 
-            if not ret: break
-        if ret:
-            acceptedEvents += 1
-        if ret or not filterOutput: 
-            wrappedOutputTree.fill()
-        if progress:
-            if i > 0 and i % progress[0] == 0:
+    if any(hasattr(m, 'analyzeBatch') for m in modules):
+        indices = xrange(entries) if eventRange == None else eventRange
+        if maxEvents > 0: indices = itertools.takewhile(lambda i : i < maxEvents-1, indices) # stop as in the per-event loop
+        for (start, stop) in _contiguousRanges(indices, chunkSize):
+            accepted = _analyzeChunk(modules, inputTree, wrappedOutputTree, start, stop, filterOutput)
+            doneEvents += stop-start
+            acceptedEvents += accepted
+            if learning and doneEvents >= branchProfile.nEvents:
+                branchProfile.save(inputTree.branchesRead())
+                learning = False
+            if progress and (doneEvents // progress[0]) > ((doneEvents-stop+start) // progress[0]):
                 t1 = time.clock()
                 progress[1].write("Processed %8d/%8d entries (elapsed time %7.1fs, curr speed %8.3f kHz, avg speed %8.3f kHz), accepted %8d/%8d events (%5.2f%%)\n" % (
-                        i,entries, t1-t0, (progress[0]/1000.)/(max(t1-tlast,1e-9)), i/1000./(max(t1-t0,1e-9)), acceptedEvents, doneEvents, acceptedEvents/(0.01*doneEvents) ))
+                        doneEvents,entries, t1-t0, ((stop-start)/1000.)/(max(t1-tlast,1e-9)), doneEvents/1000./(max(t1-t0,1e-9)), acceptedEvents, doneEvents, acceptedEvents/(0.01*doneEvents) ))
                 tlast = t1
-    for m in modules: 
+    else:
+        for i in xrange(entries) if eventRange == None else eventRange:
+            if maxEvents > 0 and i >= maxEvents-1: break
+            e = Event(inputTree,i)
+            clearExtraBranches(inputTree)
+            doneEvents += 1
+            if learning and doneEvents > branchProfile.nEvents:
+                branchProfile.save(inputTree.branchesRead())
+                learning = False
+            ret = True
+            for m in modules:
+                ret = m.analyze(e)
+                if not ret: break
+            if ret:
+                acceptedEvents += 1
+            if ret or not filterOutput:
+                wrappedOutputTree.fill()
+            if progress:
+                if i > 0 and i % progress[0] == 0:
+                    t1 = time.clock()
+                    progress[1].write("Processed %8d/%8d entries (elapsed time %7.1fs, curr speed %8.3f kHz, avg speed %8.3f kHz), accepted %8d/%8d events (%5.2f%%)\n" % (
+                            i,entries, t1-t0, (progress[0]/1000.)/(max(t1-tlast,1e-9)), i/1000./(max(t1-t0,1e-9)), acceptedEvents, doneEvents, acceptedEvents/(0.01*doneEvents) ))
+                    tlast = t1
+    for m in modules:
         m.endFile(inputFile, outputFile, inputTree, wrappedOutputTree)
+    if learning:
+        branchProfile.save(inputTree.branchesRead())
+    elif learned != None and inputTree._undeclaredInputs:
+        branchProfile.save(set(learned) | inputTree._undeclaredInputs) # add the branches not read by previous jobs
+    elif inputTree._undeclaredInputs:
+        print "Input branches read without being declared: %s" % ", ".join(sorted(inputTree._undeclaredInputs))
 
     return (doneEvents, acceptedEvents, time.clock() - t0)
+
+def _contiguousRanges(indices, chunkSize):
+    """Group the entry indices in ranges [start, stop) of consecutive entries, of at most chunkSize entries each"""
+    if hasattr(indices, '__len__'):
+        n = len(indices)
+        if n == 0: return
+        if indices[n-1] - indices[0] == n-1: # contiguous range, no need to look at each index
+            for start in xrange(indices[0], indices[0]+n, chunkSize):
+                yield (start, min(start+chunkSize, indices[0]+n))
+            return
+    start = stop = None
+    for i in indices:
+        if start != None and i == stop and stop-start < chunkSize:
+            stop += 1
+        else:
+            if start != None: yield (start, stop)
+            start, stop = i, i+1
+    if start != None: yield (start, stop)
+
+def _analyzeChunk(modules, inputTree, wrappedOutputTree, start, stop, filterOutput):
+    """Run the modules on the entries in [start, stop), fill the output tree and return the number of accepted events.
+
+       Consecutive per-event modules are run event by event, batch modules once on the whole chunk. The outputs of
+       each group of modules are recorded and filled again before running the following ones on each event, so that
+       the branches produced by any earlier module can be read both from the Event and from the Chunk."""
+    alive = np.ones(stop-start, dtype=bool)
+    chunk = Chunk(inputTree, start, stop, alive) # updated in place as the modules reject entries
+    segments = []
+    for m in modules:
+        isBatch = hasattr(m, 'analyzeBatch')
+        if segments and segments[-1][0] == isBatch: segments[-1][1].append(m)
+        else: segments.append((isBatch, [m]))
+    outputBranches = wrappedOutputTree._branches
+    sources = [] # outputs of the modules run so far: ('batch', {name: column}) or ('event', [ {name: value} per entry ])
+    def replay(i):
+        e = Event(inputTree, start+i)
+        clearExtraBranches(inputTree)
+        for kind, values in sources:
+            if kind == 'batch':
+                for name, column in values.iteritems():
+                    if name in outputBranches: wrappedOutputTree.fillBranch(name, _pythonValue(column[i]))
+            elif values[i]:
+                for name, val in values[i].iteritems():
+                    if name in outputBranches: wrappedOutputTree.fillBranch(name, val)
+        return e
+    lastEventModules = segments[-1][1] if not segments[-1][0] else []
+    for isBatch, segmentModules in (segments if not lastEventModules else segments[:-1]):
+        if isBatch:
+            for m in segmentModules:
+                mask, columns = m.analyzeBatch(chunk)
+                if mask is not None: alive &= np.asarray(mask, dtype=bool)
+                if columns:
+                    chunk.addColumns(columns)
+                    sources.append(('batch', columns))
+        else:
+            records = [ None ] * chunk.size
+            for i in np.flatnonzero(alive).tolist():
+                e = replay(i)
+                for m in segmentModules:
+                    if not m.analyze(e):
+                        alive[i] = False
+                        break
+                else:
+                    records[i] = dict(inputTree._extrabranches)
+            # the outputs of earlier modules are in the records as well, as they were replayed
+            earlier = set(name for kind, values in sources for name in (values.iterkeys() if kind == 'batch' else _recordNames(values)))
+            sources.append(('event', records))
+            chunk.addColumns(_recordColumns(records, outputBranches, (_recordNames(records) & set(outputBranches.iterkeys())) - earlier))
+    accepted = 0
+    for i in (np.flatnonzero(alive).tolist() if filterOutput else xrange(chunk.size)):
+        e = replay(i)
+        ret = alive[i]
+        if ret:
+            for m in lastEventModules:
+                ret = m.analyze(e)
+                if not ret: break
+        if ret:
+            accepted += 1
+        if ret or not filterOutput:
+            wrappedOutputTree.fill()
+    return accepted
+
+def _pythonValue(val):
+    """Python float/int (or list of them) for a value of a batch column, as per-event modules read from the TTreeReaders"""
+    if isinstance(val, np.ndarray): return val.tolist()
+    if isinstance(val, np.generic): return val.item()
+    return val
+
+def _recordNames(records):
+    names = set()
+    for record in records:
+        if record: names.update(record.iterkeys())
+    return names
+
+def _recordColumns(records, outputBranches, names):
+    """Convert the values of the given output branches produced event by event (a dictionary per entry, None for rejected entries)
+       to chunk columns. Entries without a value get 0, or no values for variable-length arrays (zeros for fixed-length ones)"""
+    columns = {}
+    for name in names:
+        branch = outputBranches[name]
+        values = [ record.get(name, None) if record else None for record in records ]
+        if branch.lenVar or branch.n > 1:
+            default = [ 0 ] * (0 if branch.lenVar else branch.n)
+            lists = [ list(v) if v is not None else default for v in values ] # copies TTreeReaderArrays as well
+            content = np.array([ x for l in lists for x in l ], dtype=branch.buff.dtype)
+            columns[name] = JaggedArray.fromCounts(content, [ len(l) for l in lists ])
+        else:
+            columns[name] = np.array([ v if v is not None else 0 for v in values ], dtype=branch.buff.dtype)
+    return columns
@@ -0,0 +1,332 @@
+import re
+import numpy as np
+from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import JaggedArray
+
+class ExpressionError(ValueError):
+    pass
+
+# functions of the TTree::Draw syntax, as NumPy functions of their arguments
+_functions = { 'abs':np.abs, 'fabs':np.abs, 'sqrt':np.sqrt, 'exp':np.exp, 'log':np.log, 'log10':np.log10,
+               'sin':np.sin, 'cos':np.cos, 'tan':np.tan, 'asin':np.arcsin, 'acos':np.arccos, 'atan':np.arctan,
+               'atan2':np.arctan2, 'pow':np.power, 'min':np.minimum, 'max':np.maximum }
+_tmathFunctions = { 'TMath::Abs':'abs', 'TMath::Sqrt':'sqrt', 'TMath::Exp':'exp', 'TMath::Log':'log', 'TMath::Log10':'log10',
+                    'TMath::Sin':'sin', 'TMath::Cos':'cos', 'TMath::Tan':'tan', 'TMath::ASin':'asin', 'TMath::ACos':'acos',
+                    'TMath::ATan':'atan', 'TMath::ATan2':'atan2', 'TMath::Power':'pow', 'TMath::Min':'min', 'TMath::Max':'max' }
+_reductions = ('Sum$', 'Max$', 'Min$', 'Length$')
+
+# binary operators by increasing precedence, as in C
+_binaryOperators = [ ('||',), ('&&',), ('|',), ('^',), ('&',), ('==','!='), ('<','<=','>','>='), ('+','-'), ('*','/','%') ]
+
+_tokenRegex = re.compile(r"\s*(?:(?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|(?P<name>[A-Za-z_][A-Za-z0-9_]*(?:::[A-Za-z_][A-Za-z0-9_]*|\$)?)|(?P<op>&&|\|\||==|!=|<=|>=|[-+*/%<>!&|^()\[\],]))")
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _tokenRegex.match(text, pos)
+        if not m: raise ExpressionError("Unexpected character at '%s' in %s" % (text[pos:].lstrip(), text))
+        kind = m.lastgroup
+        tokens.append((kind, m.group(kind)))
+        pos = m.end()
+    return tokens
+
+class _Parser:
+    """Recursive descent parser of the TTree::Draw expressions, returning trees of tuples:
+       ('num', value), ('var', name), ('index', name, index), ('unary', op, x), ('binary', op, x, y), ('call', function, [args])"""
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+    def parse(self):
+        if not self.tokens: raise ExpressionError("Empty expression")
+        ret = self._binary(0)
+        if self.pos != len(self.tokens): self._fail()
+        return ret
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+    def _expect(self, op):
+        if self._next() != ('op', op): self._fail(self.pos-1)
+    def _fail(self, pos=None):
+        pos = self.pos if pos == None else pos
+        raise ExpressionError("Unexpected %s in %s" % ("'%s'" % self.tokens[pos][1] if pos < len(self.tokens) else "end", self.text))
+    def _binary(self, level):
+        if level == len(_binaryOperators): return self._unary()
+        ret = self._binary(level+1)
+        while self._peek()[0] == 'op' and self._peek()[1] in _binaryOperators[level]:
+            op = self._next()[1]
+            ret = ('binary', op, ret, self._binary(level+1))
+        return ret
+    def _unary(self):
+        kind, value = self._peek()
+        if kind == 'op' and value in ('-', '+', '!'):
+            self._next()
+            return ('unary', value, self._unary())
+        return self._primary()
+    def _primary(self):
+        kind, value = self._next()
+        if kind == 'num':
+            return ('num', float(value) if re.search("[.eE]", value) else int(value))
+        if kind == 'op' and value == '(':
+            ret = self._binary(0)
+            self._expect(')')
+            return ret
+        if kind != 'name': self._fail(self.pos-1)
+        if self._peek() == ('op', '('):
+            self._next()
+            function = _tmathFunctions.get(value, value)
+            if function not in _functions and function not in _reductions: raise ExpressionError("Unsupported function %s in %s" % (value, self.text))
+            args = [ self._binary(0) ]
+            while self._peek() == ('op', ','):
+                self._next()
+                args.append(self._binary(0))
+            self._expect(')')
+            nArgs = 1 if function in _reductions or function not in ('atan2', 'pow', 'min', 'max') else 2
+            if len(args) != nArgs: raise ExpressionError("%s takes %d argument(s) in %s" % (value, nArgs, self.text))
+            return ('call', function, args)
+        if value.endswith("$") or "::" in value: raise ExpressionError("Unsupported %s in %s" % (value, self.text))
+        if self._peek() == ('op', '['):
+            self._next()
+            index = self._binary(0)
+            self._expect(']')
+            if self._peek() == ('op', '['): raise ExpressionError("Multi-dimensional arrays are not supported in %s" % self.text)
+            return ('index', value, index)
+        return ('var', value)
+
+class _Values:
+    """Values of a (sub-)expression for a range of entries: one value per entry if offsets is None,
+       otherwise a variable number of values (instances) per entry, as in a JaggedArray.
+       For one value per entry, valid tells which entries have a value (None if all of them), e.g. x[2] has none if x has less than 3 elements"""
+    __slots__ = ('values', 'offsets', 'valid')
+    def __init__(self, values, offsets=None, valid=None):
+        self.values = values
+        self.offsets = offsets
+        self.valid = valid
+    def counts(self, size):
+        if self.offsets is not None: return np.diff(self.offsets)
+        return np.ones(size, dtype=np.int64) if self.valid is None else self.valid.astype(np.int64)
+
+def _asNumbers(values):
+    """Convert the values of a branch to 64-bit integers or doubles, in which all the computations are done"""
+    return values.astype(np.int64) if values.dtype.kind in 'biu' else values.astype(np.float64)
+
+def _offsets(counts):
+    offsets = np.zeros(len(counts)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+def _take(values, index):
+    return values[index] if len(values) else np.zeros(len(index), dtype=values.dtype)
+
+def _align(x, y, size):
+    """Return the values of x and y as flat arrays with the same instances, and the offsets (or validity) of the result.
+
+       As in TTreeFormula, a single value is used for all the instances of an array, and two arrays with different
+       lengths are paired element by element up to the shortest length. An entry without value has no instances."""
+    if x.offsets is None and y.offsets is None:
+        valid = x.valid if y.valid is None else (y.valid if x.valid is None else x.valid & y.valid)
+        return x.values, y.values, None, valid
+    if x.offsets is None or y.offsets is None:
+        (single, array) = (x, y) if x.offsets is None else (y, x)
+        counts = np.diff(array.offsets)
+        arrayValues = array.values
+        if single.valid is not None:
+            arrayValues = arrayValues[np.repeat(single.valid, counts)]
+            counts = np.where(single.valid, counts, 0)
+        singleValues = np.repeat(single.values, counts)
+        offsets = _offsets(counts)
+        return (singleValues, arrayValues, offsets, None) if x.offsets is None else (arrayValues, singleValues, offsets, None)
+    if len(x.offsets) == len(y.offsets) and (x.offsets is y.offsets or np.array_equal(x.offsets, y.offsets)):
+        return x.values, y.values, x.offsets, None
+    counts = np.minimum(np.diff(x.offsets), np.diff(y.offsets))
+    offsets = _offsets(counts)
+    local = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+    return _take(x.values, np.repeat(x.offsets[:-1], counts) + local), _take(y.values, np.repeat(y.offsets[:-1], counts) + local), offsets, None
+
+def _binaryOp(op, x, y):
+    if op in ('+', '-', '*'):
+        return x + y if op == '+' else (x - y if op == '-' else x * y)
+    if op == '/': # division by zero gives 0, as in TTreeFormula
+        y = np.asarray(y, dtype=np.float64)
+        return np.where(y == 0, 0., np.asarray(x, dtype=np.float64) / np.where(y == 0, 1., y))
+    if op in ('%', '&', '|', '^'):
+        x, y = np.asarray(x).astype(np.int64), np.asarray(y).astype(np.int64)
+        if op == '%': return np.where(y == 0, 0, np.fmod(x, np.where(y == 0, 1, y)))
+        return x & y if op == '&' else (x | y if op == '|' else x ^ y)
+    if op == '&&': return ((x != 0) & (y != 0)).astype(np.int64)
+    if op == '||': return ((x != 0) | (y != 0)).astype(np.int64)
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    return { '==':np.equal, '!=':np.not_equal, '<':np.less, '<=':np.less_equal, '>':np.greater, '>=':np.greater_equal }[op](x, y).astype(np.int64)
+
+_cppFunctions = { 'abs':'std::fabs', 'fabs':'std::fabs', 'sqrt':'std::sqrt', 'exp':'std::exp', 'log':'std::log', 'log10':'std::log10',
+                  'sin':'std::sin', 'cos':'std::cos', 'tan':'std::tan', 'asin':'std::asin', 'acos':'std::acos', 'atan':'std::atan',
+                  'atan2':'std::atan2', 'pow':'std::pow', 'min':'std::min<double>', 'max':'std::max<double>' }
+
+class _CppLevel:
+    """Arrays read element by element, and conditions on the fixed indices, of a loop over the instances of a (sub-)expression"""
+    def __init__(self, depth):
+        self.index = "i%d" % depth
+        self.depth = depth
+        self.arrays = set()
+        self.checks = []
+    def count(self):
+        """C++ code of the number of instances: the shortest length of the arrays, or 0 if an index is out of range"""
+        ret = "1"
+        for array in sorted(self.arrays):
+            ret = "Long64_t(%s.size())" % array if ret == "1" else "std::min<Long64_t>(%s, Long64_t(%s.size()))" % (ret, array)
+        return ret if not self.checks else "((%s) ? %s : 0)" % (" && ".join(self.checks), ret)
+
+class Expression:
+    """Expression in the TTree::Draw syntax, evaluated with NumPy on all the entries of a chunk at once.
+
+       The supported subset is the one of the usual cut strings: numbers and branches, arithmetic, comparisons, logical and bitwise
+       operators, the common math functions (also as TMath::), Sum$, Max$, Min$ and Length$, and array indices (constant or single values).
+       Expressions of arrays have one value (instance) per element, as in TTreeFormula: an entry is selected if any of the instances is,
+       and eval returns the first one. Values are computed in double precision, and are integers if all the inputs are."""
+    def __init__(self, text):
+        self.text = text
+        self.tree = _Parser(text).parse()
+        self._branches = set()
+        self._collect(self.tree)
+    def branches(self):
+        """Return the set of the branches used by the expression"""
+        return self._branches
+    def select(self, chunk):
+        """Return the boolean mask of the entries of the chunk passing the expression, used as a selection"""
+        chunk.load(sorted(self._branches))
+        result = self._eval(self.tree, chunk.__getitem__, len(chunk))
+        if result.offsets is None:
+            ret = (result.values != 0)
+            return ret if result.valid is None else (ret & result.valid)
+        counts = np.diff(result.offsets)
+        passing = np.repeat(np.arange(len(chunk)), counts)[result.values != 0]
+        return np.bincount(passing, minlength=len(chunk)) > 0
+    def values(self, chunk):
+        """Return the values of the expression for the entries of the chunk, as a NumPy array (or a JaggedArray for expressions of arrays)"""
+        chunk.load(sorted(self._branches))
+        result = self._eval(self.tree, chunk.__getitem__, len(chunk))
+        if result.offsets is not None: return JaggedArray(result.values, result.offsets)
+        return result.values if result.valid is None else np.where(result.valid, result.values, 0)
+    def evalEvent(self, event):
+        """Return the value of the expression for an Event, i.e. its first instance (0 if there is none),
+           as a float like TTreeFormula::EvalInstance"""
+        def column(name):
+            val = event._tree.readColumn(name)
+            if isinstance(val, (list, tuple, np.ndarray)):
+                return JaggedArray(np.asarray(val), np.array([0, len(val)], dtype=np.int64))
+            return np.array([ord(val) if type(val) == str else val]) # convert char to integer number
+        result = self._eval(self.tree, column, 1)
+        if len(result.values) == 0 or (result.valid is not None and not result.valid[0]): return 0.
+        return float(result.values[0])
+    def cppSelection(self, isArray):
+        """Return a C++ boolean expression of the branches (as single values, or ROOT::VecOps::RVec for arrays) equivalent to select,
+           e.g. for a RDataFrame Filter. isArray(name) must tell whether a branch is an array"""
+        level = _CppLevel(0)
+        value = self._cpp(self.tree, level, isArray)
+        return ("[&]() { const Long64_t n0 = %s; for (Long64_t i0 = 0; i0 < n0; ++i0) { if ((%s) != 0) return true; } return false; }()" %
+                (level.count(), value))
+    def _cpp(self, node, level, isArray):
+        kind = node[0]
+        if kind == 'num':
+            return "%r" % float(node[1])
+        if kind == 'var':
+            if not isArray(node[1]): return "double(%s)" % node[1]
+            level.arrays.add(node[1])
+            return "double(%s[%s])" % (node[1], level.index)
+        if kind == 'index':
+            if not isArray(node[1]): raise ExpressionError("%s is not an array in %s" % (node[1], self.text))
+            indexLevel = _CppLevel(level.depth)
+            index = "Long64_t(%s)" % self._cpp(node[2], indexLevel, isArray)
+            if indexLevel.arrays: raise ExpressionError("Array indices must have a single value per entry in %s" % self.text)
+            level.checks += indexLevel.checks + [ "%s >= 0 && %s < Long64_t(%s.size())" % (index, index, node[1]) ]
+            return "double(%s[%s])" % (node[1], index)
+        if kind == 'unary':
+            x = self._cpp(node[2], level, isArray)
+            return "double((%s) == 0)" % x if node[1] == '!' else "(%s(%s))" % (node[1], x)
+        if kind == 'binary':
+            op, x, y = node[1], self._cpp(node[2], level, isArray), self._cpp(node[3], level, isArray)
+            if op in ('+', '-', '*'): return "(%s %s %s)" % (x, op, y)
+            if op == '/': return "[](double x, double y) { return y == 0 ? 0. : x / y; }(%s, %s)" % (x, y)
+            if op == '%': return "double([](Long64_t x, Long64_t y) { return y == 0 ? 0 : x %% y; }(%s, %s))" % (x, y)
+            if op in ('&', '|', '^'): return "double(Long64_t(%s) %s Long64_t(%s))" % (x, op, y)
+            if op in ('&&', '||'): return "double((%s) != 0 %s (%s) != 0)" % (x, op, y)
+            return "double((%s) %s (%s))" % (x, op, y)
+        if kind == 'call':
+            function = node[1]
+            if function not in _reductions:
+                return "%s(%s)" % (_cppFunctions[function], ", ".join(self._cpp(arg, level, isArray) for arg in node[2]))
+            inner = _CppLevel(level.depth+1)
+            value = self._cpp(node[2][0], inner, isArray)
+            n, i = "n%d" % inner.depth, inner.index
+            if function == 'Length$': return "double(%s)" % inner.count()
+            if function == 'Sum$':
+                body = "ret += %s;" % value
+            else:
+                body = "const double v = %s; if (%s == 0 || v %s ret) ret = v;" % (value, i, '>' if function == 'Max$' else '<')
+            return "[&]() { double ret = 0; const Long64_t %s = %s; for (Long64_t %s = 0; %s < %s; ++%s) { %s } return ret; }()" % (n, inner.count(), i, i, n, i, body)
+        raise ExpressionError("Unknown node %s" % (kind,))
+    def _collect(self, node):
+        if node[0] in ('var', 'index'): self._branches.add(node[1])
+        if node[0] == 'index': self._collect(node[2])
+        elif node[0] == 'unary': self._collect(node[2])
+        elif node[0] == 'binary':
+            self._collect(node[2]); self._collect(node[3])
+        elif node[0] == 'call':
+            for arg in node[2]: self._collect(arg)
+    def _column(self, name, column, size):
+        val = column(name)
+        if isinstance(val, JaggedArray): return _Values(_asNumbers(np.asarray(val.content)), np.asarray(val.offsets))
+        val = np.asarray(val)
+        if val.shape != (size,): raise ExpressionError("Unexpected shape %s of %s in %s" % (val.shape, name, self.text))
+        return _Values(_asNumbers(val))
+    def _eval(self, node, column, size):
+        kind = node[0]
+        if kind == 'num':
+            return _Values(np.full(size, node[1], dtype=np.int64 if isinstance(node[1], (int, long)) else np.float64))
+        if kind == 'var':
+            return self._column(node[1], column, size)
+        if kind == 'index':
+            array = self._column(node[1], column, size)
+            index = self._eval(node[2], column, size)
+            if index.offsets is not None: raise ExpressionError("Array indices must have a single value per entry in %s" % self.text)
+            if array.offsets is None: raise ExpressionError("%s is not an array in %s" % (node[1], self.text))
+            index, indexValid = np.asarray(index.values).astype(np.int64), index.valid
+            counts = np.diff(array.offsets)
+            valid = (index >= 0) & (index < counts)
+            if indexValid is not None: valid &= indexValid
+            return _Values(_take(array.values, np.where(valid, array.offsets[:-1] + index, 0)), None, valid)
+        if kind == 'unary':
+            x = self._eval(node[2], column, size)
+            op = node[1]
+            values = (x.values == 0).astype(np.int64) if op == '!' else (-x.values if op == '-' else x.values)
+            return _Values(values, x.offsets, x.valid)
+        if kind == 'binary':
+            x, y = self._eval(node[2], column, size), self._eval(node[3], column, size)
+            xv, yv, offsets, valid = _align(x, y, size)
+            return _Values(_binaryOp(node[1], xv, yv), offsets, valid)
+        if kind == 'call':
+            function, args = node[1], [ self._eval(arg, column, size) for arg in node[2] ]
+            if function in _reductions: return self._reduce(function, args[0], size)
+            if len(args) == 1:
+                return _Values(_functions[function](np.asarray(args[0].values, dtype=np.float64)), args[0].offsets, args[0].valid)
+            xv, yv, offsets, valid = _align(args[0], args[1], size)
+            if function in ('min', 'max'): return _Values(_functions[function](xv, yv), offsets, valid)
+            return _Values(_functions[function](np.asarray(xv, dtype=np.float64), np.asarray(yv, dtype=np.float64)), offsets, valid)
+        raise ExpressionError("Unknown node %s" % (kind,))
+    def _reduce(self, function, x, size):
+        counts = x.counts(size)
+        if function == 'Length$': return _Values(counts)
+        offsets = x.offsets if x.offsets is not None else _offsets(counts)
+        values = x.values if x.valid is None else x.values[x.valid]
+        if function == 'Sum$':
+            sums = np.bincount(np.repeat(np.arange(size), counts), weights=values, minlength=size)
+            return _Values(np.rint(sums).astype(np.int64) if values.dtype.kind in 'biu' else sums)
+        ret = np.zeros(size, dtype=values.dtype)
+        nonEmpty = counts > 0
+        if len(values):
+            ret[nonEmpty] = (np.maximum if function == 'Max$' else np.minimum).reduceat(values, offsets[:-1][nonEmpty])
+        return _Values(ret)
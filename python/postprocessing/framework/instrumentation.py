@@ -0,0 +1,79 @@
+import json
+import time
+
+class Instrumentation:
+    """Accumulators of the number of calls, wall and CPU time of the steps of the event loop
+       (analyze, beginFile and endFile of each module, reading the input and filling the output),
+       and of the number of events accepted and rejected by each module.
+
+       The accumulated values are kept in a dictionary of plain values (stats), so that the ones
+       of different files and worker processes can be sent back and merged"""
+    def __init__(self, stats=None):
+        self.stats = stats if stats != None else {}
+    def entry(self, name, order):
+        if name not in self.stats:
+            self.stats[name] = { 'order':order, 'calls':0, 'wall':0., 'cpu':0., 'pass':0, 'fail':0 }
+        return self.stats[name]
+    def timed(self, name, order, function, counts=False):
+        """Return a function calling function and accumulating its timing in the stats of name.
+           If counts is True, the calls returning True or False are also counted as passed or failed"""
+        stat = self.entry(name, order)
+        def timedFunction(*args, **kwargs):
+            w0 = time.time(); c0 = time.clock()
+            ret = function(*args, **kwargs)
+            stat['wall'] += time.time() - w0
+            stat['cpu'] += time.clock() - c0
+            stat['calls'] += 1
+            if counts:
+                if ret: stat['pass'] += 1
+                else: stat['fail'] += 1
+            return ret
+        return timedFunction
+    def merge(self, other):
+        for name, stat in other.stats.iteritems():
+            mine = self.entry(name, stat['order'])
+            for k in 'calls', 'wall', 'cpu', 'pass', 'fail':
+                mine[k] += stat[k]
+    def printTable(self, out=None):
+        lines = [ "%-50s %10s %10s %10s %12s %10s %10s" % ("Step", "Calls", "Wall [s]", "CPU [s]", "Wall/call [us]", "Passed", "Failed") ]
+        for name, stat in sorted(self.stats.iteritems(), key=lambda (name, stat) : stat['order']):
+            lines.append("%-50s %10d %10.3f %10.3f %12.1f %10s %10s" % (name, stat['calls'], stat['wall'], stat['cpu'], 1e6*stat['wall']/max(stat['calls'],1),
+                                                                        stat['pass'] if stat['pass'] or stat['fail'] else "", stat['fail'] if stat['pass'] or stat['fail'] else ""))
+        text = "\n".join(lines)
+        if out: out.write(text+"\n")
+        else: print text
+    def saveJSON(self, fileName):
+        rows = [ dict(stat, name=name) for name, stat in sorted(self.stats.iteritems(), key=lambda (name, stat) : stat['order']) ]
+        for row in rows: del row['order']
+        with open(fileName, "w") as jsonFile:
+            json.dump({ 'steps':rows }, jsonFile, indent=1)
+        print "Saved timing information in %s" % fileName
+
+class _InstrumentedModule:
+    """Proxy of a module timing its calls to beginFile, endFile, analyze and analyzeBatch"""
+    def __init__(self, module, label, instrumentation, order):
+        self._module = module
+        self.beginFile = instrumentation.timed(label+".beginFile", order, module.beginFile)
+        self.endFile = instrumentation.timed(label+".endFile", order+0.2, module.endFile)
+        self.analyze = instrumentation.timed(label+".analyze", order+0.1, module.analyze, counts=True)
+        if hasattr(module, 'analyzeBatch'):
+            self.analyzeBatch = instrumentation.timed(label+".analyzeBatch", order+0.1, module.analyzeBatch)
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+class _InstrumentedOutput:
+    """Proxy of the wrapped output tree timing the calls to fill"""
+    def __init__(self, output, instrumentation, order):
+        self._output = output
+        self.fill = instrumentation.timed("output.fill", order, output.fill)
+    def __getattr__(self, name):
+        return getattr(self._output, name)
+
+def instrument(instrumentation, modules, inputTree, wrappedOutputTree):
+    """Return proxies of the modules and of the output tree, and time the reading of the input tree
+       (reader SetEntry/Next calls in gotoEntry, and readChunk for batch modules), accumulating in instrumentation"""
+    modules = [ _InstrumentedModule(m, "%s[%d]" % (m.__class__.__name__, i), instrumentation, 10*i+10) for i,m in enumerate(modules) ]
+    inputTree.gotoEntry = instrumentation.timed("input.gotoEntry", 0, inputTree.gotoEntry)
+    inputTree.readChunk = instrumentation.timed("input.readChunk", 1, inputTree.readChunk)
+    wrappedOutputTree = _InstrumentedOutput(wrappedOutputTree, instrumentation, 10*len(modules)+10)
+    return modules, wrappedOutputTree
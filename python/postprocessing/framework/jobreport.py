@@ -11,8 +11,8 @@ class JobReport :
            ET.SubElement(self.performancesummary, "Metric", Name="Parameter-untracked-bool-stats",Value="true")
            ET.SubElement(self.performancesummary, "Metric", Name="Parameter-untracked-string-cacheHint",Value="application-only")
            ET.SubElement(self.performancesummary, "Metric", Name="Parameter-untracked-string-readHint",Value="auto-detect")
-           ET.SubElement(self.performancesummary, "Metric", Name="ROOT-tfile-read-totalMegabytes",Value="0")
-           ET.SubElement(self.performancesummary, "Metric", Name="ROOT-tfile-write-totalMegabytes",Value="0")
+           self.readMegabytes = ET.SubElement(self.performancesummary, "Metric", Name="ROOT-tfile-read-totalMegabytes",Value="0")
+           self.writeMegabytes = ET.SubElement(self.performancesummary, "Metric", Name="ROOT-tfile-write-totalMegabytes",Value="0")
     #<Metric Name="Parameter-untracked-bool-enabled" Value="true"/>
     #<Metric Name="Parameter-untracked-bool-stats" Value="true"/>
     #<Metric Name="Parameter-untracked-string-cacheHint" Value="application-only"/>
@@ -57,6 +57,27 @@ class JobReport :
                 for l in ls :
                    ET.SubElement(run,"LumiSection",ID="%s"%l)
 		
+       def addReadBranches(self,branches) :
+           for b in sorted(branches) :
+                ET.SubElement(self.readbranches,"Branch",Name=b)
+
+       def addStorageStatistics(self,readBytes,readCalls,writeBytes,cacheEfficiency=None) :
+           self.readMegabytes.set("Value","%.6f"%(readBytes/1024./1024.))
+           self.writeMegabytes.set("Value","%.6f"%(writeBytes/1024./1024.))
+           ET.SubElement(self.performancesummary, "Metric", Name="tstoragefile-read-numOperations",Value="%d"%readCalls)
+           ET.SubElement(self.performancesummary, "Metric", Name="tstoragefile-read-totalMegabytes",Value="%.6f"%(readBytes/1024./1024.))
+           ET.SubElement(self.performancesummary, "Metric", Name="tstoragefile-write-totalMegabytes",Value="%.6f"%(writeBytes/1024./1024.))
+           if cacheEfficiency != None :
+                ET.SubElement(self.performancesummary, "Metric", Name="ROOT-ttreecache-efficiency",Value="%.4f"%cacheEfficiency)
+
+       def addTiming(self,wallTime,cpuTime,events) :
+           timing = ET.SubElement(self.performancereport, "PerformanceSummary", Metric="Timing")
+           ET.SubElement(timing, "Metric", Name="TotalJobTime",Value="%.3f"%wallTime)
+           ET.SubElement(timing, "Metric", Name="TotalJobCPU",Value="%.3f"%cpuTime)
+           ET.SubElement(timing, "Metric", Name="TotalEvents",Value="%d"%events)
+           ET.SubElement(timing, "Metric", Name="EventThroughput",Value="%.3f"%(events/wallTime if wallTime > 0 else 0.))
+           ET.SubElement(timing, "Metric", Name="AvgEventTime",Value="%.6f"%(wallTime/events if events > 0 else 0.))
+
        def save(self,filename="FrameworkJobReport.xml"):
 	    tree = ET.ElementTree(self.fjr)
 	    tree.write(filename) #, pretty_print=True)
@@ -1,17 +1,83 @@
-from array import array
+import numpy as np
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
-from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import setExtraBranch
+from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import setExtraBranch, _rootLeafType2NumpyType, _currentTreeEntry
 
-_rootBranchType2PythonArray = { 'b':'B', 'B':'b', 'i':'I', 'I':'i', 'F':'f', 'D':'d', 'l':'L', 'L':'l', 'O':'B' }
+_rootBranchType2NumpyType = { 'b':np.uint8, 'B':np.int8, 'i':np.uint32, 'I':np.int32, 'F':np.float32, 'D':np.float64, 'l':np.uint64, 'L':np.int64, 'O':np.bool_ }
+
+# copy of the values of a TTreeReaderArray into the buffer of an output branch in a single call,
+# converting them to the type of the branch (one overload per type of the reader)
+_readerTypes = [ 'UChar_t', 'Char_t', 'UInt_t', 'Int_t', 'Float_t', 'Double_t', 'ULong64_t', 'Long64_t', 'Bool_t' ]
+_copyCode = """
+#include <TTreeReaderArray.h>
+template<typename S, typename D> void nanoaodCopyArrayTo(const TTreeReaderArray<S> & src, D * dst, size_t n) {
+  for (size_t i = 0; i < n; ++i) dst[i] = src[i];
+}
+template<typename S> void nanoaodCopyArrayAs(const TTreeReaderArray<S> & src, void * dst, size_t n, char type) {
+  switch (type) {
+    case 'b': nanoaodCopyArrayTo(src, static_cast<UChar_t *>(dst), n); break;
+    case 'B': nanoaodCopyArrayTo(src, static_cast<Char_t *>(dst), n); break;
+    case 'i': nanoaodCopyArrayTo(src, static_cast<UInt_t *>(dst), n); break;
+    case 'I': nanoaodCopyArrayTo(src, static_cast<Int_t *>(dst), n); break;
+    case 'F': nanoaodCopyArrayTo(src, static_cast<Float_t *>(dst), n); break;
+    case 'D': nanoaodCopyArrayTo(src, static_cast<Double_t *>(dst), n); break;
+    case 'l': nanoaodCopyArrayTo(src, static_cast<ULong64_t *>(dst), n); break;
+    case 'L': nanoaodCopyArrayTo(src, static_cast<Long64_t *>(dst), n); break;
+    case 'O': nanoaodCopyArrayTo(src, static_cast<Bool_t *>(dst), n); break;
+  }
+}
+""" + "".join("void nanoaodCopyArray(const TTreeReaderArray<%s> & src, void * dst, size_t n, char type) { nanoaodCopyArrayAs(src, dst, n, type); }\n" % t for t in _readerTypes)
+_copyCodeDeclared = False
+
+def _copyReaderArray(reader, buff, n, rootBranchType):
+    global _copyCodeDeclared
+    if not _copyCodeDeclared:
+        ROOT.gInterpreter.Declare(_copyCode)
+        _copyCodeDeclared = True
+    ROOT.nanoaodCopyArray(reader, buff, n, rootBranchType)
+
+_rootLeafType2rootBranchType = { 'UChar_t':'b', 'Char_t':'B', 'UInt_t':'i', 'Int_t':'I', 'Float_t':'F', 'Double_t':'D', 'ULong64_t':'l', 'Long64_t':'L', 'Bool_t':'O' }
+
+# loops of the in-process merge of several input files: back-filling of a new branch with the value
+# in its buffer, and copy of the entries of a tree selected by an entry list (not supported by TTree::CopyEntries)
+_mergeCode = """
+#include <TTree.h>
+#include <TBranch.h>
+#include <TEntryList.h>
+void nanoaodBackFill(TBranch * branch, Long64_t n) {
+  for (Long64_t i = 0; i < n; ++i) branch->Fill();
+}
+void nanoaodCopyEntries(TTree * src, TTree * dst, TEntryList * elist) {
+  for (Long64_t i = 0, n = elist->GetN(); i < n; ++i) {
+    src->GetEntry(elist->GetEntry(i));
+    dst->Fill();
+  }
+}
+"""
+_mergeCodeDeclared = False
+
+def _declareMergeCode():
+    global _mergeCodeDeclared
+    if not _mergeCodeDeclared:
+        ROOT.gInterpreter.Declare(_mergeCode)
+        _mergeCodeDeclared = True
 
 class OutputBranch:
-    def __init__(self, tree, name, rootBranchType, n=1, lenVar=None, title=None):
+    """Output branch, with its values stored in a NumPy buffer.
+
+       The values can be given as a NumPy array, a TTreeReaderArray or any sequence, and are copied at once.
+       The handle returned by OutputTree.branch can be kept by modules and filled with fillBranch(val),
+       which is the same as OutputTree.fillBranch(name, val) without looking up the branch by name."""
+    def __init__(self, tree, name, rootBranchType, n=1, lenVar=None, title=None, lenBranch=None, intree=None):
         n = int(n)
-        self.buff   = array(_rootBranchType2PythonArray[rootBranchType], n*[0. if rootBranchType in 'FD' else 0])
+        self.name = name
+        self.rootBranchType = rootBranchType
+        self.buff   = np.zeros(max(n,1), dtype=_rootBranchType2NumpyType[rootBranchType])
         self.lenVar = lenVar
         self.n = n
+        self._lenBranch = lenBranch
+        self._intree = intree
         if lenVar != None:
             self.branch = tree.Branch(name, self.buff, "%s[%s]/%s" % (name,lenVar,rootBranchType))
         elif n == 1:
@@ -21,15 +87,35 @@ class OutputBranch:
         if title: self.branch.SetTitle(title)
     def fill(self, val):
         if self.lenVar:
-            if len(self.buff) < len(val): # realloc
-                self.buff = array(self.buff.typecode, max(len(val),2*len(self.buff))*[0. if self.buff.typecode in 'fd' else 0])
+            n = len(val)
+            if len(self.buff) < n: # realloc, with amortised growth
+                self.buff = np.zeros(max(n,2*len(self.buff)), dtype=self.buff.dtype)
                 self.branch.SetAddress(self.buff)
-            for i,v in enumerate(val): self.buff[i] = v
+            self._copy(val, n)
         elif self.n == 1: 
             self.buff[0] = val
         else:
-            if len(val) != self.n: raise RuntimeError("Mismatch in filling branch %s of fixed length %d with %d values (%s)" % (self.Branch.GetName(),self.n,len(val),val))
-            for i,v in enumerate(val): self.buff[i] = v
+            if len(val) != self.n: raise RuntimeError("Mismatch in filling branch %s of fixed length %d with %d values (%s)" % (self.branch.GetName(),self.n,len(val),val))
+            self._copy(val, self.n)
+    def attach(self, intree):
+        """Set again the buffer of the branch, and the input tree of the following modules, for the next input file"""
+        self._intree = intree
+        self.branch.SetAddress(self.buff)
+    def fillBranch(self, val):
+        """Set the value of the branch for the current event, and make it readable by the following modules"""
+        if self.lenVar:
+            if self._lenBranch: self._lenBranch.buff[0] = len(val)
+            setExtraBranch(self._intree,self.lenVar,len(val))
+        self.fill(val)
+        setExtraBranch(self._intree,self.name,val)
+    def _copy(self, val, n):
+        if n == 0: return
+        if isinstance(val, np.ndarray) or isinstance(val, list):
+            self.buff[:n] = val
+        elif type(val).__name__.startswith("TTreeReaderArray"):
+            _copyReaderArray(val, self.buff, n, self.rootBranchType)
+        else:
+            self.buff[:n] = list(val)
 
 class OutputTree:
     def __init__(self, tfile, ttree, intree):
@@ -37,68 +123,196 @@ class OutputTree:
         self._tree = ttree
         self._intree = intree
         self._branches = {} 
+        self._optimizeBaskets = False
+        self._maxBasketMemory = None
     def branch(self, name, rootBranchType, n=1, lenVar=None, title=None):
+        if name in self._branches:
+            return self._branches[name] # made for a previous input file, when merging several of them in the same output
         if (lenVar != None) and (lenVar not in self._branches) and (not self._tree.GetBranch(lenVar)):
-            self._branches[lenVar] = OutputBranch(self._tree, lenVar, "i")
-        self._branches[name] = OutputBranch(self._tree, name, rootBranchType, n=n, lenVar=lenVar, title=title)
+            self._branches[lenVar] = OutputBranch(self._tree, lenVar, "i", intree=self._intree)
+        self._branches[name] = OutputBranch(self._tree, name, rootBranchType, n=n, lenVar=lenVar, title=title,
+                                            lenBranch=self._branches.get(lenVar, None), intree=self._intree)
         return self._branches[name]
     def fillBranch(self, name, val):
-        br = self._branches[name]
-        if br.lenVar and (br.lenVar in self._branches):
-            self._branches[br.lenVar].buff[0] = len(val)
-            setExtraBranch(self._intree,br.lenVar,len(val))
-        br.fill(val)
-        setExtraBranch(self._intree,name,val)
+        self._branches[name].fillBranch(val)
     def tree(self):
         return self._tree
+    def configureBaskets(self, autoFlush=None, optimizeBaskets=False, maxBasketMemory=None):
+        """Set the AutoFlush of the output tree (number of entries per cluster if > 0, or of bytes if < 0),
+           whether to optimise the basket sizes once the first cluster is written, and the maximum memory
+           in bytes used by the baskets being filled (which also sets the AutoFlush if it is not given)"""
+        if maxBasketMemory:
+            self._tree.SetMaxVirtualSize(maxBasketMemory)
+            if autoFlush == None: autoFlush = -maxBasketMemory
+        if autoFlush != None: self._tree.SetAutoFlush(autoFlush)
+        self._optimizeBaskets = optimizeBaskets or bool(maxBasketMemory)
+        self._maxBasketMemory = maxBasketMemory
     def fill(self):
         self._tree.Fill()
+        if self._optimizeBaskets:
+            # after the first flush, the AutoFlush is the number of entries in the first cluster
+            autoFlush = self._tree.GetAutoFlush()
+            if autoFlush > 0 and self._tree.GetEntries() >= autoFlush: self._doOptimizeBaskets()
     def write(self):
         self._file.cd()
         self._tree.Write()
+    def _doOptimizeBaskets(self):
+        self._tree.OptimizeBaskets(self._maxBasketMemory or self._tree.GetTotBytes(), 1, "")
+        self._optimizeBaskets = False
 
 class FullOutput(OutputTree):
-    def __init__(self, inputFile, inputTree, outputFile, branchSelection = None, fullClone = False, provenance = False, jsonFilter = None):
+    """Output tree with the selected branches of the input tree, and the other trees and objects of the input file.
+
+       If mergeInto is given, the output of a previous input file with the same output file, the entries and the other
+       trees and objects of this input file are appended to the ones of the previous files, as they would be by haddnano.py"""
+    def __init__(self, inputFile, inputTree, outputFile, branchSelection = None, fullClone = False, provenance = False, jsonFilter = None, copyOtherTrees = True, mergeInto = None):
         outputFile.cd()
         if branchSelection: 
             branchSelection.selectBranches(inputTree)
-        outputTree = inputTree.CopyTree('1') if fullClone else inputTree.CloneTree(0)
-        OutputTree.__init__(self, outputFile, outputTree, inputTree)
+        if mergeInto:
+            OutputTree.__init__(self, outputFile, mergeInto._tree, inputTree)
+            self._branches = mergeInto._branches
+            self._optimizeBaskets = mergeInto._optimizeBaskets
+            self._maxBasketMemory = mergeInto._maxBasketMemory
+            self._otherTrees = mergeInto._otherTrees
+            self._otherObjects = mergeInto._otherObjects
+        else:
+            outputTree = inputTree.CopyTree('1') if fullClone else inputTree.CloneTree(0)
+            OutputTree.__init__(self, outputFile, outputTree, inputTree)
+            self._otherTrees = {}
+            self._otherObjects = {}
         self._inputTree = inputTree
-        self._otherTrees = {}
-        self._otherObjects = {}
+        if mergeInto:
+            self._attachInput()
+            if fullClone: self._copyEntries()
+        if copyOtherTrees:
+            self._copyOtherTrees(inputFile, provenance, jsonFilter)
+    def fill(self):
+        self._inputTree.readAllBranches()
+        OutputTree.fill(self)
+    def write(self):
+        OutputTree.write(self)
+        for t in self._otherTrees.itervalues():
+            t.Write()
+        for on,ov in self._otherObjects.iteritems():
+            self._file.WriteTObject(ov,on)
+    def detachInput(self):
+        """Disconnect the output tree from the input tree, before the input file is closed and the next one appended"""
+        clones = self._inputTree.GetListOfClones()
+        if clones: clones.Remove(self._tree)
+    def _copyOtherTrees(self, inputFile, provenance, jsonFilter):
         for k in inputFile.GetListOfKeys():
             kn = k.GetName()
             if kn == "Events":
                 continue # this we are doing
             elif kn in ("MetaData", "ParameterSets"):
-                if provenance: self._otherTrees[kn] = inputFile.Get(kn).CopyTree('1')
+                if provenance: self._copyOtherTree(kn, inputFile.Get(kn), '1')
             elif kn in ("LuminosityBlocks", "Runs"):
-                if not jsonFilter: self._otherTrees[kn] = inputFile.Get(kn).CopyTree('1')
+                if not jsonFilter: self._copyOtherTree(kn, inputFile.Get(kn), '1')
                 else:
                     _isRun = (kn=="Runs")
-                    _it = inputFile.Get(kn)
-                    _ot = _it.CloneTree(0)
-                    for ev in _it:
-                        if (jsonFilter.filterRunOnly(ev.run) if _isRun else jsonFilter.filterRunLumi(ev.run,ev.luminosityBlock)): _ot.Fill()
-                    self._otherTrees[kn] = _ot
+                    self._copyOtherTree(kn, inputFile.Get(kn), jsonFilter.runOnlyCut() if _isRun else jsonFilter.lumiCut())
             elif k.GetClassName() == "TTree":
                 print "Not copying unknown tree %s" % kn
             else:
-                self._otherObjects[kn] = inputFile.Get(kn)
-    def fill(self):
-        self._inputTree.readAllBranches()
-        self._tree.Fill()
-    def write(self):
-        OutputTree.write(self)
-        for t in self._otherTrees.itervalues():
-            t.Write()
-        for on,ov in self._otherObjects.iteritems():
-            self._file.WriteTObject(ov,on)
+                self._copyOtherObject(kn, inputFile.Get(kn))
+    def _copyOtherTree(self, name, tree, cut):
+        if name not in self._otherTrees:
+            self._file.cd()
+            self._otherTrees[name] = tree.CopyTree(cut)
+            return
+        # append the selected entries to the ones of the previous input files
+        ROOT.gROOT.cd()
+        selected = tree.CopyTree(cut)
+        ROOT.SetOwnership(selected, True)
+        selected.CopyAddresses(self._otherTrees[name])
+        self._otherTrees[name].CopyEntries(selected)
+        self._file.cd()
+    def _copyOtherObject(self, name, obj):
+        if hasattr(obj, 'SetDirectory'): obj.SetDirectory(0) # keep it after the input file is closed
+        if name not in self._otherObjects:
+            self._otherObjects[name] = obj
+        elif obj.InheritsFrom(ROOT.TH1.Class()):
+            self._otherObjects[name].Add(obj)
+        elif obj.InheritsFrom(ROOT.TObjString.Class()):
+            if obj.GetString() != self._otherObjects[name].GetString(): print "Strings are not matching for %s" % name
+    def _attachInput(self):
+        """Connect the output tree to the branches of a new input tree.
+
+           Branches missing in the new input tree are filled with zeros, and branches that are new
+           (single values, or arrays with a new counter) are added and back-filled with zeros for the previous entries"""
+        _declareMergeCode()
+        outBranches = set(b.GetName() for b in self._tree.GetListOfBranches()) - set(self._branches.iterkeys())
+        inBranches = set(b.GetName() for b in self._inputTree.GetListOfBranches() if self._inputTree.GetBranchStatus(b.GetName()))
+        self._zeroBuffers = []
+        missing, additional = sorted(outBranches - inBranches), sorted(inBranches - outBranches)
+        if missing or additional:
+            print "Branches missing in the input: %s, additional in the input: %s" % (missing, additional)
+        for name in missing:
+            leaf = self._tree.GetBranch(name).GetLeaf(name)
+            if leaf.GetLeafCount() and leaf.GetLeafCount().GetName() not in missing:
+                raise RuntimeError("Can't merge the array branch %s, missing in the input while its counter %s is not" % (name, leaf.GetLeafCount().GetName()))
+            buff = np.zeros(max(leaf.GetLenStatic(),1), dtype=_rootLeafType2NumpyType[leaf.GetTypeName()])
+            self._tree.GetBranch(name).SetAddress(buff)
+            self._zeroBuffers.append(buff)
+        # counters first, so that the arrays can refer to them
+        for name in sorted(additional, key=lambda name : bool(self._inputTree.GetBranch(name).GetLeaf(name).GetLeafCount())):
+            leaf = self._inputTree.GetBranch(name).GetLeaf(name)
+            if leaf.GetLeafCount() and leaf.GetLeafCount().GetName() not in additional:
+                raise RuntimeError("Can't merge the array branch %s, new in the input while its counter %s is not" % (name, leaf.GetLeafCount().GetName()))
+            buff = np.zeros(max(leaf.GetLenStatic(),1), dtype=_rootLeafType2NumpyType[leaf.GetTypeName()])
+            branch = self._tree.Branch(name, buff, "%s/%s" % (leaf.GetTitle(), _rootLeafType2rootBranchType[leaf.GetTypeName()]))
+            ROOT.nanoaodBackFill(branch, self._tree.GetEntries())
+        self._inputTree.AddClone(self._tree)
+        self._inputTree.CopyAddresses(self._tree)
+        for b in self._branches.itervalues():
+            b.attach(self._inputTree)
+    def _copyEntries(self):
+        elist = self._inputTree.GetEntryList()
+        if elist: ROOT.nanoaodCopyEntries(self._inputTree, self._tree, elist)
+        else: self._tree.CopyEntries(self._inputTree)
 
 class FriendOutput(OutputTree):
+    """Friend tree, by default with its clusters aligned to the ones of the input tree, so that both can be read efficiently together"""
     def __init__(self, inputFile, inputTree, outputFile, treeName="Friends"):
         outputFile.cd()
         outputTree = ROOT.TTree(treeName,"Friend tree for "+inputTree.GetName())
         OutputTree.__init__(self, outputFile, outputTree, inputTree)
+        self._clusterStarts = None
+        self.configureBaskets()
+    def configureBaskets(self, autoFlush=None, optimizeBaskets=False, maxBasketMemory=None):
+        OutputTree.configureBaskets(self, autoFlush, optimizeBaskets, maxBasketMemory)
+        if autoFlush == None and not maxBasketMemory and ROOT.gROOT.GetVersionInt() < 61400:
+            print "WARNING: FlushBaskets does not start a new cluster in this ROOT version, the clusters of the friend tree are not aligned to the ones of the input tree"
+            self._clusterStarts = None
+        elif autoFlush == None and not maxBasketMemory:
+            # flush at the cluster boundaries of the input tree instead
+            self._tree.SetAutoFlush(0)
+            self._clusterStarts = clusterStarts(self._intree)
+            self._nextCluster = 0
+        else:
+            self._clusterStarts = None
+    def fill(self):
+        if self._clusterStarts != None:
+            entry = _currentTreeEntry(self._intree) # the tree entry, also when reading through an entry list
+            if self._nextCluster < len(self._clusterStarts) and entry >= self._clusterStarts[self._nextCluster]:
+                if self._tree.GetEntries() > 0:
+                    self._tree.FlushBaskets() # also marks the end of a cluster
+                    if self._optimizeBaskets: self._doOptimizeBaskets()
+                while self._nextCluster < len(self._clusterStarts) and entry >= self._clusterStarts[self._nextCluster]:
+                    self._nextCluster += 1
+            self._tree.Fill()
+        else:
+            OutputTree.fill(self)
+
+def clusterStarts(tree):
+    """Return the list of the first entries of the clusters of a tree"""
+    nEntries = tree.GetEntries()
+    ret = []
+    it = tree.GetClusterIterator(0)
+    entry = it.Next()
+    while entry < nEntries:
+        ret.append(entry)
+        entry = it.Next()
+    return ret
 
@@ -1,118 +1,420 @@
 #!/usr/bin/env python
 import os
+import sys
 import time
+import traceback
+import multiprocessing
+import Queue
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 from PhysicsTools.NanoAODTools.postprocessing.framework.branchselection import BranchSelection
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import InputTree
-from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import eventLoop
-from PhysicsTools.NanoAODTools.postprocessing.framework.output import FriendOutput, FullOutput
-from PhysicsTools.NanoAODTools.postprocessing.framework.preskimming import preSkim
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import eventLoop, Module
+from PhysicsTools.NanoAODTools.postprocessing.framework.output import FriendOutput, FullOutput, clusterStarts
+from PhysicsTools.NanoAODTools.postprocessing.framework.preskimming import preSkim, EntryListCache
 from PhysicsTools.NanoAODTools.postprocessing.framework.jobreport import JobReport
+from PhysicsTools.NanoAODTools.postprocessing.framework.branchprofile import BranchProfile
+from PhysicsTools.NanoAODTools.postprocessing.framework.instrumentation import Instrumentation
+from PhysicsTools.NanoAODTools.postprocessing.framework.compression import parseCompression
+from PhysicsTools.NanoAODTools.postprocessing.framework.prefetch import FilePrefetcher, configureReading
 
 class PostProcessor :
     def __init__(self,outputDir,inputFiles,cut=None,branchsel=None,modules=[],compression="LZMA:9",friend=False,postfix=None,
-		 jsonInput=None,noOut=False,justcount=False,provenance=False,haddFileName=None,fwkJobReport=False):
-	self.outputDir=outputDir
-	self.inputFiles=inputFiles
-	self.cut=cut
-	self.modules=modules
-	self.compression=compression
-	self.postfix=postfix
-	self.json=jsonInput
-	self.noOut=noOut
-	self.friend=friend
-	self.justcount=justcount
-	self.provenance=provenance
-	self.jobReport = JobReport() if fwkJobReport else None
-	self.haddFileName=haddFileName
-	if self.jobReport and not self.haddFileName :
-		print "Because you requested a FJR we assume you want the final hadd. No name specified for the output file, will use tree.root"
-		self.haddFileName="tree.root"
- 	self.branchsel = BranchSelection(branchsel) if branchsel else None 
+                 jsonInput=None,noOut=False,justcount=False,provenance=False,haddFileName=None,fwkJobReport=False,nWorkers=1,splitFiles=False,
+                 entryListCache=None,entryListCacheSize=1000,branchProfile=None,branchProfileEvents=1000,
+                 timing=False,timingJSON=None,nThreads=1,autoFlush=None,optimizeBaskets=False,maxBasketMemory=None,haddInProcess=False,
+                 prefetch=False,prefetchDir=None,prefetchEntries=1000,cacheSize=None,cacheLearnEntries=None,asyncPrefetch=False,
+                 preskimRDF=False):
+        self.outputDir=outputDir
+        self.inputFiles=inputFiles
+        self.cut=cut
+        self.modules=modules
+        self.compression=compression
+        self.postfix=postfix
+        self.json=jsonInput
+        self.noOut=noOut
+        self.friend=friend
+        self.justcount=justcount
+        self.provenance=provenance
+        self.nWorkers=max(1,int(nWorkers))
+        self.nThreads=max(1,int(nThreads))
+        self.autoFlush=autoFlush # as in TTree::SetAutoFlush: entries if > 0, bytes if < 0
+        self.optimizeBaskets=optimizeBaskets
+        self.maxBasketMemory=maxBasketMemory # in MB
+        self.splitFiles=splitFiles
+        self.jobReport = JobReport() if fwkJobReport else None
+        self.haddFileName=haddFileName
+        if self.jobReport and not self.haddFileName :
+            print "Because you requested a FJR we assume you want the final hadd. No name specified for the output file, will use tree.root"
+            self.haddFileName="tree.root"
+        self.haddInProcess=haddInProcess
+        self.prefetch=prefetch or (prefetchDir != None)
+        self.prefetchDir=prefetchDir
+        self.prefetchEntries=prefetchEntries
+        self.cacheSize=cacheSize # in MB
+        self.cacheLearnEntries=cacheLearnEntries
+        self.asyncPrefetch=asyncPrefetch
+        self.preskimRDF=preskimRDF
+        self.branchsel = BranchSelection(branchsel) if branchsel else None
+        # entryListCacheSize is in MB
+        self.entryListCache = EntryListCache(entryListCache, entryListCacheSize*1024*1024) if entryListCache else None
+        self.branchProfileDir = branchProfile
+        self.branchProfileEvents = branchProfileEvents
+        self.timing = timing or (timingJSON != None)
+        self.timingJSON = timingJSON
     def run(self) :
-    	if not self.noOut:
-            outpostfix = self.postfix if self.postfix != None else ("_Friend" if self.friend else "_Skim")
-            if self.compression != "none":
-                ROOT.gInterpreter.ProcessLine("#include <Compression.h>")
-                (algo, level) = self.compression.split(":")
-                compressionLevel = int(level)
-                if   algo == "LZMA": compressionAlgo  = ROOT.ROOT.kLZMA
-                elif algo == "ZLIB": compressionAlgo  = ROOT.ROOT.kZLIB
-                else: raise RuntimeError("Unsupported compression %s" % algo)
-            else:
-                compressionLevel = 0 
-	    print "Will write selected trees to "+self.outputDir
+        self.outpostfix = None
+        self.compressionLevel = 0
+        if not self.noOut:
+            self.outpostfix = self.postfix if self.postfix != None else ("_Friend" if self.friend else "_Skim")
+            (self.compressionAlgo, self.compressionLevel) = parseCompression(self.compression)
+            print "Will write selected trees to "+self.outputDir
             if not self.justcount:
                 if not os.path.exists(self.outputDir):
                     os.system("mkdir -p "+self.outputDir)
 
-	if self.noOut:
-	    if len(self.modules) == 0: 
-		raise RuntimeError("Running with --noout and no modules does nothing!")
+        if self.noOut:
+            if len(self.modules) == 0:
+                raise RuntimeError("Running with --noout and no modules does nothing!")
+
+        configureReading(self.cacheLearnEntries, self.asyncPrefetch)
+        self._prefetcher = None
+        t0 = time.clock(); wallTime0 = time.time()
+        merged = False
+        tasks = []
+        if self.nWorkers > 1:
+            # entry ranges are only useful if there is an event loop to run
+            split = self.splitFiles and len(self.modules) > 0 and not self.justcount
+            for fname in self.inputFiles:
+                tasks += [ (fname, part) for part in (self._splitFile(fname) if split else [None]) ]
+        if len(tasks) > 1:
+            workerResults = self._runInWorkers(tasks)
+            instrumentation = self._mergeInstrumentation(workerResults)
+            results = self._mergeParts(tasks, workerResults)
+            # the CPU time spent in the worker processes is not accounted by time.clock() in this process
+            cpuTime = time.clock()-t0 + sum(r['cpuTime'] for r in results)
+        else:
+            self._enableThreads()
+            modules = self._buildModules()
+            self._branchProfile = self._makeBranchProfile(modules)
+            for m in modules: m.beginJob()
+            self._mergedOutput = None
+            merge = self._mergeInProcess()
+            if self.prefetch:
+                # with several worker processes, the reading of the next files is already overlapped with the processing
+                self._prefetcher = FilePrefetcher(self.inputFiles, localDir=self.prefetchDir, nEntries=self.prefetchEntries,
+                                                  cacheSize=int(self.cacheSize*1024*1024) if self.cacheSize else 0)
+            results = [ self._processFile(fname, modules, merge=merge) for fname in self.inputFiles ]
+            if self._prefetcher: self._prefetcher.close()
+            if self._mergedOutput:
+                results[-1]['writeBytes'] += self._writeMergedOutput()
+                merged = True
+            for m in modules: m.endJob()
+            cpuTime = time.clock()-t0
+            instrumentation = self._mergeInstrumentation(results)
+
+        totEntriesRead = sum(r['entries'] for r in results)
+        outFileNames = [ r['outFileName'] for r in results if r['outFileName'] ]
+
+        print  totEntriesRead/cpuTime, "Hz"
+
+        if instrumentation:
+            instrumentation.printTable()
+            if self.timingJSON: instrumentation.saveJSON(self.timingJSON)
+
+        if self.justcount: return
+
+        writeBytes = sum(r['writeBytes'] for r in results)
+        if self.haddFileName and not merged :
+            os.system("./haddnano.py -j %d %s %s" %(self.nWorkers,self.haddFileName," ".join(outFileNames))) #FIXME: remove "./" once haddnano.py is distributed with cms releases
+            if os.path.exists(self.haddFileName): writeBytes += os.path.getsize(self.haddFileName)
+        if self.jobReport :
+            for r in results:
+                self.jobReport.addInputFile(r['fname'],r['nall'])
+            self.jobReport.addReadBranches(set(b for r in results for b in r['branchesRead']))
+            self.jobReport.addStorageStatistics(sum(r['readBytes'] for r in results), sum(r['readCalls'] for r in results), writeBytes,
+                                                _cacheEfficiency(results))
+            self.jobReport.addTiming(time.time()-wallTime0, cpuTime, sum(r['nall'] for r in results))
+            self.jobReport.addOutputFile(self.haddFileName, events=sum(r['npass'] for r in results))
+            self.jobReport.save()
+
+    def _mergeInProcess(self):
+        """Whether to write the selected events of all the input files directly to self.haddFileName, instead of merging the outputs with haddnano.py"""
+        if not (self.haddInProcess and self.haddFileName) or self.justcount: return False
+        if self.friend:
+            print "WARNING: friend trees are merged with haddnano.py"
+            return False
+        return True
+
+    def _writeMergedOutput(self):
+        """Write and close the merged output, returning the number of bytes written in doing so"""
+        (outFile, outTree) = self._mergedOutput
+        writeBytes0 = outFile.GetBytesWritten()
+        outTree.write()
+        outFile.Close()
+        print "Done %s" % self.haddFileName
+        return outFile.GetBytesWritten() - writeBytes0
 
-	for m in self.modules: m.beginJob()
+    def _enableThreads(self):
+        """Use self.nThreads threads in ROOT for the decompression of the input and the compression of the output baskets.
 
-	fullClone = (len(self.modules) == 0)
-	outFileNames=[]
+           The modules are still run in a single thread, and the output files are the same as with one thread,
+           as the baskets compressed in parallel are written in the same order"""
+        if self.nThreads <= 1: return
+        if not hasattr(ROOT.ROOT, "EnableImplicitMT"):
+            print "WARNING: implicit multi-threading is not available in this ROOT version, running with one thread"
+            self.nThreads = 1
+            return
+        ROOT.ROOT.EnableImplicitMT(self.nThreads)
+        ROOT.TTreeCacheUnzip.SetParallelUnzip(ROOT.TTreeCacheUnzip.kEnable)
+        print "Using %d threads for the (de)compression of the trees" % self.nThreads
+
+    def _buildModules(self):
+        """Return the list of module instances to run.
+
+           Entries of self.modules can be either module instances or the constructors
+           (e.g. the lambdas defined in the module files, or the Module classes) used to build them."""
+        return [ (m if isinstance(m, Module) else m()) for m in self.modules ]
+
+    def _mergeInstrumentation(self, results):
+        """Return the sum of the timing information of all the processed files (or parts of files), if requested"""
+        if not self.timing: return None
+        ret = Instrumentation()
+        for r in results:
+            if r.get('instrumentation'): ret.merge(Instrumentation(r['instrumentation']))
+        return ret
+
+    def _makeBranchProfile(self, modules):
+        """Return the BranchProfile of the modules, if requested: it must be made before beginJob, which may change the modules"""
+        return BranchProfile(self.branchProfileDir, modules, self.branchProfileEvents) if self.branchProfileDir else None
+
+    def _processFile(self, fname, modules, part=None, merge=False):
+        """Open, pre-skim, process and write a single input file.
+
+           If part is given as (index, nParts, firstEntry, lastEntry), only the tree entries
+           in [firstEntry, lastEntry) are processed, and written to a separate partial output file.
+           If merge is True, the output is appended to self.haddFileName, which is kept open in self._mergedOutput.
+           Returns a dictionary with the bookkeeping information needed by run()"""
         t0 = time.clock()
-	totEntriesRead=0
-	for fname in self.inputFiles:
-
-	    # open input file
-	    inFile = ROOT.TFile.Open(fname)
-
-	    #get input tree
-	    inTree = inFile.Get("Events")
-	    totEntriesRead+=inTree.GetEntries()
-	    # pre-skimming
-	    elist,jsonFilter = preSkim(inTree, self.json, self.cut)
-	    if self.justcount:
-		print 'Would select %d entries from %s'%(elist.GetN() if elist else inTree.GetEntries(), fname)
-		continue
-	    else:
-		print 'Pre-select %d entries out of %s '%(elist.GetN() if elist else inTree.GetEntries(),inTree.GetEntries())
-		
-	    if fullClone:
-		# no need of a reader (no event loop), but set up the elist if available
-		if elist: inTree.SetEntryList(elist)
-	    else:
-		# initialize reader
-		inTree = InputTree(inTree, elist) 
-
-	    # prepare output file
-	    outFileName = os.path.join(self.outputDir, os.path.basename(fname).replace(".root",outpostfix+".root"))
-	    outFile = ROOT.TFile.Open(outFileName, "RECREATE", "", compressionLevel)
-	    outFileNames.append(outFileName)
-	    if compressionLevel: outFile.SetCompressionAlgorithm(compressionAlgo)
-
-	    # prepare output tree
-	    if self.friend:
-		outTree = FriendOutput(inFile, inTree, outFile)
-	    else:
-		outTree = FullOutput(inFile, inTree, outFile, branchSelection = self.branchsel, fullClone = fullClone, jsonFilter = jsonFilter,provenance=self.provenance)
-
-	    # process events, if needed
-	    if not fullClone:
-		(nall, npass, timeLoop) = eventLoop(self.modules, inFile, outFile, inTree, outTree)
-		print 'Processed %d preselected entries from %s (%s entries). Finally selected %d entries' % (nall, fname, inTree.GetEntries(), npass)
-	    else:
-		print 'Selected %d entries from %s' % (outTree.tree().GetEntries(), fname)
-
-	    # now write the output
-	    outTree.write()
-	    outFile.Close()
-	    print "Done %s" % outFileName
-	    if self.jobReport:
-		self.jobReport.addInputFile(fname,nall)
-		
-	for m in self.modules: m.endJob()
-	
-	print  totEntriesRead/(time.clock()-t0), "Hz"
-
-
-	if self.haddFileName :
-		os.system("./haddnano.py %s %s" %(self.haddFileName," ".join(outFileNames))) #FIXME: remove "./" once haddnano.py is distributed with cms releases
-	if self.jobReport :
-		self.jobReport.addOutputFile(self.haddFileName)
-		self.jobReport.save()
+        result = { 'fname':fname, 'outFileName':None, 'entries':0, 'nall':0, 'npass':0,
+                   'readBytes':0, 'readCalls':0, 'writeBytes':0, 'cacheEfficiency':None, 'branchesRead':[] }
+        fullClone = (len(modules) == 0)
+
+        # open input file
+        inFile = self._prefetcher.open(fname) if self._prefetcher else ROOT.TFile.Open(fname)
+
+        #get input tree
+        inTree = inFile.Get("Events")
+        if self.cacheSize and not self._prefetcher: inTree.SetCacheSize(int(self.cacheSize*1024*1024))
+        if part != None: inTree.SetCacheEntryRange(part[2], part[3]) # don't prefetch the baskets of the other parts
+        result['entries'] = inTree.GetEntries() if (part == None or part[0] == 0) else 0
+        # pre-skimming, only of the entries of this part of the file
+        elist,jsonFilter = preSkim(inTree, self.json, self.cut, cache=self.entryListCache, rdf=self.preskimRDF,
+                                   entryRange=(part[2], part[3]) if part != None else None)
+        if self.justcount:
+            print 'Would select %d entries from %s'%(elist.GetN() if elist else inTree.GetEntries(), fname)
+            if self._prefetcher: self._prefetcher.release(fname, inFile)
+            result['cpuTime'] = time.clock()-t0
+            return result
+        else:
+            nEntries = inTree.GetEntries() if part == None else part[3]-part[2]
+            print 'Pre-select %d entries out of %s '%(elist.GetN() if elist else nEntries,nEntries)
+
+        eventRange = None
+        if fullClone:
+            # no need of a reader (no event loop), but set up the elist if available
+            if elist: inTree.SetEntryList(elist)
+        else:
+            # initialize reader
+            inTree = InputTree(inTree, elist)
+            if part != None and not elist: # otherwise the entry list only has entries of this part
+                eventRange = xrange(part[2], part[3])
+
+        # prepare output file
+        previousOutput = None
+        if merge and self._mergedOutput:
+            (outFile, previousOutput) = self._mergedOutput
+            outFileName = self.haddFileName
+        else:
+            outFileName = self.haddFileName if merge else self._outFileName(fname, part)
+            outFile = ROOT.TFile.Open(outFileName, "RECREATE", "", self.compressionLevel)
+            if self.compressionLevel: outFile.SetCompressionAlgorithm(self.compressionAlgo)
+        result['outFileName'] = outFileName
+        writeBytes0 = outFile.GetBytesWritten()
+        outEntries0 = previousOutput.tree().GetEntries() if previousOutput else 0
+
+        # prepare output tree
+        if self.friend:
+            outTree = FriendOutput(inFile, inTree, outFile)
+        else:
+            # when splitting a file, the other trees and objects are copied only with the first part
+            outTree = FullOutput(inFile, inTree, outFile, branchSelection = self.branchsel, fullClone = fullClone, jsonFilter = jsonFilter,provenance=self.provenance,
+                                 copyOtherTrees = (part == None or part[0] == 0), mergeInto = previousOutput)
+
+        if (self.autoFlush != None or self.optimizeBaskets or self.maxBasketMemory) and not previousOutput:
+            outTree.configureBaskets(self.autoFlush, self.optimizeBaskets, int(self.maxBasketMemory*1024*1024) if self.maxBasketMemory else None)
+
+        if self.nThreads > 1:
+            # unzip the input baskets of the different branches, and flush the output ones, in parallel
+            inTree.SetImplicitMT(True)
+            outTree.tree().SetImplicitMT(True)
+
+        # process events, if needed
+        if not fullClone:
+            instrumentation = Instrumentation() if self.timing else None
+            (nall, npass, timeLoop) = eventLoop(modules, inFile, outFile, inTree, outTree, eventRange=eventRange, branchProfile=self._branchProfile,
+                                                instrumentation=instrumentation)
+            if instrumentation: result['instrumentation'] = instrumentation.stats
+            print 'Processed %d preselected entries from %s (%s entries). Finally selected %d entries' % (nall, fname, inTree.GetEntries(), npass)
+        else:
+            nall = npass = outTree.tree().GetEntries() - outEntries0
+            print 'Selected %d entries from %s' % (npass, fname)
+        result['nall'] = nall
+        result['npass'] = npass
+
+        # now write the output, or keep it open for the next input files
+        if merge:
+            outTree.detachInput()
+            self._mergedOutput = (outFile, outTree)
+        else:
+            outTree.write()
+            outFile.Close()
+            print "Done %s" % outFileName
+
+        # storage statistics for the job report
+        result['readBytes'] = inFile.GetBytesRead()
+        result['readCalls'] = inFile.GetReadCalls()
+        result['writeBytes'] = outFile.GetBytesWritten() - writeBytes0
+        cache = inFile.GetCacheRead(inTree)
+        if cache and hasattr(cache, 'GetEfficiency'): # a TTreeCache: fraction of the reads that were served by the cache
+            result['cacheEfficiency'] = cache.GetEfficiency()
+        if not fullClone: result['branchesRead'] = sorted(inTree.branchesRead())
+        if self._prefetcher: self._prefetcher.release(fname, inFile, result['branchesRead'])
+        result['cpuTime'] = time.clock()-t0
+        return result
+
+    def _outFileName(self, fname, part=None):
+        postfix = self.outpostfix if part == None else "%s_part%d" % (self.outpostfix, part[0])
+        return os.path.join(self.outputDir, os.path.basename(fname).replace(".root",postfix+".root"))
+
+    def _splitFile(self, fname):
+        """Split the Events tree of the input file in up to self.nWorkers ranges of entries aligned to the cluster boundaries.
+
+           Returns a list of parts (index, nParts, firstEntry, lastEntry), or [None] if the file is not split"""
+        inFile = ROOT.TFile.Open(fname)
+        inTree = inFile.Get("Events")
+        nEntries = inTree.GetEntries()
+        clusters = clusterStarts(inTree)
+        inFile.Close()
+        ranges = []
+        for start in clusters:
+            if not ranges or start >= (len(ranges)*nEntries)/self.nWorkers:
+                ranges.append([start, nEntries])
+                if len(ranges) > 1: ranges[-2][1] = start
+        if len(ranges) < 2: return [None]
+        print "Splitting %s in %d ranges of entries" % (fname, len(ranges))
+        return [ (i, len(ranges), first, last) for i,(first,last) in enumerate(ranges) ]
+
+    def _mergeParts(self, tasks, results):
+        """Merge in order the partial outputs of files processed in several parts.
+
+           Returns the results with one entry per input file, in the order of the input files"""
+        merged = []
+        for (fname, part), result in zip(tasks, results):
+            if part == None:
+                merged.append(result)
+                continue
+            if part[0] == 0:
+                merged.append(dict(result, outFileName=self._outFileName(fname), parts=[]))
+            else:
+                merged[-1]['cacheEfficiency'] = _cacheEfficiency([ merged[-1], result ])
+                for k in 'entries', 'nall', 'npass', 'cpuTime', 'readBytes', 'readCalls', 'writeBytes':
+                    merged[-1][k] += result[k]
+                merged[-1]['branchesRead'] = sorted(set(merged[-1]['branchesRead']) | set(result['branchesRead']))
+            if result['outFileName']: merged[-1]['parts'].append(result['outFileName'])
+            if part[0] == part[1]-1 and merged[-1]['parts']:
+                outFileName = merged[-1]['outFileName']
+                merger = ROOT.TFileMerger(False, False)
+                merger.SetFastMethod(True)
+                merger.SetPrintLevel(0)
+                merger.OutputFile(outFileName, "RECREATE", ROOT.ROOT.CompressionSettings(self.compressionAlgo, self.compressionLevel) if self.compressionLevel else 0)
+                for partFileName in merged[-1]['parts']:
+                    merger.AddFile(partFileName, False)
+                if not merger.Merge():
+                    raise RuntimeError("Failed to merge the partial outputs of %s into %s" % (fname, outFileName))
+                for partFileName in merged[-1]['parts']:
+                    os.remove(partFileName)
+                merged[-1]['writeBytes'] += os.path.getsize(outFileName)
+                print "Merged %d parts into %s" % (len(merged[-1]['parts']), outFileName)
+        return merged
+
+    def _runInWorkers(self, tasks):
+        """Process the tasks (input file name and optional range of entries) in a pool of self.nWorkers processes.
+
+           Each worker builds its own module instances and runs beginJob/endJob once;
+           the results are returned in the same order as the tasks."""
+        taskQueue = multiprocessing.Queue()
+        resultQueue = multiprocessing.Queue()
+        for i,task in enumerate(tasks):
+            taskQueue.put((i,task))
+        nWorkers = min(self.nWorkers, len(tasks))
+        for i in xrange(nWorkers):
+            taskQueue.put(None)
+        print "Processing %d tasks with %d worker processes" % (len(tasks), nWorkers)
+        workers = [ multiprocessing.Process(target=self._worker, args=(taskQueue, resultQueue)) for i in xrange(nWorkers) ]
+        for w in workers: w.start()
+        results = [ None ] * len(tasks)
+        started = {} # task index of each worker, as reported when it takes a task
+        try:
+            for n in xrange(len(tasks)):
+                while True:
+                    try:
+                        item = resultQueue.get(timeout=5)
+                    except Queue.Empty:
+                        self._checkWorkers(workers, started, tasks)
+                        continue
+                    if item[0] == 'start':
+                        started[item[1]] = item[2]
+                        continue
+                    break
+                (i, result, error) = item
+                if error:
+                    raise RuntimeError("Error processing %s in a worker process:\n%s" % (tasks[i], error))
+                results[i] = result
+        except:
+            for w in workers: w.terminate()
+            raise
+        for w in workers: w.join()
+        return results
+
+    def _checkWorkers(self, workers, started, tasks):
+        """Raise if a worker process exited without posting the result of its task (e.g. killed, or crashed in ROOT)"""
+        for w in workers:
+            if w.is_alive() or w.exitcode == 0: continue
+            task = tasks[started[w.pid]] if w.pid in started else None
+            raise RuntimeError("Worker process %d exited with code %s while processing %s" % (w.pid, w.exitcode, task[0] if task else "its first task"))
+
+    def _worker(self, taskQueue, resultQueue):
+        self._enableThreads() # after the fork: the thread pool can't be shared by the worker processes
+        modules = self._buildModules()
+        self._branchProfile = self._makeBranchProfile(modules)
+        for m in modules: m.beginJob()
+        while True:
+            item = taskQueue.get()
+            if item == None: break
+            i, task = item
+            resultQueue.put(('start', os.getpid(), i))
+            try:
+                resultQueue.put((i, self._processFile(task[0], modules, task[1]), None))
+            except Exception:
+                resultQueue.put((i, None, traceback.format_exc()))
+                return
+            sys.stdout.flush()
+        for m in modules: m.endJob()
+
+def _cacheEfficiency(results):
+    """Return the fraction of the reads served by the TTreeCache, averaged over the results weighted by the bytes read, or None"""
+    withCache = [ r for r in results if r['cacheEfficiency'] != None ]
+    readBytes = sum(r['readBytes'] for r in withCache)
+    if not readBytes: return None
+    return sum(r['cacheEfficiency']*r['readBytes'] for r in withCache)/float(readBytes)
@@ -0,0 +1,118 @@
+import os
+import threading
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+# opening of an input file, optionally after copying it to a local file, and reading of its first
+# entries for the given branches through the TTreeCache, which then holds the baskets of the first cluster(s).
+# It runs in a background thread, without the Python lock
+_prefetchCode = """
+#include <TFile.h>
+#include <TTree.h>
+#include <string>
+#include <vector>
+#include <algorithm>
+TFile * nanoaodPrefetchFile(const char * url, const char * localCopy, const char * treeName, Long64_t cacheSize,
+                            const std::vector<std::string> & branches, Long64_t nEntries) {
+  if (localCopy[0]) {
+    if (!TFile::Cp(url, localCopy, false)) return nullptr;
+    url = localCopy;
+  }
+  TFile * f = TFile::Open(url);
+  if (!f || f->IsZombie()) return f;
+  TTree * t = nullptr;
+  f->GetObject(treeName, t);
+  if (!t) return f;
+  if (cacheSize > 0) t->SetCacheSize(cacheSize);
+  if (branches.empty() || nEntries <= 0) return f;
+  for (const auto & b : branches) t->AddBranchToCache(b.c_str(), true);
+  t->StopCacheLearningPhase();
+  t->SetBranchStatus("*", 0);
+  for (const auto & b : branches) t->SetBranchStatus(b.c_str(), 1);
+  for (Long64_t i = 0, n = std::min(nEntries, t->GetEntries()); i < n; ++i) t->GetEntry(i);
+  t->SetBranchStatus("*", 1);
+  return f;
+}
+"""
+_prefetchCodeDeclared = False
+
+def _declarePrefetchCode():
+    global _prefetchCodeDeclared
+    if not _prefetchCodeDeclared:
+        ROOT.ROOT.EnableThreadSafety()
+        ROOT.gInterpreter.Declare(_prefetchCode)
+        ROOT.nanoaodPrefetchFile._threaded = True # release the Python lock while it runs
+        _prefetchCodeDeclared = True
+
+def isRemote(fileName):
+    return "://" in fileName and not fileName.startswith("file:")
+
+def _branchVector(names):
+    ret = ROOT.std.vector('string')()
+    for name in names: ret.push_back(name)
+    return ret
+
+def configureReading(cacheLearnEntries=None, asyncPrefetch=False):
+    """Set the number of entries used by the TTreeCache to learn the branches that are read, and whether the
+       TTreeCache fills its next block asynchronously while the current one is being read; both apply to the files opened afterwards"""
+    if cacheLearnEntries: ROOT.TTreeCache.SetLearnEntries(cacheLearnEntries)
+    if asyncPrefetch: ROOT.gEnv.SetValue("TFile.AsyncPrefetching", 1)
+
+class FilePrefetcher:
+    """Prefetch of the input files, in the order of fileNames: when a file is opened, the next one is opened in a
+       background thread, optionally after copying it to localDir if it is remote, and the first nEntries entries
+       of the branches read in the previous file are read in its TTreeCache of cacheSize bytes"""
+    def __init__(self, fileNames, treeName="Events", localDir=None, cacheSize=0, nEntries=1000):
+        self._fileNames = list(fileNames)
+        self._treeName = treeName
+        self._localDir = localDir
+        self._cacheSize = cacheSize
+        self._nEntries = nEntries
+        self._pending = None
+        self._localCopies = {}
+        self.branches = []
+        _declarePrefetchCode()
+        if localDir and not os.path.isdir(localDir): os.makedirs(localDir)
+    def open(self, fname):
+        """Return the TFile of fname, waiting for its prefetch if it was started, and start the prefetch of the next file"""
+        if self._pending and self._pending[0] == fname:
+            (fname, thread, result) = self._pending
+            self._pending = None
+            thread.join()
+        else:
+            self.close() # files not opened in order
+            result = {}
+            self._prefetch(fname, self._localCopy(fname), _branchVector([]), result)
+        tfile = result.get('file', None)
+        if not tfile or tfile.IsZombie():
+            raise RuntimeError("Failed to open %s" % fname)
+        self._localCopies[fname] = result['localCopy']
+        if fname in self._fileNames and self._fileNames.index(fname)+1 < len(self._fileNames):
+            self._start(self._fileNames[self._fileNames.index(fname)+1])
+        return tfile
+    def release(self, fname, tfile, branches=None):
+        """Close the TFile of fname and remove its local copy; the branches read in it are warmed up in the next files"""
+        if branches: self.branches = sorted(branches)
+        if tfile: tfile.Close()
+        localCopy = self._localCopies.pop(fname, None)
+        if localCopy and os.path.exists(localCopy): os.remove(localCopy)
+    def close(self):
+        """Wait for the prefetch still running, if any, and drop its file"""
+        if self._pending:
+            (fname, thread, result) = self._pending
+            self._pending = None
+            thread.join()
+            self._localCopies[fname] = result['localCopy']
+            self.release(fname, result.get('file', None))
+    def _localCopy(self, fname):
+        if not (self._localDir and isRemote(fname)): return ""
+        return os.path.join(self._localDir, "prefetch_%d_%s" % (os.getpid(), os.path.basename(fname)))
+    def _start(self, fname):
+        result = {}
+        thread = threading.Thread(target=self._prefetch, args=(fname, self._localCopy(fname), _branchVector(self.branches), result))
+        thread.daemon = True
+        thread.start()
+        self._pending = (fname, thread, result)
+    def _prefetch(self, fname, localCopy, branches, result):
+        result['localCopy'] = localCopy
+        result['file'] = ROOT.nanoaodPrefetchFile(fname, localCopy, self._treeName, self._cacheSize, branches, self._nEntries)
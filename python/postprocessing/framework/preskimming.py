@@ -1,66 +1,276 @@
+import os
 import json
+import glob
+import bisect
+import hashlib
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.framework.expression import Expression, ExpressionError
+
+# compiled index of the lumi sections of JSON files, usable in TTree::Draw/CopyTree selections:
+# each JSONFilter registers its (merged, sorted) ranges of lumi sections per run, and the selection
+# nanoaodLumiMaskPass(id,run,luminosityBlock) does a binary search within the run, caching the last matching range
+_lumiMaskCode = """
+#include <deque>
+#include <map>
+#include <vector>
+#include <utility>
+#include <algorithm>
+#include <limits>
+struct NanoAODLumiMask {
+  std::map<unsigned, std::vector<std::pair<unsigned,unsigned> > > ranges;
+};
+std::deque<NanoAODLumiMask> & nanoaodLumiMasks() { static std::deque<NanoAODLumiMask> masks; return masks; }
+int nanoaodLumiMaskCreate() {
+  nanoaodLumiMasks().push_back(NanoAODLumiMask());
+  return nanoaodLumiMasks().size()-1;
+}
+void nanoaodLumiMaskAdd(int id, unsigned run, unsigned first, unsigned last) {
+  nanoaodLumiMasks()[id].ranges[run].push_back(std::make_pair(first, last));
+}
+double nanoaodLumiMaskPass(double id, double run, double lumi) {
+  thread_local int lastId = -1;
+  thread_local unsigned lastRun = 0;
+  thread_local const std::vector<std::pair<unsigned,unsigned> > * lastRanges = nullptr;
+  thread_local std::pair<unsigned,unsigned> lastRange(1, 0);
+  int i = id; unsigned r = run, l = lumi;
+  if (i == lastId && r == lastRun) {
+    if (lastRange.first <= l && l <= lastRange.second) return 1;
+  } else {
+    const std::map<unsigned, std::vector<std::pair<unsigned,unsigned> > > & ranges = nanoaodLumiMasks()[i].ranges;
+    std::map<unsigned, std::vector<std::pair<unsigned,unsigned> > >::const_iterator it = ranges.find(r);
+    lastId = i; lastRun = r; lastRange = std::make_pair(1u, 0u);
+    lastRanges = (it == ranges.end() ? nullptr : &it->second);
+  }
+  if (!lastRanges) return 0;
+  std::vector<std::pair<unsigned,unsigned> >::const_iterator it = std::upper_bound(lastRanges->begin(), lastRanges->end(), std::make_pair(l, std::numeric_limits<unsigned>::max()));
+  if (it == lastRanges->begin()) return 0;
+  --it;
+  if (l > it->second) return 0;
+  lastRange = *it;
+  return 1;
+}
+double nanoaodLumiMaskPassRun(double id, double run) {
+  return nanoaodLumiMasks()[int(id)].ranges.count(unsigned(run)) ? 1 : 0;
+}
+"""
+_lumiMaskDeclared = False
+_lumiMaskIds = {} # compiled lumi mask of each distinct content of the JSON files, shared by all the JSONFilters
+
+def _mergeRanges(lumis):
+    """Sort and merge overlapping or adjacent ranges of lumi sections"""
+    ret = []
+    for (l1,l2) in sorted((long(l1),long(l2)) for (l1,l2) in lumis):
+        if ret and l1 <= ret[-1][1]+1:
+            ret[-1] = (ret[-1][0], max(ret[-1][1], l2))
+        else:
+            ret.append((l1,l2))
+    return ret
+
 class JSONFilter:
     def __init__(self,fname="",runsAndLumis={}):
         self.keep = {}
-	if fname != "" :
-	    self.runsAndLumis= json.load(open(fname, 'r'));
-	else :
-	    self.runsAndLumis=runsAndLumis
+        if fname != "" :
+            self.runsAndLumis= json.load(open(fname, 'r'));
+        else :
+            self.runsAndLumis=runsAndLumis
         for _run,lumis in self.runsAndLumis.iteritems():
             run = long(_run)
             if run not in self.keep: self.keep[run] = []
             self.keep[run] += lumis
         for run in self.keep.keys():
             if len(self.keep[run])==0: del self.keep[run]
+            else: self.keep[run] = _mergeRanges(self.keep[run])
+        self._firstLumis = dict((run, [ l1 for (l1,l2) in ranges ]) for run,ranges in self.keep.iteritems())
+        self._lastRange = (None, 1, 0) # (run, first lumi, last lumi) of the last match, as consecutive events are mostly in the same lumi
+        self._lumiMaskId = None
     def filterRunLumi(self,run,lumi):
-        try:
-            for (l1,l2) in self.keep[run]:
-                if l1 <= lumi and lumi <= l2: return True
-            return False
-        except KeyError:
-            return False
+        (lastRun, l1, l2) = self._lastRange
+        if run == lastRun and l1 <= lumi and lumi <= l2: return True
+        if run not in self.keep: return False
+        i = bisect.bisect_right(self._firstLumis[run], lumi) - 1
+        if i < 0 or lumi > self.keep[run][i][1]: return False
+        self._lastRange = (run,) + self.keep[run][i]
+        return True
     def filterRunOnly(self,run):
         return (run in self.keep)
     def runCut(self):
         return "%d <= run && run <= %s" % (min(self.keep.iterkeys()), max(self.keep.iterkeys()))
+    def lumiCut(self, run="run", lumi="luminosityBlock"):
+        """Selection of the (run, lumi) in the JSON, to be used in TTree::Draw or CopyTree"""
+        return "nanoaodLumiMaskPass(%d,%s,%s)" % (self._compiledMask(), run, lumi)
+    def runOnlyCut(self, run="run"):
+        """Selection of the runs in the JSON, to be used in TTree::Draw or CopyTree"""
+        return "nanoaodLumiMaskPassRun(%d,%s)" % (self._compiledMask(), run)
+    def _compiledMask(self):
+        global _lumiMaskDeclared
+        if self._lumiMaskId == None:
+            key = tuple((run, tuple(ranges)) for run,ranges in sorted(self.keep.iteritems()))
+            if key not in _lumiMaskIds:
+                if not _lumiMaskDeclared:
+                    ROOT.gInterpreter.Declare(_lumiMaskCode)
+                    _lumiMaskDeclared = True
+                maskId = ROOT.nanoaodLumiMaskCreate()
+                for run,ranges in self.keep.iteritems():
+                    for (l1,l2) in ranges:
+                        ROOT.nanoaodLumiMaskAdd(maskId, run, l1, l2)
+                _lumiMaskIds[key] = maskId
+            self._lumiMaskId = _lumiMaskIds[key]
+        return self._lumiMaskId
     def filterEList(self, tree, elist):
-        #FIXME this can be optimized for sure
-        tree.SetBranchStatus("*", 0)
-        tree.SetBranchStatus('run',1)
-        tree.SetBranchStatus('luminosityBlock',1)
-        filteredList = ROOT.TEntryList('filteredList','filteredList')
-        if elist:
-            for i in xrange(elist.GetN()):
-                entry = elist.GetEntry(0) if i == 0 else elist.Next()
-                tree.GetEntry(entry)
-                if self.filterRunLumi(tree.run, tree.luminosityBlock):
-                    filteredList.Enter(entry)
-        else:
-            for entry in xrange(tree.GetEntries()):
-                tree.GetEntry(entry)
-                if self.filterRunLumi(tree.run, tree.luminosityBlock):
-                    filteredList.Enter(entry)
-        tree.SetBranchStatus("*", 1)
-        return filteredList
-                
+        """Return the entry list of the entries of elist (or of the whole tree, if None) that are in the JSON"""
+        prevEntryList = tree.GetEntryList()
+        tree.SetEntryList(elist)
+        tree.Draw('>>filteredList', self.lumiCut(), "entrylist")
+        tree.SetEntryList(prevEntryList)
+        return ROOT.gDirectory.Get('filteredList')
+
 
-def preSkim(tree, jsonInput = None, cutstring = None):
-    if jsonInput == None and cutstring == None: 
+class EntryListCache:
+    """Cache on disk of the entry lists selected by preSkim, keyed by the identity of the input file, the cut and the JSON.
+
+       When the total size of the cached entry lists exceeds maxSize (in bytes), the least recently used ones are removed."""
+    def __init__(self, directory, maxSize=1000*1024*1024):
+        self.directory = directory
+        self.maxSize = maxSize
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory): raise # otherwise created meanwhile by another process
+    def key(self, tree, cutstring, jsonFilter, entryRange=None):
+        tfile = tree.GetCurrentFile()
+        ident = [ tfile.GetName(), tfile.GetSize(), tfile.GetUUID().AsString(), tree.GetName(), tree.GetEntries(), cutstring ]
+        if entryRange: ident.append(tuple(entryRange))
+        if os.path.isfile(tfile.GetName()): ident.append(os.path.getmtime(tfile.GetName()))
+        if jsonFilter: ident.append(sorted(jsonFilter.keep.iteritems()))
+        return hashlib.sha1(repr(ident)).hexdigest()
+    def get(self, key, tree):
+        """Return the cached entry list for the tree, or None"""
+        path = self._path(key)
+        if not os.path.exists(path): return None
+        tfile = ROOT.TFile.Open(path)
+        elist = tfile.Get("elist") if tfile else None
+        if not elist:
+            if tfile: tfile.Close()
+            return None
+        elist.SetDirectory(0)
+        tfile.Close()
+        elist.SetTreeName(tree.GetName())
+        elist.SetFileName(tree.GetCurrentFile().GetName())
+        try:
+            os.utime(path, None) # mark as recently used
+        except OSError:
+            pass
+        print "Using cached entry list %s" % path
+        return elist
+    def put(self, key, elist):
+        path = self._path(key)
+        tmpPath = "%s.%d.tmp" % (path, os.getpid())
+        tfile = ROOT.TFile.Open(tmpPath, "RECREATE")
+        tfile.WriteTObject(elist, "elist")
+        tfile.Close()
+        os.rename(tmpPath, path)
+        self._evict()
+    def _path(self, key):
+        return os.path.join(self.directory, "elist_%s.root" % key)
+    def _evict(self):
+        files = []
+        for path in glob.glob(os.path.join(self.directory, "elist_*.root")):
+            try:
+                files.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                pass # removed meanwhile by another process
+        totalSize = sum(size for (mtime,size,path) in files)
+        for (mtime,size,path) in sorted(files):
+            if totalSize <= self.maxSize: break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            totalSize -= size
+
+# selection of the entries of a tree with a RDataFrame filter, using the implicit multi-threading if enabled.
+# The entries are taken in the order in which the threads process them, so they are sorted before filling the TEntryList
+_rdfEntryListCode = """
+#include <ROOT/RDataFrame.hxx>
+#include <TEntryList.h>
+#include <TTree.h>
+#include <vector>
+#include <algorithm>
+TEntryList * nanoaodRDFEntryList(TTree * tree, const char * filter, const char * name) {
+  ROOT::RDataFrame df(*tree);
+  auto entries = df.Filter(filter).Take<ULong64_t>("rdfentry_");
+  std::vector<ULong64_t> sorted(entries->begin(), entries->end());
+  std::sort(sorted.begin(), sorted.end());
+  TEntryList * elist = new TEntryList(name, name, tree);
+  for (ULong64_t entry : sorted) elist->Enter(entry);
+  return elist;
+}
+"""
+_rdfEntryListDeclared = False
+
+def _isArray(tree, name):
+    leaf = tree.GetLeaf(name)
+    if not leaf: raise ExpressionError("Unknown branch %s" % name)
+    return bool(leaf.GetLeafCount()) or leaf.GetLen() > 1
+
+def rdfSelection(tree, cutstring=None, jsonFilter=None):
+    """Return the C++ selection of a RDataFrame equivalent to the cut string and JSON selection of preSkim.
+       Raise ExpressionError if the cut string is not supported by expression.Expression"""
+    cuts = []
+    if cutstring != None:
+        cuts.append(Expression(cutstring).cppSelection(lambda name : _isArray(tree, name)))
+    if jsonFilter != None:
+        cuts += [ jsonFilter.runCut(), jsonFilter.lumiCut() ]
+    return " && ".join("(%s)" % cut for cut in cuts)
+
+def rdfEntryList(tree, selection, name="elist"):
+    """Return the TEntryList of the entries of the tree passing the selection, evaluated by a RDataFrame"""
+    global _rdfEntryListDeclared
+    if not _rdfEntryListDeclared:
+        ROOT.gInterpreter.Declare(_rdfEntryListCode)
+        _rdfEntryListDeclared = True
+    return ROOT.nanoaodRDFEntryList(tree, selection, name)
+
+def preSkim(tree, jsonInput = None, cutstring = None, cache = None, rdf = False, entryRange = None):
+    """Return the entry list of the entries of the tree passing the cut string and JSON selection, and the JSONFilter.
+
+       If entryRange is given as (firstEntry, lastEntry), only the tree entries in [firstEntry, lastEntry) are selected.
+       With rdf, the selection is evaluated by a RDataFrame, in parallel if the implicit multi-threading of ROOT is enabled;
+       cut strings not supported by expression.Expression, and ranges of entries, are still evaluated with TTree::Draw"""
+    if jsonInput == None and cutstring == None:
         return None,None
     cut = None
     jsonFilter = None
     if jsonInput != None:
-	if type(jsonInput) is dict:
+        if type(jsonInput) is dict:
             jsonFilter = JSONFilter(runsAndLumis=jsonInput)
-	else:
+        else:
             jsonFilter = JSONFilter(jsonInput)
-        cut = jsonFilter.runCut()
-    if cutstring != None: 
+        # the run range is cheap to check and rejects most of the entries of runs not in the JSON
+        cut = "(%s) && %s" % (jsonFilter.runCut(), jsonFilter.lumiCut())
+    if cutstring != None:
         cut = "(%s) && (%s)" % (cutstring, cut) if cut else cutstring
-    tree.Draw('>>elist',cut,"entrylist")
-    elist = ROOT.gDirectory.Get('elist')
-    if jsonInput:
-        elist = jsonFilter.filterEList(tree,elist)
+    if cache:
+        key = cache.key(tree, cutstring, jsonFilter, entryRange)
+        elist = cache.get(key, tree)
+        tree.GetDirectory().cd()
+        if elist: return elist,jsonFilter
+    elist = None
+    if rdf and not entryRange:
+        try:
+            elist = rdfEntryList(tree, rdfSelection(tree, cutstring, jsonFilter))
+        except ExpressionError, e:
+            print "Selecting the entries with TTree::Draw: %s" % e
+        except Exception, e: # e.g. a compilation error of the filter, or a column missing in the tree
+            print "WARNING: failed to select the entries with a RDataFrame, using TTree::Draw instead: %s" % e
+            tree.GetDirectory().cd()
+    if not elist:
+        if entryRange: tree.Draw('>>elist',cut,"entrylist",entryRange[1]-entryRange[0],entryRange[0])
+        else: tree.Draw('>>elist',cut,"entrylist")
+        elist = ROOT.gDirectory.Get('elist')
+    if cache:
+        cache.put(key, elist)
+        tree.GetDirectory().cd()
     return elist,jsonFilter
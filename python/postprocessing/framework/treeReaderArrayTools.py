@@ -1,9 +1,14 @@
 import types
+import fnmatch
+import numpy as np
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
+_rootLeafType2NumpyType = { 'UChar_t':np.uint8, 'Char_t':np.int8, 'UInt_t':np.uint32, 'Int_t':np.int32, 'Float_t':np.float32, 'Double_t':np.float64,
+                            'ULong64_t':np.uint64, 'Long64_t':np.int64, 'Bool_t':np.bool_ }
+
 def InputTree(tree,entrylist=None):
-    """add to the PyROOT wrapper of a TTree a TTreeReader and methods readBranch, arrayReader, valueReader""" 
+    """add to the PyROOT wrapper of a TTree a TTreeReader and methods readBranch, readColumn, arrayReader, valueReader""" 
     if hasattr(tree, '_ttreereader'): return tree # don't initialize twice
     tree.entry = -1
     tree._entrylist = entrylist
@@ -16,8 +21,20 @@ def InputTree(tree,entrylist=None):
     tree.arrayReader = types.MethodType(getArrayReader, tree)
     tree.valueReader = types.MethodType(getValueReader, tree)
     tree.readBranch = types.MethodType(readBranch, tree)
+    tree.readColumn = types.MethodType(readColumn, tree)
+    tree._columnCache = {}
     tree.gotoEntry = types.MethodType(_gotoEntry, tree)
     tree.readAllBranches = types.MethodType(_readAllBranches, tree)
+    tree.readChunk = types.MethodType(readChunk, tree)
+    tree.declareInputs = types.MethodType(declareInputs, tree)
+    tree.activateInputs = types.MethodType(activateInputs, tree)
+    tree.branchesRead = types.MethodType(branchesRead, tree)
+    tree._chunkBranches = set()
+    tree._declaredInputs = set()
+    tree._inputsDeclared = False
+    tree._inputsActivated = False
+    tree._undeclaredInputs = set()
+    tree._chunkBuffers = {}
     tree.entries = tree._ttreereader.GetEntries(False)
     tree._extrabranches={}
     return tree
@@ -25,6 +42,7 @@ def InputTree(tree,entrylist=None):
 def getArrayReader(tree, branchName):
     """Make a reader for branch branchName containing a variable-length value array."""
     if branchName not in tree._ttras:
+       _checkDeclared(tree, branchName)
        if not tree.GetBranch(branchName): raise RuntimeError, "Can't find branch '%s'" % branchName
        leaf = tree.GetBranch(branchName).GetLeaf(branchName)
        if not bool(leaf.GetLeafCount()): raise RuntimeError, "Branch %s is not a variable-length value array" % branchName
@@ -35,6 +53,7 @@ def getArrayReader(tree, branchName):
 def getValueReader(tree, branchName):
     """Make a reader for branch branchName containing a single value."""
     if branchName not in tree._ttrvs:
+       _checkDeclared(tree, branchName)
        if not tree.GetBranch(branchName): raise RuntimeError, "Can't find branch '%s'" % branchName
        leaf = tree.GetBranch(branchName).GetLeaf(branchName)
        if bool(leaf.GetLeafCount()) or leaf.GetLen()!=1 : raise RuntimeError, "Branch %s is not a value" % branchName
@@ -47,6 +66,7 @@ def clearExtraBranches(tree):
 
 def setExtraBranch(tree,name,val):
     tree._extrabranches[name] = val
+    tree._columnCache.pop(name, None)
 
 def readBranch(tree, branchName):
     """Return the branch value if the branch is a value, and a TreeReaderArray if the branch is an array"""
@@ -61,6 +81,7 @@ def readBranch(tree, branchName):
     else:
         branch = tree.GetBranch(branchName)
         if not branch: raise RuntimeError, "Unknown branch %s" % branchName
+        _checkDeclared(tree, branchName)
         leaf = branch.GetLeaf(branchName)
         typ = leaf.GetTypeName()
         if leaf.GetLen() == 1 and not bool(leaf.GetLeafCount()): 
@@ -73,6 +94,149 @@ def readBranch(tree, branchName):
             tree.gotoEntry(tree.entry,forceCall=True) # force calling SetEntry as a new ArrayReader was created
             return _ar
 
+def declareInputs(tree, branches):
+    """Declare the input branches read by a module: to be called in its beginFile.
+
+       Branches can be given by name or by wildcard patterns (as in SetBranchStatus). Names that are not
+       in the input tree are accepted too, as they can be branches produced by previous modules."""
+    tree._inputsDeclared = True
+    for name in branches:
+        if any(c in name for c in "*?["):
+            tree._declaredInputs.update(fnmatch.filter([ b.GetName() for b in tree.GetListOfBranches() ], name))
+        else:
+            tree._declaredInputs.add(name)
+
+def activateInputs(tree, keep=[], deactivate=True):
+    """Make at once the readers of all the declared input branches, so that the TTreeReader is not rebuilt during the event loop.
+
+       If deactivate is True, all the other branches are disabled, except the ones in keep (e.g. those copied to the output tree).
+       From then on, reading a branch that was not declared still works, but it is reported."""
+    declared = [ name for name in sorted(tree._declaredInputs) if tree.GetBranch(name) ]
+    for name in declared:
+        if name in tree._ttras or name in tree._ttrvs: continue
+        leaf = tree.GetBranch(name).GetLeaf(name)
+        if not leaf: continue
+        if leaf.GetLen() == 1 and not bool(leaf.GetLeafCount()):
+            _makeValueReader(tree, leaf.GetTypeName(), name)
+        else:
+            _makeArrayReader(tree, leaf.GetTypeName(), name)
+    if deactivate:
+        # readers made before the declarations (e.g. in initReaders) are needed as well
+        needed = set(declared) | set(tree._ttras.iterkeys()) | set(tree._ttrvs.iterkeys())
+        needed |= set(name for name in keep if tree.GetBranch(name))
+        tree.SetBranchStatus("*", 0)
+        for name in needed:
+            _enableBranch(tree, name)
+            tree.AddBranchToCache(name, True)
+        # the TTreeCache already knows all the branches that will be read, no need to learn them from the first entries
+        tree.StopCacheLearningPhase()
+        tree._inputsActivated = True
+
+def branchesRead(tree):
+    """Return the set of the input branches read so far, through readers or readChunk"""
+    return set(tree._ttras.iterkeys()) | set(tree._ttrvs.iterkeys()) | tree._chunkBranches
+
+def readColumn(tree, branchName):
+    """Return the values of an array branch for the current entry as a list, which is read only once per entry
+       (the value itself for single-value branches)"""
+    if branchName in tree._extrabranches:
+        val = tree._extrabranches[branchName]
+        if type(val) == str: return ord(val) # convert char to integer number, as for the values read from the tree
+        if hasattr(val, '__len__') and len(val) and type(val[0]) == str: return [ ord(v) for v in val ]
+        return val
+    ret = tree._columnCache.get(branchName, None)
+    if ret is None:
+        val = readBranch(tree, branchName)
+        if branchName not in tree._ttras: return val
+        ret = [ val[i] for i in xrange(val.GetSize()) ]
+        if ret and type(ret[0]) == str: ret = [ ord(v) for v in ret ] # convert char to integer number
+        tree._columnCache[branchName] = ret
+    return ret
+
+def readChunk(tree, branches, start, stop):
+    """Read the values of the branches for the entries in [start, stop) into NumPy arrays.
+
+       Entries are numbered as in gotoEntry, i.e. within the entry list if there is one.
+       Returns a dictionary with a NumPy array for single-value branches and a JaggedArray for array branches.
+       The arrays are views of buffers that are reused by the next call reading the same branches,
+       so they must be copied if they are needed for longer. Values are read through TTree::Draw, hence as doubles:
+       64-bit integers above 2^53 are not exact."""
+    nEntries = stop-start
+    tree._chunkBranches.update(branches)
+    values = []; arrays = []
+    for name in branches:
+        branch = tree.GetBranch(name)
+        if not branch: raise RuntimeError, "Unknown branch %s" % name
+        _checkDeclared(tree, name)
+        leaf = branch.GetLeaf(name)
+        if leaf.GetLen() == 1 and not bool(leaf.GetLeafCount()):
+            values.append((name, leaf.GetTypeName()))
+        else:
+            arrays.append((name, leaf))
+    for name, leaf in arrays:
+        leafCount = leaf.GetLeafCount()
+        if bool(leafCount) and leafCount.GetName() not in [ n for n,t in values ]:
+            values.append((leafCount.GetName(), leafCount.GetTypeName()))
+    ret = {}
+    prevEntryList = tree.GetEntryList()
+    prevEstimate = tree.GetEstimate()
+    tree.SetEntryList(tree._entrylist)
+    try:
+        # TTree::Draw evaluates up to 4 expressions at once, and keeps their values in memory if there are not more than the estimate
+        tree.SetEstimate(nEntries+1)
+        for i in xrange(0, len(values), 4):
+            group = values[i:i+4]
+            columns = _drawColumns(tree, [ n for n,t in group ], nEntries, start)
+            for (name, typ), column in zip(group, columns):
+                if len(column) != nEntries: raise RuntimeError, "Read %d values of branch %s instead of %d" % (len(column), name, nEntries)
+                ret[name] = _chunkBuffer(tree, name, typ, column)
+        # arrays with the same counter (or the same fixed length) have the same number of values, so they are drawn together as well
+        byCount = {}
+        for name, leaf in arrays:
+            leafCount = leaf.GetLeafCount()
+            countName = leafCount.GetName() if bool(leafCount) else "%d" % leaf.GetLen()
+            if countName not in byCount: byCount[countName] = []
+            byCount[countName].append((name, leaf))
+        for countName in sorted(byCount.iterkeys()):
+            sameCount = byCount[countName]
+            leaf = sameCount[0][1]
+            counts = ret[countName] if bool(leaf.GetLeafCount()) else np.full(nEntries, leaf.GetLen(), dtype=np.int64)
+            offsets = _chunkBuffer(tree, "offsets:"+countName, None, None, nEntries+1)
+            offsets[0] = 0
+            np.cumsum(counts, out=offsets[1:])
+            tree.SetEstimate(int(max(offsets[-1], nEntries))+1)
+            for i in xrange(0, len(sameCount), 4):
+                group = sameCount[i:i+4]
+                columns = _drawColumns(tree, [ n for n,l in group ], nEntries, start)
+                for (name, leaf), column in zip(group, columns):
+                    if len(column) != offsets[-1]: raise RuntimeError, "Read %d values of branch %s instead of %d" % (len(column), name, offsets[-1])
+                    ret[name] = JaggedArray(_chunkBuffer(tree, name, leaf.GetTypeName(), column), offsets)
+    finally:
+        tree.SetEntryList(prevEntryList)
+        tree.SetEstimate(prevEstimate)
+    return dict((name, ret[name]) for name in branches)
+
+class JaggedArray(object):
+    """Variable-length arrays of a range of entries, stored as a flat array of values (content)
+       and the offsets of the first value of each entry (offsets, with one more element than the number of entries)"""
+    def __init__(self,content,offsets):
+        self.content = content
+        self.offsets = offsets
+    @staticmethod
+    def fromCounts(content,counts):
+        offsets = np.zeros(len(counts)+1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return JaggedArray(content,offsets)
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+    def entryIndex(self):
+        """Return, for each value in content, the index of the entry it belongs to"""
+        return np.repeat(np.arange(len(self)), self.counts)
+    def __len__(self):
+        return len(self.offsets)-1
+    def __getitem__(self,index):
+        return self.content[self.offsets[index]:self.offsets[index+1]]
 
 
 ####### PRIVATE IMPLEMENTATION PART #######
@@ -106,6 +270,21 @@ def _remakeAllReaders(tree):
     tree._ttreereaderversion += 1
 
 
+def _enableBranch(tree, name):
+    tree.SetBranchStatus(name, 1)
+    leaf = tree.GetBranch(name).GetLeaf(name)
+    if leaf and bool(leaf.GetLeafCount()): tree.SetBranchStatus(leaf.GetLeafCount().GetName(), 1)
+
+def _checkDeclared(tree, branchName):
+    """Report (once) and enable a branch read without being declared, if the undeclared branches were disabled"""
+    if not tree._inputsActivated or branchName in tree._declaredInputs: return
+    if branchName not in tree._undeclaredInputs:
+        print "WARNING: branch %s is read but was not declared with declareInputs in the beginFile of the modules" % branchName
+        tree._undeclaredInputs.add(branchName)
+        tree._declaredInputs.add(branchName)
+    _enableBranch(tree, branchName)
+    tree.AddBranchToCache(branchName, True)
+
 def _readAllBranches(tree):
     tree.GetEntry(_currentTreeEntry(tree))
 
@@ -117,6 +296,8 @@ def _currentTreeEntry(tree):
 
 def _gotoEntry(tree, entry, forceCall=False):
     tree._ttreereader._isClean = False
+    if tree.entry != entry:
+        tree._columnCache.clear()
     if tree.entry != entry or forceCall:
         if (tree.entry == entry-1 and entry!=0):
             tree._ttreereader.Next()
@@ -124,3 +305,26 @@ def _gotoEntry(tree, entry, forceCall=False):
             tree._ttreereader.SetEntry(entry)
         tree.entry = entry
 
+def _drawColumns(tree, names, nEntries, firstEntry):
+    if nEntries <= 0: return [ np.empty(0) for n in names ]
+    if tree.Draw(":".join(names), "", "goff", nEntries, firstEntry) < 0:
+        raise RuntimeError, "Failed to read branches %s" % names
+    nRows = tree.GetSelectedRows()
+    columns = []
+    for i in xrange(len(names)):
+        val = tree.GetVal(i)
+        val.SetSize(nRows)
+        columns.append(np.frombuffer(val, dtype=np.float64, count=nRows))
+    return columns
+
+def _chunkBuffer(tree, key, typ, values, size=None):
+    """Return a view of size elements (or the size of values, copied in it) of a buffer reused across chunks"""
+    if size == None: size = len(values)
+    dtype = _rootLeafType2NumpyType[typ] if typ else np.int64
+    buff = tree._chunkBuffers.get(key, None)
+    if buff is None or len(buff) < size or buff.dtype != dtype:
+        buff = np.empty(max(size, 2*len(buff) if buff is not None else size), dtype=dtype)
+        tree._chunkBuffers[key] = buff
+    ret = buff[:size]
+    if values is not None: ret[:] = values
+    return ret
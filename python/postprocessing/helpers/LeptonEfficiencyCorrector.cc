@@ -4,8 +4,11 @@
 #include <iostream>
 #include <string>
 #include <vector>
+#include <cmath>
 #include <TH2.h>
 #include <TFile.h>
+#include <TTreeReaderValue.h>
+#include <TTreeReaderArray.h>
 
 #include "WeightCalculatorFromHistogram.cc"
 
@@ -16,18 +19,22 @@ class LeptonEfficiencyCorrector {
   LeptonEfficiencyCorrector(std::vector<std::string> files, std::vector<std::string> histos);
   ~LeptonEfficiencyCorrector() {}
 
-  void setLeptons(int nLep, int *lepPdgId, float *lepPt, float *lepEta);
+  void setLeptons(TTreeReaderValue<unsigned> *nLep, TTreeReaderArray<int> *lepPdgId, TTreeReaderArray<float> *lepPt, TTreeReaderArray<float> *lepEta);
 
   float getSF(int pdgid, float pt, float eta);
   float getSFErr(int pdgid, float pt, float eta);
+  // scale factors of the leptons of the current entry of the tree readers; run() also fills the uncertainties returned by errors()
   const std::vector<float> & run();
+  const std::vector<float> & errors() const { return retErr_; }
 
 private:
   std::vector<TH2F*> effmaps_;
-  std::vector<float> ret_;
-  int nLep_;
-  float *Lep_eta_, *Lep_pt_;
-  int *Lep_pdgId_;
+  std::vector<WeightCalculatorFromHistogram> weights_;
+  std::vector<float> ret_, retErr_;
+  TTreeReaderValue<unsigned> *nLep_ = nullptr;
+  TTreeReaderArray<int> *Lep_pdgId_ = nullptr;
+  TTreeReaderArray<float> *Lep_pt_ = nullptr;
+  TTreeReaderArray<float> *Lep_eta_ = nullptr;
 };
 
 LeptonEfficiencyCorrector:: LeptonEfficiencyCorrector(std::vector<std::string> files, std::vector<std::string> histos) {
@@ -43,20 +50,23 @@ LeptonEfficiencyCorrector:: LeptonEfficiencyCorrector(std::vector<std::string> f
       std::cout << "WARNING! File " << files[i] << " cannot be opened. Skipping this scale factor " << std::endl;
       continue;
     }
-    TH2F *hist = (TH2F*)(f->Get(histos[i].c_str()))->Clone(("eff_"+histos[i]).c_str());
-    hist->SetDirectory(0);
-    if(!hist) {
+    TH2F *orig = (TH2F*)(f->Get(histos[i].c_str()));
+    if(!orig) {
       std::cout << "ERROR! Histogram " << histos[i] << " not in file " << files[i] << ". Not considering this SF. " << std::endl;
+      f->Close();
       continue;
     } else {
       std::cout << "Loading histogram " << histos[i] << " from file " << files[i] << "... " << std::endl;
     }
+    TH2F *hist = (TH2F*)orig->Clone(("eff_"+histos[i]).c_str());
+    hist->SetDirectory(0);
     effmaps_.push_back(hist);
+    weights_.push_back(WeightCalculatorFromHistogram(hist));
     f->Close();
   }
 }
 
-void LeptonEfficiencyCorrector::setLeptons(int nLep, int *lepPdgId, float *lepPt, float *lepEta) {
+void LeptonEfficiencyCorrector::setLeptons(TTreeReaderValue<unsigned> *nLep, TTreeReaderArray<int> *lepPdgId, TTreeReaderArray<float> *lepPt, TTreeReaderArray<float> *lepEta) {
   nLep_ = nLep; Lep_pdgId_ = lepPdgId; Lep_pt_ = lepPt; Lep_eta_ = lepEta;
 }
 
@@ -64,28 +74,30 @@ float LeptonEfficiencyCorrector::getSF(int pdgid, float pt, float eta) {
   float out=1.;
   float x = abs(pdgid)==13 ? pt : eta;
   float y = abs(pdgid)==13 ? fabs(eta) : pt;
-  for(std::vector<TH2F*>::iterator hist=effmaps_.begin(); hist<effmaps_.end(); ++hist) {
-    WeightCalculatorFromHistogram wc(*hist);
-    out *= wc.getWeight(x,y);
+  for(std::vector<WeightCalculatorFromHistogram>::const_iterator wc=weights_.begin(); wc<weights_.end(); ++wc) {
+    out *= wc->getWeight(x,y);
   }
   return out;
 }
 
 float LeptonEfficiencyCorrector::getSFErr(int pdgid, float pt, float eta) {
-  float out=1.;
-  float x = pt;
-  float y = abs(pdgid)==13 ? fabs(eta) : eta;
-  for(std::vector<TH2F*>::iterator hist=effmaps_.begin(); hist<effmaps_.end(); ++hist) {
-    WeightCalculatorFromHistogram wc(*hist);
-    out *= wc.getWeightErr(x,y);
+  // relative uncertainties of the individual scale factors added in quadrature
+  float sf=1., relErr2=0.;
+  float x = abs(pdgid)==13 ? pt : eta;
+  float y = abs(pdgid)==13 ? fabs(eta) : pt;
+  for(std::vector<WeightCalculatorFromHistogram>::const_iterator wc=weights_.begin(); wc<weights_.end(); ++wc) {
+    float w = wc->getWeight(x,y);
+    sf *= w;
+    if(w != 0) relErr2 += std::pow(wc->getWeightErr(x,y)/w, 2);
   }
-  return out;
+  return sf*std::sqrt(relErr2);
 }
 
 const std::vector<float> & LeptonEfficiencyCorrector::run() {
-  ret_.clear();
-  for (int iL = 0, nL = nLep_; iL < nL; ++iL) {
-    ret_.push_back(getSF((Lep_pdgId_)[iL], (Lep_pt_)[iL], (Lep_eta_)[iL]));
+  ret_.clear(); retErr_.clear();
+  for (int iL = 0, nL = **nLep_; iL < nL; ++iL) {
+    ret_.push_back(getSF((*Lep_pdgId_)[iL], (*Lep_pt_)[iL], (*Lep_eta_)[iL]));
+    retErr_.push_back(getSFErr((*Lep_pdgId_)[iL], (*Lep_pt_)[iL], (*Lep_eta_)[iL]));
   }
   return ret_;
 }
@@ -1,9 +1,11 @@
 import ROOT
 import os
+import numpy as np
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
-from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, JaggedArray
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoAODTools.postprocessing.modules.btv.btagSFTables import BTagSFTables
 
 def is_relevant_syst_for_shape_corr(flavor_btv, syst):
     """Returns true if a flavor/syst combination is relevant"""
@@ -64,11 +66,10 @@ class btagSFProducer(Module):
         else:
             raise ValueError("ERROR: Invalid algorithm '%s'! Please choose either 'csvv2' or 'cmva'." % algo)
 
-        # load libraries for accessing b-tag scale factors (SFs) from conditions database
-        for library in [ "libCondFormatsBTauObjects", "libCondToolsBTau" ]:
-            if library not in ROOT.gSystem.GetLibraries():
-                print("Load Library '%s'" % library.replace("lib", ""))
-                ROOT.gSystem.Load(library)
+        if self.algo == "csvv2":
+            self.discr = "btagDeepB"
+        else:
+            self.discr = "btagCMVA"
 
         # define systematic uncertainties
         self.systs = []
@@ -103,32 +104,15 @@ class btagSFProducer(Module):
                 self.branchNames_central_and_systs_shape_corr[central_or_syst] = "Jet_btagSF_shape_%s" % central_or_syst
 
     def beginJob(self):
-        # initialize BTagCalibrationReader
-        # (cf. https://twiki.cern.ch/twiki/bin/viewauth/CMS/BTagCalibration )
-        self.calibration = ROOT.BTagCalibration(self.algo, os.path.join(self.inputFilePath, self.inputFileName))
-        self.readers = {}
-        for wp in [ "L", "M", "T", "shape_corr" ]:
-            wp_btv = { "l" : 0, "m" : 1, "t" : 2, "shape_corr" : 3 }.get(wp.lower(), None)
-            syts = None
-            if wp_btv in [ 0, 1, 2 ]:
-                systs = self.systs
-            else:
-                systs = self.systs_shape_corr
-            v_systs = getattr(ROOT, 'vector<string>')()
-            for syst in systs:
-                v_systs.push_back(syst)
-            reader = ROOT.BTagCalibrationReader(wp_btv, 'central', v_systs)
-            for flavor_btv in [ 0, 1, 2 ]:
-                if wp == "shape_corr":
-                    reader.load(self.calibration, flavor_btv, 'iterativefit')
-                else:
-                    reader.load(self.calibration, flavor_btv, self.measurement_types[flavor_btv])
-            self.readers[wp_btv] = reader
+        # parse the b-tag scale factors once, into tables evaluated on arrays of jets
+        # (same results as BTagCalibrationReader::eval_auto_bounds, cf. https://twiki.cern.ch/twiki/bin/viewauth/CMS/BTagCalibration )
+        self.tables = BTagSFTables(os.path.join(self.inputFilePath, self.inputFileName))
 
     def endJob(self):
         pass
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        inputTree.declareInputs(["nJet", "Jet_pt", "Jet_eta", "Jet_partonFlavour", "Jet_%s" % self.discr])
         self.out = wrappedOutputTree
         for central_or_syst in self.central_and_systs:
             self.out.branch(self.branchNames_central_and_systs[central_or_syst], "F", lenVar="nJet")
@@ -148,84 +132,93 @@ class btagSFProducer(Module):
 
             Automatically checks if values are in allowed range
 
-            If unknown wp/syst/mtype/flavor, returns -1.0
+            If unknown wp/mtype/flavor, returns -1.0
+            If syst is not one of the systematics of the module (systs, or systs_shape_corr for shape_corr), raises a ValueError,
+            as BTagCalibrationReader::eval_auto_bounds does for the systematics that were not given to its constructor
         """
+        return self.getSFs(np.array([ pt ]), np.array([ eta ]), np.array([ flavor ]), syst, wp, measurement_type, shape_corr, np.array([ discr ]))[0]
 
+    def getSFs(self, pt, eta, flavor, syst = 'central', wp = 'M', measurement_type = 'auto', shape_corr = False, discr = None, cache = None):
+        """Same as getSF, for NumPy arrays of jets.
+            If given, cache is a dictionary used to avoid evaluating several times the same scale factors
+        """
+        pt = np.asarray(pt, dtype=np.float64)
+        eta = np.asarray(eta, dtype=np.float64)
         epsilon = 1.e-3
-        if eta <= -self.max_abs_eta:
-            eta = -self.max_abs_eta + epsilon
-        if eta >= +self.max_abs_eta:
-            eta = +self.max_abs_eta - epsilon
-
-        flavor_btv = None
-        if abs(flavor) == 5:
-            flavor_btv = 0
-        elif abs(flavor) == 4:
-            flavor_btv = 1
-        elif abs(flavor) in [ 0, 1, 2, 3, 21 ]:
-            flavor_btv = 2
-        else:
-            if self.verbose > 0:
-                print("WARNING: Unknown flavor '%s', setting b-tagging SF to -1!" % repr(flavor))
-            return -1.
+        eta = np.where(eta <= -self.max_abs_eta, -self.max_abs_eta + epsilon, np.where(eta >= +self.max_abs_eta, +self.max_abs_eta - epsilon, eta))
+        discr = np.asarray(discr, dtype=np.float64) if discr is not None else np.zeros(len(pt))
+        if cache is None: cache = {}
+
+        flavor = np.abs(np.asarray(flavor))
+        flavor_btv = np.where(flavor == 5, 0, np.where(flavor == 4, 1, np.where(np.in1d(flavor, [ 0, 1, 2, 3, 21 ]), 2, -1)))
+        if self.verbose > 0:
+            for f in flavor[flavor_btv < 0]:
+                print("WARNING: Unknown flavor '%s', setting b-tagging SF to -1!" % repr(f))
 
         if shape_corr:
             wp = "shape_corr"
         wp_btv = { "l" : 0, "m" : 1, "t" : 2, "shape_corr" : 3 }.get(wp.lower(), None)
-        if wp_btv == None or not wp_btv in self.readers.keys():
+        if wp_btv == None:
             if self.verbose > 0:
                 print("WARNING: Unknown working point '%s', setting b-tagging SF to -1!" % wp)
-            return -1.
-        reader = self.readers[wp_btv]
+            return np.full(len(pt), -1.)
 
         syst = syst.lower()
 
         # evaluate SF
-        sf = None
-        if shape_corr:
-            if is_relevant_syst_for_shape_corr(flavor_btv, syst):
-                sf = reader.eval_auto_bounds(syst, flavor_btv, eta, pt, discr)
+        sf = np.full(len(pt), -1.)
+        for flavor_value in [ 0, 1, 2 ]:
+            sel = (flavor_btv == flavor_value)
+            if not np.any(sel): continue
+            if shape_corr:
+                measurement_type_btv = 'iterativefit'
+                syst_btv = syst if is_relevant_syst_for_shape_corr(flavor_value, syst) else 'central'
             else:
-                sf = reader.eval_auto_bounds('central', flavor_btv, eta, pt, discr)
-        else:
-            sf = reader.eval_auto_bounds(syst, flavor_btv, eta, pt)
+                measurement_type_btv = self.measurement_types[flavor_value]
+                syst_btv = syst
+            if syst_btv != 'central' and syst_btv not in (self.systs_shape_corr if shape_corr else self.systs):
+                raise ValueError("sysType not available (maybe not loaded?): %s" % syst_btv)
+            key = ( wp_btv, measurement_type_btv, syst_btv, flavor_value )
+            if key not in cache:
+                cache[key] = self.tables.evalAutoBounds(wp_btv, measurement_type_btv, syst_btv, flavor_value, eta[sel], pt[sel], discr[sel] if shape_corr else np.zeros(np.count_nonzero(sel)))
+            sf[sel] = cache[key]
         return sf
 
-    def analyze(self, event):
-        """process event, return True (go to next module) or False (fail, go to next event)"""
-        jets = Collection(event, "Jet")
-
-        discr = None
-        if self.algo == "csvv2":
-            discr = "btagDeepB"
-        elif self.algo == "cmva":
-            discr = "btagCMVA"
-        else:
-            raise ValueError("ERROR: Invalid algorithm '%s'! Please choose either 'csvv2' or 'cmva'." % self.algo)
-
+    def computeSFs(self, pt, eta, flavor, discr):
+        """Return the dictionary of output branch name -> scale factors for NumPy arrays of jets"""
+        ret = {}
+        cache = {}
         for central_or_syst in self.central_and_systs:
-            scale_factors = []
-            for idx, jet in enumerate(jets):
-                sf = self.getSF(jet.pt, jet.eta, jet.partonFlavour, central_or_syst, 'M', 'auto', False, getattr(jet, discr))
-                if sf < 0.01:
-                    if self.verbose > 0:
-                        print("jet #%i: pT = %1.1f, eta = %1.1f, discr = %1.3f, flavor = %i" % (idx, jet.pt, jet.eta, getattr(jet, discr), jet.partonFlavour))
-                    sf = 1.
-                scale_factors.append(sf)
-            self.out.fillBranch(self.branchNames_central_and_systs[central_or_syst], scale_factors)
+            ret[self.branchNames_central_and_systs[central_or_syst]] = self.getSFs(pt, eta, flavor, central_or_syst, 'M', 'auto', False, discr, cache)
         for central_or_syst in self.central_and_systs_shape_corr:
-            scale_factors = []
-            for idx, jet in enumerate(jets):
-                sf = self.getSF(jet.pt, jet.eta, jet.partonFlavour, central_or_syst, 'shape_corr', 'auto', True, getattr(jet, discr))
-                if sf < 0.01:
-                    if self.verbose > 0:
-                        print("jet #%i: pT = %1.1f, eta = %1.1f, discr = %1.3f, flavor = %i" % (idx, jet.pt, jet.eta, getattr(jet, discr), jet.partonFlavour))
-                    sf = 1.
-                scale_factors.append(sf)
-            self.out.fillBranch(self.branchNames_central_and_systs_shape_corr[central_or_syst], scale_factors)
+            ret[self.branchNames_central_and_systs_shape_corr[central_or_syst]] = self.getSFs(pt, eta, flavor, central_or_syst, 'shape_corr', 'auto', True, discr, cache)
+        for name, scale_factors in ret.iteritems():
+            invalid = (scale_factors < 0.01)
+            if self.verbose > 0:
+                for idx in np.flatnonzero(invalid):
+                    print("jet #%i: pT = %1.1f, eta = %1.1f, discr = %1.3f, flavor = %i" % (idx, pt[idx], eta[idx], discr[idx], flavor[idx]))
+            ret[name] = np.where(invalid, 1., scale_factors).astype(np.float32)
+        return ret
 
+    def analyze(self, event):
+        """process event, return True (go to next module) or False (fail, go to next event)"""
+        jets = Collection(event, "Jet")
+        pt = np.array([ jet.pt for jet in jets ])
+        eta = np.array([ jet.eta for jet in jets ])
+        flavor = np.array([ jet.partonFlavour for jet in jets ], dtype=np.int32)
+        discr = np.array([ getattr(jet, self.discr) for jet in jets ])
+        for name, scale_factors in self.computeSFs(pt, eta, flavor, discr).iteritems():
+            self.out.fillBranch(name, scale_factors)
         return True
 
+    def analyzeBatch(self, chunk):
+        """same as analyze, for all the events of a chunk at once"""
+        branches = [ "Jet_pt", "Jet_eta", "Jet_partonFlavour", "Jet_%s" % self.discr ]
+        chunk.load(branches)
+        ( pt, eta, flavor, discr ) = [ chunk[name].content for name in branches ]
+        offsets = chunk["Jet_pt"].offsets
+        return None, dict((name, JaggedArray(scale_factors, offsets)) for name, scale_factors in self.computeSFs(pt, eta, flavor, discr).iteritems())
+
 # define modules using the syntax 'name = lambda : constructor' to avoid having them loaded when not needed
 
 btagSF = lambda : btagSFProducer()
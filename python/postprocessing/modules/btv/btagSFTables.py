@@ -0,0 +1,183 @@
+import os
+import hashlib
+import cPickle as pickle
+import numpy as np
+
+#--------------------------------------------------------------------------------------------
+# Vectorised evaluation of the b-tagging scale factors of the BTV CSV files,
+# reproducing BTagCalibrationReader::eval_auto_bounds (cf. CondTools/BTau/src/BTagCalibrationReader.cc).
+#
+# The entries of each (operating point, measurement type, systematic, jet flavour) are binned once into a
+# lookup grid: the eta, pT and discriminator axes are divided in "atoms" (the bin edges themselves and the
+# open intervals between them), within which all the range checks of the reader give the same result.
+# The grids can be cached on disk, in a directory given by the NANOAODTOOLS_BTAGSF_CACHE environment variable.
+#--------------------------------------------------------------------------------------------
+
+_cacheVersion = 2
+
+# functions that can be used in the formulas, besides the variable x
+_formulaFunctions = { 'log':np.log, 'log10':np.log10, 'exp':np.exp, 'sqrt':np.sqrt, 'pow':np.power, 'abs':np.abs, 'fabs':np.abs,
+                      'max':np.maximum, 'min':np.minimum }
+
+def compileFormula(formula):
+    """Return a function evaluating the TF1 formula of a CSV entry on a NumPy array of x values"""
+    expr = formula.replace("TMath::", "").replace("^", "**").strip()
+    if not expr: expr = "0"
+    code = compile(expr, formula, 'eval')
+    for name in code.co_names:
+        if name != "x" and name not in _formulaFunctions:
+            raise ValueError("Unsupported function '%s' in b-tagging SF formula '%s'" % (name, formula))
+    def evaluate(x):
+        return eval(code, _formulaFunctions, { 'x':x })
+    return evaluate
+
+def _atoms(edges, values):
+    """Index of the atom of each value: 2*i+1 for values equal to edges[i], 2*i for values between edges[i-1] and edges[i]"""
+    return np.searchsorted(edges, values, side='left') + np.searchsorted(edges, values, side='right')
+
+def _atomValues(edges):
+    """A representative value for each atom of the edges"""
+    edges = edges.astype(np.float64)
+    if len(edges) == 0: return np.zeros(1)
+    ret = np.empty(2*len(edges)+1)
+    ret[1::2] = edges
+    ret[2:-1:2] = 0.5*(edges[1:] + edges[:-1])
+    ret[0] = edges[0] - 1.
+    ret[-1] = edges[-1] + 1.
+    return ret
+
+class BTagSFTable(object):
+    """The entries of one (operating point, measurement type, systematic, jet flavour), binned for vectorised lookup"""
+    def __init__(self, entries, useDiscr):
+        self.useDiscr = useDiscr
+        self.formulas = [ e[6] for e in entries ]
+        ( etaMin, etaMax, ptMin, ptMax, discrMin, discrMax ) = [ np.array([ e[i] for e in entries ], dtype=np.float32) for i in xrange(6) ]
+        self.useAbsEta = not np.any(etaMin < 0)
+        self.etaEdges = np.unique(np.concatenate((etaMin, etaMax)))
+        self.ptEdges = np.unique(np.concatenate((ptMin, ptMax)))
+        self.discrEdges = np.unique(np.concatenate((discrMin, discrMax))) if useDiscr else np.zeros(0, dtype=np.float32)
+        eta, pt, discr = _atomValues(self.etaEdges), _atomValues(self.ptEdges), _atomValues(self.discrEdges)
+        # first entry matching each atom, with the ranges used by BTagCalibrationReader::eval
+        self.entryIndex = np.full((len(eta), len(pt), len(discr)), -1, dtype=np.int32)
+        for i in reversed(xrange(len(entries))):
+            inEta = (etaMin[i] <= eta) & (eta < etaMax[i])
+            inPt = (ptMin[i] < pt) & (pt <= ptMax[i])
+            inDiscr = ((discrMin[i] <= discr) & (discr < discrMax[i])) if useDiscr else np.ones(len(discr), dtype=bool)
+            self.entryIndex[np.ix_(inEta, inPt, inDiscr)] = i
+        # pT range of the entries matching each (eta, discr) atom, as in BTagCalibrationReader::min_max_pt:
+        # the range is initialised by the first entry matching in eta, whatever its discriminator range
+        self.ptMin = np.full((len(eta), len(discr)), -1., dtype=np.float32)
+        self.ptMax = np.full((len(eta), len(discr)), -1., dtype=np.float32)
+        for i in xrange(len(entries)):
+            inEta = (etaMin[i] <= eta) & (eta <= etaMax[i])
+            inDiscr = ((discrMin[i] <= discr) & (discr < discrMax[i])) if useDiscr else np.ones(len(discr), dtype=bool)
+            first = np.outer(inEta, np.ones(len(discr), dtype=bool)) & (self.ptMin < 0.)
+            self.ptMin[first] = ptMin[i]
+            self.ptMax[first] = ptMax[i]
+            others = np.outer(inEta, inDiscr) & ~first
+            self.ptMin[others] = np.minimum(self.ptMin[others], ptMin[i])
+            self.ptMax[others] = np.maximum(self.ptMax[others], ptMax[i])
+        self._functions = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_functions'] = {}
+        return state
+
+    def _atoms(self, eta, discr):
+        eta = np.abs(eta) if self.useAbsEta else eta
+        return _atoms(self.etaEdges, eta), (_atoms(self.discrEdges, discr) if self.useDiscr else 0)
+
+    def minMaxPt(self, eta, discr):
+        """Return the arrays of minimum and maximum pT of the entries for each (eta, discr), or -1 if there are none"""
+        etaAtoms, discrAtoms = self._atoms(eta, discr)
+        return self.ptMin[etaAtoms, discrAtoms], self.ptMax[etaAtoms, discrAtoms]
+
+    def eval(self, eta, pt, discr):
+        """Return the array of values of the matching entries (0 for jets with no matching entry)"""
+        etaAtoms, discrAtoms = self._atoms(eta, discr)
+        entries = self.entryIndex[etaAtoms, _atoms(self.ptEdges, pt), discrAtoms]
+        x = (discr if self.useDiscr else pt).astype(np.float64)
+        ret = np.zeros(len(entries))
+        for i in np.unique(entries[entries >= 0]):
+            if i not in self._functions: self._functions[i] = compileFormula(self.formulas[i])
+            sel = (entries == i)
+            ret[sel] = self._functions[i](x[sel])
+        return ret
+
+class BTagSFTables(object):
+    """All the scale factors of a BTV CSV file, keyed by (operating point, measurement type, systematic, jet flavour).
+
+       If cacheDir is given (default: the NANOAODTOOLS_BTAGSF_CACHE environment variable, if set), the parsed tables are
+       cached in a file in that directory, which is used as long as the CSV file is not modified."""
+    def __init__(self, fileName, cacheDir=None):
+        self.fileName = fileName
+        if cacheDir == None: cacheDir = os.getenv("NANOAODTOOLS_BTAGSF_CACHE", None)
+        self.cacheFileName = os.path.join(cacheDir, "%s.%s.pkl" % (os.path.basename(fileName), hashlib.md5(os.path.abspath(fileName)).hexdigest()[:12])) if cacheDir else None
+        self.tables = self._load() if self.cacheFileName else None
+        if self.tables == None:
+            self.tables = self._parse(fileName)
+            if self.cacheFileName: self._save()
+
+    def _cacheKey(self):
+        stat = os.stat(self.fileName)
+        return ( _cacheVersion, stat.st_mtime, stat.st_size )
+
+    def _load(self):
+        try:
+            with open(self.cacheFileName, "rb") as cacheFile:
+                ( cacheKey, tables ) = pickle.load(cacheFile)
+            if cacheKey == self._cacheKey(): return tables
+        except (IOError, EOFError, ImportError, AttributeError, pickle.UnpicklingError, ValueError):
+            pass
+        return None
+
+    def _save(self):
+        tmpFileName = "%s.%d.tmp" % (self.cacheFileName, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.cacheFileName)): os.makedirs(os.path.dirname(self.cacheFileName))
+            with open(tmpFileName, "wb") as cacheFile:
+                pickle.dump(( self._cacheKey(), self.tables ), cacheFile, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpFileName, self.cacheFileName) # atomic, for jobs sharing the cache directory
+        except (IOError, OSError), e:
+            print "Could not save the b-tagging scale factor cache %s: %s" % (self.cacheFileName, e)
+
+    @staticmethod
+    def _parse(fileName):
+        entries = {}
+        for line in open(fileName):
+            line = line.strip()
+            if not line or ";" in line: continue # header line
+            fields = line.split(",", 10)
+            if len(fields) != 11:
+                raise ValueError("Invalid line in b-tagging SF file '%s': %s" % (fileName, line))
+            op, measurementType, sysType, flavour = int(fields[0]), fields[1].strip(), fields[2].strip(), int(fields[3])
+            values = [ float(f) for f in fields[4:10] ]
+            formula = fields[10].strip().strip('"')
+            entries.setdefault(( op, measurementType, sysType, flavour ), []).append(values + [ formula ])
+        return dict((key, BTagSFTable(tableEntries, key[0] == 3)) for key, tableEntries in entries.iteritems())
+
+    def table(self, op, measurementType, sysType, flavour):
+        key = ( op, measurementType, sysType, flavour )
+        if key not in self.tables:
+            self.tables[key] = BTagSFTable([], op == 3)
+        return self.tables[key]
+
+    def evalAutoBounds(self, op, measurementType, sysType, flavour, eta, pt, discr):
+        """Evaluate the scale factors for arrays of jets of the same flavour, as BTagCalibrationReader::eval_auto_bounds:
+           jets outside the pT range are evaluated at its boundaries, with doubled uncertainties.
+           As in the reader, jets without a matching entry (e.g. for a systematic that is not in the file) get 0"""
+        eta = np.asarray(eta, dtype=np.float32)
+        pt = np.asarray(pt, dtype=np.float32)
+        discr = np.asarray(discr, dtype=np.float32)
+        central = self.table(op, measurementType, "central", flavour)
+        ( ptMin, ptMax ) = central.minMaxPt(eta, discr)
+        below = (pt <= ptMin)
+        above = ~below & (pt > ptMax)
+        ptEval = np.where(below, (ptMin.astype(np.float64) + .0001).astype(np.float32),
+                          np.where(above, (ptMax.astype(np.float64) - .0001).astype(np.float32), pt))
+        sf = central.eval(eta, ptEval, discr)
+        if sysType == "central":
+            return sf
+        sfSyst = self.table(op, measurementType, sysType, flavour).eval(eta, ptEval, discr)
+        return np.where(below | above, sf + 2*(sfSyst - sf), sfSyst)
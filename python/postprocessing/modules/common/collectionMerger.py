@@ -25,6 +25,7 @@ class collectionMerger(Module):
         pass
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        inputTree.declareInputs([ "n%s" % x for x in self.input ] + [ "%s_*" % x for x in self.input ])
         _brlist = inputTree.GetListOfBranches()
         branches = [_brlist.At(i) for i in xrange(_brlist.GetEntries())]
         self.brlist_sep = [self.filterBranchNames(branches,x) for x in self.input]
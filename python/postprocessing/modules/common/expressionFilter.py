@@ -0,0 +1,27 @@
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoAODTools.postprocessing.framework.expression import Expression
+
+class expressionFilter(Module):
+    """Keep the events passing a cut string in the TTree::Draw syntax (as given to --cut), evaluated on chunks of events at once.
+
+       Unlike --cut, it can be run after other modules, and use the branches they produce"""
+    def __init__(self, cut):
+        self.cut = cut
+        self.expression = Expression(cut)
+    def beginJob(self):
+        pass
+    def endJob(self):
+        pass
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        inputTree.declareInputs(sorted(self.expression.branches()))
+    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        pass
+    def analyze(self, event):
+        """process event, return True (go to next module) or False (fail, go to next event)"""
+        return bool(event.eval(self.cut))
+    def analyzeBatch(self, chunk):
+        return self.expression.select(chunk), None
+
+# define modules using the syntax 'name = lambda : constructor' to avoid having them loaded when not needed
+
+twoJets = lambda : expressionFilter("Sum$(Jet_pt > 30 && abs(Jet_eta) < 2.4) >= 2")
@@ -29,6 +29,8 @@ class hepmcDump(Module, object):
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         super(hepmcDump,self).beginFile(inputFile, outputFile, inputTree, wrappedOutputTree)
         #self.worker.doCppOutput(wrappedOutputTree.tree())
+        inputTree.declareInputs(["event", "genWeight", "Generator_x1", "Generator_x2", "nLHEScaleWeight", "LHEScaleWeight", "nLHEPdfWeight", "LHEPdfWeight",
+                                 "nGenPart", "GenPart_pt", "GenPart_eta", "GenPart_phi", "GenPart_mass", "GenPart_pdgId", "GenPart_status", "GenPart_genPartIdxMother"])
         self.initReaders(inputTree)
         pass
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
@@ -3,21 +3,125 @@ import os
 import numpy as np
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
-from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection 
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, JaggedArray
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 
+def _lepSFInputs(muonSelectionTag, electronSelectionTag):
+    """Return the lists of files and histograms of the muon and electron scale factors"""
+    if muonSelectionTag=="LooseWP_2016":
+        mu_f=["Mu_Trg.root","Mu_ID.root","Mu_Iso.root"]
+        mu_h = ["IsoMu24_OR_IsoTkMu24_PtEtaBins/pt_abseta_ratio",
+                "MC_NUM_LooseID_DEN_genTracks_PAR_pt_eta/pt_abseta_ratio",
+                "LooseISO_LooseID_pt_eta/pt_abseta_ratio"]
+    if electronSelectionTag=="GPMVA90_2016":
+        el_f = ["EGM2D_eleGSF.root","EGM2D_eleMVA90.root"]
+        el_h = ["EGamma_SF2D", "EGamma_SF2D"]
+    mu_f = ["%s/src/PhysicsTools/NanoAODTools/python/postprocessing/data/leptonSF/" % os.environ['CMSSW_BASE'] + f for f in mu_f]
+    el_f = ["%s/src/PhysicsTools/NanoAODTools/python/postprocessing/data/leptonSF/" % os.environ['CMSSW_BASE'] + f for f in el_f]
+    return mu_f, mu_h, el_f, el_h
+
+def _axisBins(axis):
+    """Return the number of bins, range and bin edges (None for fixed-size bins) of a TAxis"""
+    n = axis.GetNbins()
+    edges = np.array([ axis.GetBinLowEdge(i) for i in xrange(1, n+2) ]) if axis.GetXbins().GetSize() else None
+    return (n, axis.GetXmin(), axis.GetXmax(), edges)
+
+def _findBins(axisBins, x):
+    """Same as TAxis::FindBin, with underflows and overflows moved to the first and last bins, and counting bins from 0"""
+    (n, xmin, xmax, edges) = axisBins
+    if edges is None:
+        ret = np.floor(n*(x-xmin)/(xmax-xmin)) # as in TAxis::FindBin, not from the rounded bin edges
+        ret[~(x < xmax)] = n-1
+        return np.clip(ret, 0, n-1).astype(np.int64)
+    return np.clip(np.searchsorted(edges, x, side='right'), 1, n) - 1
+
+class LeptonSFMaps:
+    """Lepton scale factors from a list of TH2 maps, converted to NumPy arrays of bin edges, contents and errors.
+
+       As in LeptonEfficiencyCorrector, the maps are binned in (pt, |eta|) for muons and (eta, pt) for electrons,
+       values outside of the maps are taken from the closest bin and the scale factors of all maps are multiplied."""
+    def __init__(self, files, histos):
+        self.maps = []
+        for fname, hname in zip(files, histos):
+            tfile = ROOT.TFile.Open(fname)
+            if not tfile:
+                print "WARNING! File %s cannot be opened. Skipping this scale factor " % fname
+                continue
+            hist = tfile.Get(hname)
+            if not hist:
+                print "ERROR! Histogram %s not in file %s. Not considering this SF. " % (hname, fname)
+                tfile.Close()
+                continue
+            print "Loading histogram %s from file %s... " % (hname, fname)
+            nx, ny = hist.GetNbinsX(), hist.GetNbinsY()
+            # the C++ code returns the values as float
+            content = np.array([ [ hist.GetBinContent(i, j) for j in xrange(1, ny+1) ] for i in xrange(1, nx+1) ], dtype=np.float32)
+            errors = np.array([ [ hist.GetBinError(i, j) for j in xrange(1, ny+1) ] for i in xrange(1, nx+1) ], dtype=np.float32)
+            self.maps.append((_axisBins(hist.GetXaxis()), _axisBins(hist.GetYaxis()), content, errors))
+            tfile.Close()
+
+    def getSF(self, pdgId, pt, eta):
+        """Return the arrays of scale factors and of their uncertainties (relative uncertainties of the maps added in quadrature)"""
+        pt = np.asarray(pt, dtype=np.float32)
+        eta = np.asarray(eta, dtype=np.float32)
+        isMuon = (np.abs(pdgId) == 13)
+        x = np.where(isMuon, pt, eta).astype(np.float64)
+        y = np.where(isMuon, np.abs(eta), pt).astype(np.float64)
+        sf = np.ones(len(pt), dtype=np.float32)
+        relErr2 = np.zeros(len(pt), dtype=np.float32)
+        for (xBins, yBins, content, errors) in self.maps:
+            # bins as in WeightCalculatorFromHistogram
+            ix = _findBins(xBins, x)
+            iy = _findBins(yBins, y)
+            w = content[ix, iy]
+            sf *= w
+            relErr2 += np.where(w != 0, errors[ix, iy]/np.where(w != 0, w, 1), 0)**2
+        return sf, sf*np.sqrt(relErr2)
+
 class lepSFProducer(Module):
     def __init__(self, muonSelectionTag, electronSelectionTag):
-        if muonSelectionTag=="LooseWP_2016":
-            mu_f=["Mu_Trg.root","Mu_ID.root","Mu_Iso.root"]
-            mu_h = ["IsoMu24_OR_IsoTkMu24_PtEtaBins/pt_abseta_ratio",
-                    "MC_NUM_LooseID_DEN_genTracks_PAR_pt_eta/pt_abseta_ratio",
-                    "LooseISO_LooseID_pt_eta/pt_abseta_ratio"]
-        if electronSelectionTag=="GPMVA90_2016":
-            el_f = ["EGM2D_eleGSF.root","EGM2D_eleMVA90.root"]
-            el_h = ["EGamma_SF2D", "EGamma_SF2D"]
-        mu_f = ["%s/src/PhysicsTools/NanoAODTools/python/postprocessing/data/leptonSF/" % os.environ['CMSSW_BASE'] + f for f in mu_f]
-        el_f = ["%s/src/PhysicsTools/NanoAODTools/python/postprocessing/data/leptonSF/" % os.environ['CMSSW_BASE'] + f for f in el_f]
+        self.mu_f, self.mu_h, self.el_f, self.el_h = _lepSFInputs(muonSelectionTag, electronSelectionTag)
+    def beginJob(self):
+        self._maps_mu = LeptonSFMaps(self.mu_f,self.mu_h)
+        self._maps_el = LeptonSFMaps(self.el_f,self.el_h)
+    def endJob(self):
+        pass
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        inputTree.declareInputs(["nMuon", "Muon_pdgId", "Muon_pt", "Muon_eta", "nElectron", "Electron_pdgId", "Electron_pt", "Electron_eta"])
+        self.out = wrappedOutputTree
+        self.out.branch("Muon_effSF", "F", lenVar="nMuon")
+        self.out.branch("Electron_effSF", "F", lenVar="nElectron")
+        self.out.branch("Muon_effSFErr", "F", lenVar="nMuon")
+        self.out.branch("Electron_effSFErr", "F", lenVar="nElectron")
+    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        pass
+    def analyze(self, event):
+        """process event, return True (go to next module) or False (fail, go to next event)"""
+        muons = Collection(event, "Muon")
+        electrons = Collection(event, "Electron")
+        sf_mu, sferr_mu = self._maps_mu.getSF([ mu.pdgId for mu in muons ], [ mu.pt for mu in muons ], [ mu.eta for mu in muons ])
+        sf_el, sferr_el = self._maps_el.getSF([ el.pdgId for el in electrons ], [ el.pt for el in electrons ], [ el.eta for el in electrons ])
+        self.out.fillBranch("Muon_effSF", sf_mu)
+        self.out.fillBranch("Electron_effSF", sf_el)
+        self.out.fillBranch("Muon_effSFErr", sferr_mu)
+        self.out.fillBranch("Electron_effSFErr", sferr_el)
+        return True
+    def analyzeBatch(self, chunk):
+        """same as analyze, for all the events of a chunk at once"""
+        ret = {}
+        for coll, maps in ("Muon", self._maps_mu), ("Electron", self._maps_el):
+            branches = [ "%s_%s" % (coll, var) for var in ("pdgId", "pt", "eta") ]
+            chunk.load(branches)
+            sf, sferr = maps.getSF(*[ chunk[name].content for name in branches ])
+            offsets = chunk[branches[0]].offsets
+            ret["%s_effSF" % coll] = JaggedArray(sf, offsets)
+            ret["%s_effSFErr" % coll] = JaggedArray(sferr, offsets)
+        return None, ret
+
+class lepSFProducerCpp(Module):
+    """Same as lepSFProducer, with the scale factors computed by the C++ LeptonEfficiencyCorrector reading the leptons from the tree readers"""
+    def __init__(self, muonSelectionTag, electronSelectionTag):
+        mu_f, mu_h, el_f, el_h = _lepSFInputs(muonSelectionTag, electronSelectionTag)
 
         self.mu_f = ROOT.std.vector(str)(len(mu_f))
         self.mu_h = ROOT.std.vector(str)(len(mu_f))
@@ -35,22 +139,38 @@ class lepSFProducer(Module):
     def endJob(self):
         pass
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        inputTree.declareInputs(["nMuon", "Muon_pdgId", "Muon_pt", "Muon_eta", "nElectron", "Electron_pdgId", "Electron_pt", "Electron_eta"])
+        self.initReaders(inputTree) # initReaders must be called in beginFile
         self.out = wrappedOutputTree
         self.out.branch("Muon_effSF", "F", lenVar="nMuon")
         self.out.branch("Electron_effSF", "F", lenVar="nElectron")
+        self.out.branch("Muon_effSFErr", "F", lenVar="nMuon")
+        self.out.branch("Electron_effSFErr", "F", lenVar="nElectron")
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         pass
+    def initReaders(self,tree):
+        self.nMuon = tree.valueReader("nMuon")
+        self.Muon_pdgId = tree.arrayReader("Muon_pdgId")
+        self.Muon_pt = tree.arrayReader("Muon_pt")
+        self.Muon_eta = tree.arrayReader("Muon_eta")
+        self.nElectron = tree.valueReader("nElectron")
+        self.Electron_pdgId = tree.arrayReader("Electron_pdgId")
+        self.Electron_pt = tree.arrayReader("Electron_pt")
+        self.Electron_eta = tree.arrayReader("Electron_eta")
+        self._worker_mu.setLeptons(self.nMuon,self.Muon_pdgId,self.Muon_pt,self.Muon_eta)
+        self._worker_el.setLeptons(self.nElectron,self.Electron_pdgId,self.Electron_pt,self.Electron_eta)
+        self._ttreereaderversion = tree._ttreereaderversion # must be set AFTER all calls to tree.valueReader or tree.arrayReader
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
-        muons = Collection(event, "Muon")
-        electrons = Collection(event, "Electron")
-        sf_el = [ self._worker_el.getSF(el.pdgId,el.pt,el.eta) for el in electrons ]
-        sf_mu = [ self._worker_mu.getSF(mu.pdgId,mu.pt,mu.eta) for mu in muons ]
-        self.out.fillBranch("Muon_effSF", sf_mu)
-        self.out.fillBranch("Electron_effSF", sf_el)
+        if event._tree._ttreereaderversion > self._ttreereaderversion:
+            self.initReaders(event._tree)
+        self.out.fillBranch("Muon_effSF", self._worker_mu.run())
+        self.out.fillBranch("Muon_effSFErr", self._worker_mu.errors())
+        self.out.fillBranch("Electron_effSF", self._worker_el.run())
+        self.out.fillBranch("Electron_effSFErr", self._worker_el.errors())
         return True
 
 # define modules using the syntax 'name = lambda : constructor' to avoid having them loaded when not needed
 
 lepSF = lambda : lepSFProducer( "LooseWP_2016", "GPMVA90_2016")
-
+lepSFCpp = lambda : lepSFProducerCpp( "LooseWP_2016", "GPMVA90_2016")
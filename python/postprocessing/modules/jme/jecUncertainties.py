@@ -24,6 +24,7 @@ class jecUncertProducer(Module):
         pass
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        inputTree.declareInputs(["nJet", "Jet_pt", "Jet_eta"])
         self.out = wrappedOutputTree
 	for u,branchname in self.uncerts :
 	        self.out.branch(branchname, "F", lenVar="nJet")
@@ -63,6 +64,7 @@ class jecUncertProducerCpp(jecUncertProducer,object):
         self.worker = ROOT.jecUncertProducerCppWorker(self.unc_factorized_path,self.vec_uncerts)
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        inputTree.declareInputs(["nJet", "Jet_pt", "Jet_eta"])
         if not self.doCppOutput:
             super(jecUncertProducerCpp,self).beginFile(inputFile, outputFile, inputTree, wrappedOutputTree)
         else:
@@ -6,6 +6,7 @@ ROOT.PyConfig.IgnoreCommandLineOptions = True
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoAODTools.postprocessing.tools import matchObjectCollection
+from PhysicsTools.NanoAODTools.postprocessing.modules.jme.jetTextTables import JERScaleFactorTable
 
 class jetSmearer(Module):
     def __init__(self, globalTag, jetType = "AK4PFchs", jerInputFileName = "Spring16_25nsV10_MC_PtResolution_AK4PFchs.txt", jerUncertaintyInputFileName = "Spring16_25nsV10_MC_SF_AK4PFchs.txt"):
@@ -42,6 +43,8 @@ class jetSmearer(Module):
         self.jer = ROOT.PyJetResolutionWrapper(os.path.join(self.jerInputFilePath, self.jerInputFileName))
         print("Loading JER scale factors and uncertainties from file '%s'" % os.path.join(self.jerInputFilePath, self.jerUncertaintyInputFileName))
         self.jerSF_and_Uncertainty = ROOT.PyJetResolutionScaleFactorWrapper(os.path.join(self.jerInputFilePath, self.jerUncertaintyInputFileName))
+        # same scale factors, for evaluating them on arrays of jets in getSmearedJetPtBatch
+        self.jerSFTable = JERScaleFactorTable(os.path.join(self.jerInputFilePath, self.jerUncertaintyInputFileName))
 
     def endJob(self):
         pass
@@ -123,3 +126,36 @@ class jetSmearer(Module):
         
         return ( jet_pt_smeared['nominal'], jet_pt_smeared['jerUp'], jet_pt_smeared['jerDown'] )
     
+
+    def getSmearedJetPtBatch(self, jets_pt, jets_eta, genJets_pt, alive=None):
+
+        #--------------------------------------------------------------------------------------------
+        # CV: Same as getSmearedJetPt, for NumPy arrays of jets (genJets_pt is NaN for jets without matched generator level jet).
+        #     The random numbers are drawn in the same order as by calling getSmearedJetPt for each jet in turn,
+        #     i.e. one for each jet with positive pT. If alive is given (a boolean per jet), only the jets
+        #     of the events still selected are smeared, as getSmearedJetPt is only called for those.
+        #--------------------------------------------------------------------------------------------
+
+        jets_pt = np.asarray(jets_pt, dtype=np.float64)
+        selected = np.ones(len(jets_pt), dtype=bool) if alive is None else np.asarray(alive, dtype=bool)
+        for pt in jets_pt[selected & ~(jets_pt > 0.)]:
+            print("WARNING: jet pT = %1.1f !!" % pt)
+        positive = selected & (jets_pt > 0.)
+        nRandom = int(np.count_nonzero(positive))
+        u = np.zeros(len(jets_pt))
+        if nRandom:
+            randoms = np.empty(nRandom)
+            self.rnd.RndmArray(nRandom, randoms)
+            u[positive] = randoms
+        hasGenJet = ~np.isnan(genJets_pt)
+
+        jets_pt_smeared = []
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for enum_central_or_shift in [ 0, 2, 1 ]: # nominal, up, down (cf. getSmearedJetPt)
+                jet_pt_sf = self.jerSFTable.getScaleFactor(jets_eta, enum_central_or_shift)
+                smearFactor = np.where(hasGenJet, 1. + (jet_pt_sf - 1.)*(jets_pt - genJets_pt)/jets_pt,
+                                       np.where(jet_pt_sf > 1., 1. + u, 1.))
+                smearFactor = np.where(smearFactor*jets_pt < 1.e-2, 1.e-2/jets_pt, smearFactor)
+                jets_pt_smeared.append(np.where(positive, smearFactor*jets_pt, jets_pt))
+
+        return tuple(jets_pt_smeared)
@@ -0,0 +1,75 @@
+import numpy as np
+
+#--------------------------------------------------------------------------------------------
+# Readers for the txt files of JES uncertainties and JER scale factors, evaluating them on NumPy arrays of jets.
+# They follow the conventions of CondFormats/JetMETObjects (JetCorrectorParameters, SimpleJetCorrectionUncertainty
+# and JetResolutionObject), so that they give the same values as the ROOT wrappers used in the per-event code.
+#--------------------------------------------------------------------------------------------
+
+def _readTextTableLines(fileName, section=None):
+    """Return the definition line and the lines of values of a txt file, or of one [section] of it"""
+    definition = None; lines = []
+    inSection = (section == None)
+    for line in open(fileName):
+        line = line.strip()
+        if not line or line[0] == "#": continue
+        if line[0] == "[":
+            if definition != None and inSection and section != None: break
+            inSection = (section == None or line[1:line.index("]")] == section)
+            continue
+        if not inSection: continue
+        if line[0] == "{":
+            definition = line
+        else:
+            lines.append([ float(x) for x in line.split() ])
+    if definition == None:
+        raise ValueError("No table %sfound in file '%s'" % ("" if section == None else ("for section '%s' " % section), fileName))
+    return definition, lines
+
+class JESUncertaintyTable(object):
+    """JES uncertainties in bins of eta ([etaMin, etaMax) as in JetCorrectorParameters), linearly interpolated in pT within each bin"""
+    def __init__(self, fileName, section=None):
+        definition, lines = _readTextTableLines(fileName, section)
+        if definition.split()[1:4] != [ "JetEta", "1", "JetPt" ]:
+            raise ValueError("Unsupported JES uncertainty table '%s' in file '%s'" % (definition, fileName))
+        self.etaMin = np.array([ l[0] for l in lines ], dtype=np.float32)
+        self.etaMax = np.array([ l[1] for l in lines ], dtype=np.float32)
+        if np.any(np.diff(self.etaMin) < 0):
+            raise ValueError("JES uncertainty bins in file '%s' are not sorted in eta" % fileName)
+        # each bin has a list of (pT, up, down) triplets; values are stored as floats in the C++ implementation
+        self.points = [ np.array(l[3:3+int(l[2])], dtype=np.float32).reshape(-1, 3).astype(np.float64) for l in lines ]
+
+    def getUncertainty(self, eta, pt, up=True):
+        """Return the uncertainty for each jet, or -999 for jets outside the eta bins"""
+        eta = np.asarray(eta, dtype=np.float32)
+        pt = np.asarray(pt, dtype=np.float32).astype(np.float64)
+        ret = np.full(len(pt), -999.)
+        bins = np.searchsorted(self.etaMin, eta, side='right')-1
+        inside = (bins >= 0)
+        inside[inside] = (eta[inside] < self.etaMax[bins[inside]])
+        bins[~inside] = -1
+        column = 1 if up else 2
+        for b in np.unique(bins[inside]):
+            sel = (bins == b)
+            points = self.points[b]
+            # np.interp clamps to the values at the first and last points, as SimpleJetCorrectionUncertainty does
+            ret[sel] = np.interp(pt[sel], points[:,0], points[:,column])
+        return ret
+
+class JERScaleFactorTable(object):
+    """JER scale factors (nominal, down, up) in bins of eta ([etaMin, etaMax], the first matching bin is used, as in JetResolutionObject)"""
+    def __init__(self, fileName):
+        definition, lines = _readTextTableLines(fileName)
+        if definition.split()[1:3] != [ "JetEta", "0" ]:
+            raise ValueError("Unsupported JER scale factor table '%s' in file '%s'" % (definition, fileName))
+        self.etaMin = np.array([ l[0] for l in lines ], dtype=np.float32)
+        self.etaMax = np.array([ l[1] for l in lines ], dtype=np.float32)
+        self.values = np.array([ l[3:6] for l in lines ], dtype=np.float32).astype(np.float64)
+
+    def getScaleFactor(self, eta, variation):
+        """Return the scale factor for each jet, variation being 0 (nominal), 1 (down) or 2 (up); 1 outside the eta bins"""
+        eta = np.asarray(eta, dtype=np.float32)
+        ret = np.ones(len(eta))
+        for i in reversed(xrange(len(self.etaMin))):
+            ret[(eta >= self.etaMin[i]) & (eta <= self.etaMax[i])] = self.values[i, variation]
+        return ret
@@ -3,13 +3,14 @@ import math, os
 import numpy as np
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
-from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object, JaggedArray
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoAODTools.postprocessing.tools import matchObjectCollection
 from PhysicsTools.NanoAODTools.postprocessing.modules.jme.jetSmearer import jetSmearer
+from PhysicsTools.NanoAODTools.postprocessing.modules.jme.jetTextTables import JESUncertaintyTable
 
 class jetmetUncertaintiesProducer(Module):
-    def __init__(self, globalTag, jesUncertainties = [ "Total" ], jetType = "AK4PFchs"):
+    def __init__(self, globalTag, jesUncertainties = [ "Total" ], jetType = "AK4PFchs", crossCheck = False):
 
         #--------------------------------------------------------------------------------------------
         # CV: globalTag and jetType not yet used, as there is no consistent set of txt files for
@@ -33,13 +34,19 @@ class jetmetUncertaintiesProducer(Module):
         self.jesInputFilePath = os.environ['CMSSW_BASE'] + "/src/PhysicsTools/NanoAODTools/data/jme/"
         if len(jesUncertainties) == 1 and jesUncertainties[0] == "Total":
             self.jesUncertaintyInputFileName = "Summer16_23Sep2016V4_MC_Uncertainty_AK4PFchs.txt"
+            self.jesUncertaintySections = False
         else:
             self.jesUncertaintyInputFileName = "Summer16_23Sep2016V4_MC_UncertaintySources_AK4PFchs.txt"
+            self.jesUncertaintySections = True
 
         # define energy threshold below which jets are considered as "unclustered energy"
         # (cf. JetMETCorrections/Type1MET/python/correctionTermsPfMetType1Type2_cff.py )
         self.unclEnThreshold = 15.
 
+        # when processing chunks of events (analyzeBatch), compare the results with the per-event implementation
+        self.crossCheck = crossCheck
+        self.crossCheckTolerance = 1.e-4
+
         # load libraries for accessing JES scale factors and uncertainties from txt files
         for library in [ "libCondFormatsJetMETObjects", "libPhysicsToolsNanoAODTools" ]:
             if library not in ROOT.gSystem.GetLibraries():
@@ -48,8 +55,19 @@ class jetmetUncertaintiesProducer(Module):
 
     def beginJob(self):
 
-        print("Loading jet energy scale (JES) uncertainties from file '%s'" % os.path.join(self.jesInputFilePath, self.jesUncertaintyInputFileName))
-        self.jesUncertainty = ROOT.JetCorrectionUncertainty(os.path.join(self.jesInputFilePath, self.jesUncertaintyInputFileName))
+        jesUncertaintyInputFile = os.path.join(self.jesInputFilePath, self.jesUncertaintyInputFileName)
+        print("Loading jet energy scale (JES) uncertainties from file '%s'" % jesUncertaintyInputFile)
+        self.jesUncertainty = {}
+        self.jesUncertaintyTables = {}
+        if not self.jesUncertaintySections:
+            self.jesUncertainty["Total"] = ROOT.JetCorrectionUncertainty(jesUncertaintyInputFile)
+            self.jesUncertaintyTables["Total"] = JESUncertaintyTable(jesUncertaintyInputFile)
+        else:
+            # the file of uncertainty sources has one section per source. N.B. before the sources were vectorised, a single
+            # JetCorrectionUncertainty built from the whole file was used for all of them, i.e. the same uncertainty for every source
+            for jesUncertainty in self.jesUncertainties:
+                self.jesUncertainty[jesUncertainty] = ROOT.JetCorrectionUncertainty(ROOT.JetCorrectorParameters(jesUncertaintyInputFile, jesUncertainty))
+                self.jesUncertaintyTables[jesUncertainty] = JESUncertaintyTable(jesUncertaintyInputFile, jesUncertainty)
 
         self.jetSmearer.beginJob()
 
@@ -58,6 +76,10 @@ class jetmetUncertaintiesProducer(Module):
         self.jetSmearer.endJob()
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        inputTree.declareInputs([ "n%s" % self.jetBranchName ] + [ "%s_%s" % (self.jetBranchName, var) for var in ("pt", "eta", "phi") ] +
+                                [ "n%s" % self.genJetBranchName ] + [ "%s_%s" % (self.genJetBranchName, var) for var in ("pt", "eta", "phi") ] +
+                                [ "%s_%s" % (self.metBranchName, var) for var in ("pt", "phi", "MetUnclustEnUpDeltaX", "MetUnclustEnUpDeltaY") ] +
+                                [ self.rhoBranchName ])
         self.out = wrappedOutputTree
         self.out.branch("%s_pt_smeared" % self.jetBranchName, "F", lenVar="nJet")
         self.out.branch("%s_pt_smeared" % self.metBranchName, "F")
@@ -78,6 +100,12 @@ class jetmetUncertaintiesProducer(Module):
     
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
+        for name, value in self._compute(event).iteritems():
+            self.out.fillBranch(name, value)
+        return True
+
+    def _compute(self, event):
+        """compute the output branches for one event, returned as a dictionary of branch name -> value"""
         jets = Collection(event, self.jetBranchName )
         genJets = Collection(event, self.genJetBranchName )
 
@@ -130,9 +158,9 @@ class jetmetUncertaintiesProducer(Module):
             jet_pt_jesDown = {}
             for jesUncertainty in self.jesUncertainties:
                 # (cf. https://twiki.cern.ch/twiki/bin/view/CMSPublic/WorkBookJetEnergyCorrections#JetCorUncertainties )
-                self.jesUncertainty.setJetPt(jet_pt_ref)
-                self.jesUncertainty.setJetEta(jet.eta)
-                delta = self.jesUncertainty.getUncertainty(True)
+                self.jesUncertainty[jesUncertainty].setJetPt(jet_pt_ref)
+                self.jesUncertainty[jesUncertainty].setJetEta(jet.eta)
+                delta = self.jesUncertainty[jesUncertainty].getUncertainty(True)
                 jet_pt_jesUp[jesUncertainty]   = jet_pt_ref*(1. + delta)
                 jet_pt_jesDown[jesUncertainty] = jet_pt_ref*(1. - delta)
                 jets_pt_jesUp[jesUncertainty].append(jet_pt_jesUp[jesUncertainty])
@@ -181,28 +209,141 @@ class jetmetUncertaintiesProducer(Module):
             met_px_unclEnDown  = met_px_unclEnDown + (met_px_smeared - met_px)
             met_py_unclEnDown  = met_py_unclEnDown + (met_py_smeared - met_py)
 
-        self.out.fillBranch("%s_pt_smeared" % self.jetBranchName, jets_pt_smeared)
-        self.out.fillBranch("%s_pt_smeared" % self.metBranchName, math.sqrt(met_px_smeared**2 + met_py_smeared**2))
-        self.out.fillBranch("%s_phi_smeared" % self.metBranchName, math.atan2(met_py_smeared, met_px_smeared))
-        self.out.fillBranch("%s_pt_jerUp" % self.jetBranchName, jets_pt_jerUp)
-        self.out.fillBranch("%s_pt_jerUp" % self.metBranchName, math.sqrt(met_px_jerUp**2 + met_py_jerUp**2))
-        self.out.fillBranch("%s_phi_jerUp" % self.metBranchName, math.atan2(met_py_jerUp, met_px_jerUp))
-        self.out.fillBranch("%s_pt_jerDown" % self.jetBranchName, jets_pt_jerDown)
-        self.out.fillBranch("%s_pt_jerDown" % self.metBranchName, math.sqrt(met_px_jerDown**2 + met_py_jerDown**2))
-        self.out.fillBranch("%s_phi_jerDown" % self.metBranchName, math.atan2(met_py_jerDown, met_px_jerDown))
+        ret = {}
+        ret["%s_pt_smeared" % self.jetBranchName] = jets_pt_smeared
+        ret["%s_pt_smeared" % self.metBranchName] = math.sqrt(met_px_smeared**2 + met_py_smeared**2)
+        ret["%s_phi_smeared" % self.metBranchName] = math.atan2(met_py_smeared, met_px_smeared)
+        ret["%s_pt_jerUp" % self.jetBranchName] = jets_pt_jerUp
+        ret["%s_pt_jerUp" % self.metBranchName] = math.sqrt(met_px_jerUp**2 + met_py_jerUp**2)
+        ret["%s_phi_jerUp" % self.metBranchName] = math.atan2(met_py_jerUp, met_px_jerUp)
+        ret["%s_pt_jerDown" % self.jetBranchName] = jets_pt_jerDown
+        ret["%s_pt_jerDown" % self.metBranchName] = math.sqrt(met_px_jerDown**2 + met_py_jerDown**2)
+        ret["%s_phi_jerDown" % self.metBranchName] = math.atan2(met_py_jerDown, met_px_jerDown)
         for jesUncertainty in self.jesUncertainties:
-            self.out.fillBranch("%s_pt_jes%sUp" % (self.jetBranchName, jesUncertainty), jets_pt_jesUp[jesUncertainty])
-            self.out.fillBranch("%s_pt_jes%sUp" % (self.metBranchName, jesUncertainty), math.sqrt(met_px_jesUp[jesUncertainty]**2 + met_py_jesUp[jesUncertainty]**2))
-            self.out.fillBranch("%s_phi_jes%sUp" % (self.metBranchName, jesUncertainty), math.atan2(met_py_jesUp[jesUncertainty], met_px_jesUp[jesUncertainty]))
-            self.out.fillBranch("%s_pt_jes%sDown" % (self.jetBranchName, jesUncertainty), jets_pt_jesDown[jesUncertainty])
-            self.out.fillBranch("%s_pt_jes%sDown" % (self.metBranchName, jesUncertainty), math.sqrt(met_px_jesDown[jesUncertainty]**2 + met_py_jesDown[jesUncertainty]**2))
-            self.out.fillBranch("%s_phi_jes%sDown" % (self.metBranchName, jesUncertainty), math.atan2(met_py_jesDown[jesUncertainty], met_px_jesDown[jesUncertainty]))
-        self.out.fillBranch("%s_pt_unclustEnUp" % self.metBranchName, math.sqrt(met_px_unclEnUp**2 + met_py_unclEnUp**2))
-        self.out.fillBranch("%s_phi_unclustEnUp" % self.metBranchName, math.atan2(met_py_unclEnUp, met_px_unclEnUp))
-        self.out.fillBranch("%s_pt_unclustEnDown" % self.metBranchName, math.sqrt(met_px_unclEnDown**2 + met_py_unclEnDown**2))
-        self.out.fillBranch("%s_phi_unclustEnDown" % self.metBranchName, math.atan2(met_py_unclEnDown, met_px_unclEnDown))
+            ret["%s_pt_jes%sUp" % (self.jetBranchName, jesUncertainty)] = jets_pt_jesUp[jesUncertainty]
+            ret["%s_pt_jes%sUp" % (self.metBranchName, jesUncertainty)] = math.sqrt(met_px_jesUp[jesUncertainty]**2 + met_py_jesUp[jesUncertainty]**2)
+            ret["%s_phi_jes%sUp" % (self.metBranchName, jesUncertainty)] = math.atan2(met_py_jesUp[jesUncertainty], met_px_jesUp[jesUncertainty])
+            ret["%s_pt_jes%sDown" % (self.jetBranchName, jesUncertainty)] = jets_pt_jesDown[jesUncertainty]
+            ret["%s_pt_jes%sDown" % (self.metBranchName, jesUncertainty)] = math.sqrt(met_px_jesDown[jesUncertainty]**2 + met_py_jesDown[jesUncertainty]**2)
+            ret["%s_phi_jes%sDown" % (self.metBranchName, jesUncertainty)] = math.atan2(met_py_jesDown[jesUncertainty], met_px_jesDown[jesUncertainty])
+        ret["%s_pt_unclustEnUp" % self.metBranchName] = math.sqrt(met_px_unclEnUp**2 + met_py_unclEnUp**2)
+        ret["%s_phi_unclustEnUp" % self.metBranchName] = math.atan2(met_py_unclEnUp, met_px_unclEnUp)
+        ret["%s_pt_unclustEnDown" % self.metBranchName] = math.sqrt(met_px_unclEnDown**2 + met_py_unclEnDown**2)
+        ret["%s_phi_unclustEnDown" % self.metBranchName] = math.atan2(met_py_unclEnDown, met_px_unclEnDown)
 
-        return True
+        return ret
+
+    def analyzeBatch(self, chunk):
+        """same as analyze, for all the events of a chunk at once"""
+        jetBranches = [ "%s_%s" % (self.jetBranchName, var) for var in ("pt", "eta", "phi") ]
+        genJetBranches = [ "%s_%s" % (self.genJetBranchName, var) for var in ("pt", "eta", "phi") ]
+        metBranches = [ "%s_%s" % (self.metBranchName, var) for var in ("pt", "phi", "MetUnclustEnUpDeltaX", "MetUnclustEnUpDeltaY") ]
+        # (rho is not needed, as the jet pT resolution does not enter the smearing factors, cf. jetSmearer.getSmearedJetPt)
+        chunk.load(jetBranches + genJetBranches + metBranches)
+        jets = chunk[jetBranches[0]]
+        ( jets_pt, jets_eta, jets_phi ) = [ chunk[name].content.astype(np.float64) for name in jetBranches ]
+        genJets = chunk[genJetBranches[0]]
+        ( genJets_pt, genJets_eta, genJets_phi ) = [ chunk[name].content.astype(np.float64) for name in genJetBranches ]
+        ( met_pt, met_phi, met_deltaPx_unclEn, met_deltaPy_unclEn ) = [ chunk[name].astype(np.float64) for name in metBranches ]
+        jets_event = jets.entryIndex()
+
+        if self.crossCheck:
+            # the per-event implementation must use the same random numbers
+            rnd = self.jetSmearer.rnd.Clone()
+
+        # match reconstructed jets to generator level ones, and evaluate JER scale factors and uncertainties
+        genJetIndex = _matchJets(jets_eta, jets_phi, jets.offsets, genJets_eta, genJets_phi, genJets.offsets)
+        genJets_pt_matched = np.where(genJetIndex >= 0, genJets_pt[np.maximum(genJetIndex, 0)] if len(genJets_pt) else np.nan, np.nan)
+        # random numbers are only drawn for the events not rejected by the previous modules, as in the per-event implementation
+        jets_alive = np.repeat(chunk.alive, jets.counts) if chunk.alive is not None else None
+        ( jets_pt_smeared, jets_pt_jerUp, jets_pt_jerDown ) = self.jetSmearer.getSmearedJetPtBatch(jets_pt, jets_eta, genJets_pt_matched, jets_alive)
+        if self.applyJERCorr:
+            jets_pt_ref     = jets_pt_smeared
+        else:
+            jets_pt_ref     = jets_pt
+            jets_pt_jerUp   = jets_pt_jerUp*jets_pt/jets_pt_smeared
+            jets_pt_jerDown = jets_pt_jerDown*jets_pt/jets_pt_smeared
+
+        # progate JER and JES corrections and uncertainties to MET, summing the shifts of the jets of each event
+        clustered = (jets_pt_ref > self.unclEnThreshold)
+        jets_cosPhi = np.where(clustered, np.cos(jets_phi), 0.)
+        jets_sinPhi = np.where(clustered, np.sin(jets_phi), 0.)
+        def metShift(jets_delta):
+            return ( -np.bincount(jets_event, weights=jets_delta*jets_cosPhi, minlength=len(chunk)),
+                     -np.bincount(jets_event, weights=jets_delta*jets_sinPhi, minlength=len(chunk)) )
+        ( met_px, met_py ) = ( met_pt*np.cos(met_phi), met_pt*np.sin(met_phi) )
+        ( met_dpx_smeared, met_dpy_smeared ) = metShift(jets_pt_smeared - jets_pt) if self.applyJERCorr else ( 0., 0. )
+
+        ret = {}
+        def fillMET(variation, jets_delta=None, met_dpx=0., met_dpy=0.):
+            if jets_delta is not None:
+                ( dpx, dpy ) = metShift(jets_delta)
+                ( met_dpx, met_dpy ) = ( met_dpx + dpx, met_dpy + dpy )
+            ( px, py ) = ( met_px + met_dpx + met_dpx_smeared, met_py + met_dpy + met_dpy_smeared )
+            ret["%s_pt_%s" % (self.metBranchName, variation)] = np.sqrt(px**2 + py**2).astype(np.float32)
+            ret["%s_phi_%s" % (self.metBranchName, variation)] = np.arctan2(py, px).astype(np.float32)
+        def fillJets(variation, jets_pt_variation):
+            ret["%s_pt_%s" % (self.jetBranchName, variation)] = JaggedArray(jets_pt_variation.astype(np.float32), jets.offsets)
+
+        fillJets("smeared", jets_pt_smeared)
+        fillMET("smeared")
+        fillJets("jerUp", jets_pt_jerUp)
+        fillMET("jerUp", jets_pt_jerUp - jets_pt_ref)
+        fillJets("jerDown", jets_pt_jerDown)
+        fillMET("jerDown", jets_pt_jerDown - jets_pt_ref)
+        for jesUncertainty in self.jesUncertainties:
+            # (cf. https://twiki.cern.ch/twiki/bin/view/CMSPublic/WorkBookJetEnergyCorrections#JetCorUncertainties )
+            delta = self.jesUncertaintyTables[jesUncertainty].getUncertainty(jets_eta, jets_pt_ref, True)
+            for shift, sign in ( "Up", 1. ), ( "Down", -1. ):
+                jets_pt_jes = jets_pt_ref*(1. + sign*delta)
+                fillJets("jes%s%s" % (jesUncertainty, shift), jets_pt_jes)
+                fillMET("jes%s%s" % (jesUncertainty, shift), jets_pt_jes - jets_pt_ref)
+        # propagate "unclustered energy" uncertainty to MET
+        fillMET("unclustEnUp", met_dpx=met_deltaPx_unclEn, met_dpy=met_deltaPy_unclEn)
+        fillMET("unclustEnDown", met_dpx=-met_deltaPx_unclEn, met_dpy=-met_deltaPy_unclEn)
+
+        if self.crossCheck:
+            self._crossCheck(chunk, ret, rnd)
+        return None, ret
+
+    def _crossCheck(self, chunk, columns, rnd):
+        """compare the results of analyzeBatch with the ones of the per-event implementation"""
+        batchRnd = self.jetSmearer.rnd
+        self.jetSmearer.rnd = rnd
+        try:
+            for i in (np.flatnonzero(chunk.alive).tolist() if chunk.alive is not None else xrange(len(chunk))):
+                for name, value in self._compute(chunk.event(i)).iteritems():
+                    expected = np.asarray(value, dtype=np.float32)
+                    found = np.asarray(columns[name][i], dtype=np.float32)
+                    if expected.shape != found.shape or not np.allclose(found, expected, rtol=self.crossCheckTolerance, atol=self.crossCheckTolerance):
+                        raise RuntimeError("Mismatch in %s for entry %d: %s (batch) vs %s (per event)" % (name, chunk.start+i, found, expected))
+        finally:
+            self.jetSmearer.rnd = batchRnd
+
+def _matchJets(jets_eta, jets_phi, jets_offsets, genJets_eta, genJets_phi, genJets_offsets, dRmax=0.4):
+    """Return for each jet the index of the closest generator level jet in the same event (the first one in case of ties)
+       if it is within dRmax, or -1, as matchObjectCollection does"""
+    nJets = np.diff(jets_offsets)
+    nGenJets = np.diff(genJets_offsets)
+    jets_event = np.repeat(np.arange(len(nJets)), nJets)
+    # all (jet, generator level jet) pairs in each event, ordered by jet and then by generator level jet
+    nPairs = nGenJets[jets_event]
+    pairs_jet = np.repeat(np.arange(len(jets_eta)), nPairs)
+    pairs_first = np.cumsum(nPairs) - nPairs
+    pairs_genJet = genJets_offsets[jets_event[pairs_jet]] + np.arange(len(pairs_jet)) - pairs_first[pairs_jet]
+    dPhi = jets_phi[pairs_jet] - genJets_phi[pairs_genJet]
+    dPhi = (dPhi + math.pi) % (2*math.pi) - math.pi
+    dR = np.hypot(jets_eta[pairs_jet] - genJets_eta[pairs_genJet], dPhi)
+    ret = np.full(len(jets_eta), -1, dtype=np.int64)
+    withPairs = np.flatnonzero(nPairs > 0)
+    if len(withPairs):
+        dRmin = np.fmin.reduceat(dR, pairs_first[withPairs])
+        closest = np.flatnonzero(dR == np.repeat(dRmin, nPairs[withPairs]))
+        ( jetsWithMin, first ) = np.unique(pairs_jet[closest], return_index=True)
+        closest = closest[first]
+        matched = (dR[closest] < dRmax)
+        ret[jetsWithMin[matched]] = pairs_genJet[closest[matched]]
+    return ret
 
 jesUncertaintySources = [
     "AbsoluteStat",
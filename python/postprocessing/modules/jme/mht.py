@@ -15,6 +15,7 @@ class mhtProducer(Module):
     def endJob(self):
         pass
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        inputTree.declareInputs(["nElectron", "Electron_*", "nMuon", "Muon_*", "nJet", "Jet_*"]) # the selections can use any variable
         self.out = wrappedOutputTree
         self.out.branch("MHT_pt",  "F");
         self.out.branch("MHT_phi", "F");
@@ -1,75 +1,153 @@
 #!/bin/env python
-import ROOT
-from array import array
+import os
 import sys
+import multiprocessing
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
 
-if len(sys.argv) < 3 :
-	print "Syntax: haddnano.py out.root input1.root input2.root ..."
-ofname=sys.argv[1]
-files=sys.argv[2:]
+# back-filling of the branches missing in some of the inputs, with default (zero) values, in a single C++ call per branch
+_zeroFillCode = """
+#include <TTree.h>
+#include <TBranch.h>
+#include <string>
+void haddnanoZeroFill(TTree * tree, const char * name, const char * type) {
+  Long64_t value = 0; // large enough for any type of single value
+  TBranch * b = tree->Branch(name, &value, (std::string(name) + "/" + type).c_str());
+  for (Long64_t i = 0, n = tree->GetEntries(); i < n; ++i) b->Fill();
+  b->ResetAddress();
+}
+"""
+_zeroFillDeclared = False
+
+_rootLeafType2rootBranchType = { 'UChar_t':'b', 'Char_t':'B', 'UInt_t':'i', 'Int_t':'I', 'Float_t':'F', 'Double_t':'D', 'ULong64_t':'l', 'Long64_t':'L', 'Bool_t':'O' }
 
 def zeroFill(tree,brName,brObj) :
-	if brObj.GetLeaf(brName).GetTypeName() != "Bool_t" :
-		print "Did not expect to back fill non-boolean branches",tree,brName,brObj.GetLeaf(br).GetTypeName()
-	else :
-		buff=array('B',[0])
-		b=tree.Branch(brName,buff,brName+"/O")
-		for x in xrange(0,tree.GetEntries()):	
-			b.Fill()
-		b.ResetAddress()
-fileHandles=[]
-goFast=True
-for fn in files :
-    print "Adding file",fn
-    fileHandles.append(ROOT.TFile.Open(fn))
-    if fileHandles[-1].GetCompressionSettings() != fileHandles[0].GetCompressionSettings() :
-	goFast=False
-	print "Disabling fast merging as inputs have different compressions"
-of=ROOT.TFile(ofname,"recreate")
-if goFast :
-	of.SetCompressionSettings(fileHandles[0].GetCompressionSettings())
-of.cd()
+    global _zeroFillDeclared
+    leaf = brObj.GetLeaf(brName)
+    if leaf.GetTypeName() not in _rootLeafType2rootBranchType or bool(leaf.GetLeafCount()) or leaf.GetLen() != 1 :
+        print "Can't back fill the branch",brName,"of type",leaf.GetTypeName(),"in",tree.GetName()
+        return
+    if not _zeroFillDeclared :
+        ROOT.gInterpreter.Declare(_zeroFillCode)
+        _zeroFillDeclared = True
+    ROOT.haddnanoZeroFill(tree,brName,_rootLeafType2rootBranchType[leaf.GetTypeName()])
+
+def mergeFiles(ofname, files, compression=None, fast=True) :
+    """Merge files into ofname, opening them one at a time after the first one.
+
+       compression are the compression settings of the output file (None for the default of ROOT);
+       trees are merged with fast cloning if fast is True, which requires all the inputs to have these settings."""
+    print "Merging %d files into %s" % (len(files), ofname)
+    first=ROOT.TFile.Open(files[0])
+    of=ROOT.TFile(ofname,"recreate")
+    if compression != None :
+        of.SetCompressionSettings(compression)
+    of.cd()
+    outputs=[]
+    for e in first.GetListOfKeys() :
+        obj=e.ReadObj()
+        if obj.IsA().InheritsFrom(ROOT.TTree.Class()) :
+            of.cd()
+            obj=obj.CloneTree(-1,"fast" if fast else "")
+        outputs.append((e.GetName(),obj))
+    for fn in files[1:] :
+        fh=ROOT.TFile.Open(fn)
+        for name,obj in outputs :
+            key=fh.GetListOfKeys().FindObject(name)
+            if not key :
+                print "Object",name,"is missing in",fn
+                continue
+            otherObj=key.ReadObj()
+            inputs=ROOT.TList()
+            inputs.Add(otherObj)
+            if obj.IsA().InheritsFrom(ROOT.TTree.Class()) :
+                if name=='Events' :
+                    otherObj.SetAutoFlush(0)
+                    branchNames=set([x.GetName() for x in obj.GetListOfBranches()])
+                    otherBranches=set([ x.GetName() for x in otherObj.GetListOfBranches() ])
+                    missingBranches=sorted(branchNames-otherBranches)
+                    additionalBranches=sorted(otherBranches-branchNames)
+                    if missingBranches or additionalBranches :
+                        print "missing:",missingBranches,"\n Additional:",additionalBranches
+                    for br in missingBranches :
+                        #fill "Other"
+                        zeroFill(otherObj,br,obj.GetListOfBranches().FindObject(br))
+                    for br in additionalBranches :
+                        #fill main
+                        zeroFill(obj,br,otherObj.GetListOfBranches().FindObject(br))
+                of.cd()
+                obj.Merge(inputs,"fast" if fast else "")
+            elif obj.IsA().InheritsFrom(ROOT.TH1.Class()) :
+                obj.Merge(inputs)
+            elif obj.IsA().InheritsFrom(ROOT.TObjString.Class()) :
+                if otherObj.GetString()!=obj.GetString():
+                    print "Strings are not matching"
+        fh.Close()
+    of.cd()
+    for name,obj in outputs :
+        if obj.IsA().InheritsFrom(ROOT.TTree.Class()) or obj.IsA().InheritsFrom(ROOT.TH1.Class()) or obj.IsA().InheritsFrom(ROOT.TObjString.Class()) :
+            obj.Write(name)
+        else:
+            print "Cannot handle ", obj.IsA().GetName()
+    of.Close()
+    first.Close()
+
+def _mergeTask(args) :
+    mergeFiles(*args)
+    return args[0]
+
+def haddnano(ofname, files, fanIn=50, nJobs=1, tmpDir=None) :
+    """Merge files into ofname, in a tree of merges of at most fanIn files each.
+
+       The merges of each level are independent, and are run in nJobs processes. Fast merging is used
+       if all the inputs have the same compression settings, which are then kept for the intermediate and final outputs."""
+    compression=None
+    for fn in files :
+        fh=ROOT.TFile.Open(fn)
+        if not fh : raise RuntimeError("Can't open %s" % fn)
+        settings=fh.GetCompressionSettings()
+        fh.Close()
+        if compression == None :
+            compression=settings
+        elif settings != compression :
+            print "Disabling fast merging as inputs have different compressions"
+            compression=None
+            break
+    fast=(compression != None)
+    if tmpDir == None : tmpDir=os.path.dirname(os.path.abspath(ofname))
+    fanIn=max(fanIn,2)
+    pool=multiprocessing.Pool(nJobs) if nJobs > 1 else None
+    level=0
+    try :
+        while True :
+            batches=[ files[i:i+fanIn] for i in xrange(0,len(files),fanIn) ]
+            if len(batches) == 1 :
+                mergeFiles(ofname,batches[0],compression,fast)
+                outputs=[ ofname ]
+            else :
+                tasks=[ (os.path.join(tmpDir,"%s_haddnano_%d_%d_%d.root" % (os.path.basename(ofname).replace(".root",""),os.getpid(),level,i)),batch,compression,fast) for i,batch in enumerate(batches) ]
+                outputs=pool.map(_mergeTask,tasks) if pool else map(_mergeTask,tasks)
+            if level > 0 :
+                for fn in files : os.remove(fn) # intermediate outputs of the previous level
+            if len(batches) == 1 : break
+            # once all the inputs have been merged with the same settings, fast merging can be used
+            files=outputs; level+=1
+            if compression == None :
+                fh=ROOT.TFile.Open(files[0])
+                compression=fh.GetCompressionSettings()
+                fh.Close()
+                fast=True
+    finally :
+        if pool : pool.close()
 
-for e in fileHandles[0].GetListOfKeys() :
-	name=e.GetName()
-	print "Merging" ,name
-	obj=e.ReadObj()
-	cl=ROOT.TClass.GetClass(e.GetClassName())
-	inputs=ROOT.TList()
-	isTree= obj.IsA().InheritsFrom(ROOT.TTree.Class())
-	if isTree :
-		obj=obj.CloneTree(-1,"fast" if goFast else "")
-		branchNames=set([x.GetName() for x in obj.GetListOfBranches()])
-	for fh in fileHandles[1:] :
-		otherObj=fh.GetListOfKeys().FindObject(name).ReadObj()
-		inputs.Add(otherObj)
-		if isTree and obj.GetName()=='Events'  :	
-			otherObj.SetAutoFlush(0)
-			otherBranches=set([ x.GetName() for x in otherObj.GetListOfBranches() ])
-			missingBranches=list(branchNames-otherBranches)
-			additionalBranches=list(otherBranches-branchNames)
-			print "missing:",missingBranches,"\n Additional:",additionalBranches
-			for br in missingBranches :
-				#fill "Other"	
-				zeroFill(otherObj,br,obj.GetListOfBranches().FindObject(br))
-			for br in additionalBranches :
-				#fill main	
-				branchNames.add(br)
-				zeroFill(obj,br,otherObj.GetListOfBranches().FindObject(br))
-			#merge immediately for trees
-	        	obj.Merge(inputs,"fast" if goFast else "")
-			inputs.Clear()
-	
-        if isTree  :
-		obj.Write()	
-	elif obj.IsA().InheritsFrom(ROOT.TH1.Class()) :		
-		obj.Merge(inputs)
-		obj.Write()
-	elif obj.IsA().InheritsFrom(ROOT.TObjString.Class()) :	
-		for st in inputs:
-		 	if  st.GetString()!=obj.GetString():
-				print "Strings are not matching"
-		obj.Write()
-	else:
-		print "Cannot handle ", obj.IsA().GetName()
-	
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] out.root input1.root input2.root ...")
+    parser.add_option("-n", "--fan-in", dest="fanIn", type="int", default=50, help="Maximum number of files merged at once; more inputs are merged in several steps (default: %default)")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1, help="Number of processes used to run the merges of each step in parallel (default: %default)")
+    parser.add_option("-t", "--tmpdir", dest="tmpDir", type="string", default=None, help="Directory for the intermediate merged files (default: the directory of the output file)")
+    (options, args) = parser.parse_args()
+    if len(args) < 2 :
+        parser.print_help()
+        sys.exit(1)
+    haddnano(args[0], args[1:], fanIn=options.fanIn, nJobs=options.jobs, tmpDir=options.tmpDir)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Write the Events tree of a NanoAOD file with several compression settings,
+# and compare the output size, the write time and the time to read back each group of branches
+import os, sys, time, json
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.framework.compression import compressionSettings
+
+def branchGroups(tree):
+    """Group the branches by collection, i.e. by the prefix before the first '_' (nX counters go with collection X)"""
+    names = [ b.GetName() for b in tree.GetListOfBranches() ]
+    prefixes = set(name.split("_")[0] for name in names if "_" in name)
+    groups = {}
+    for name in names:
+        group = name.split("_")[0]
+        if "_" not in name and name[0] == "n" and name[1:] in prefixes: group = name[1:]
+        groups.setdefault(group, []).append(name)
+    return groups
+
+def writeTree(inputFile, outputFile, compression, maxEntries):
+    """Copy the Events tree (recompressing the baskets) and return the wall time spent"""
+    inFile = ROOT.TFile.Open(inputFile)
+    inTree = inFile.Get("Events")
+    outFile = ROOT.TFile.Open(outputFile, "RECREATE", "", compressionSettings(compression))
+    t0 = time.time()
+    outTree = inTree.CloneTree(maxEntries if maxEntries > 0 else -1)
+    outFile.cd()
+    outTree.Write()
+    outFile.Close()
+    wall = time.time()-t0
+    inFile.Close()
+    return wall
+
+def readGroups(fileName):
+    """Return the total compressed size and the wall time needed to read all the entries of each group of branches"""
+    tfile = ROOT.TFile.Open(fileName)
+    tree = tfile.Get("Events")
+    ret = {}
+    for group, branches in sorted(branchGroups(tree).iteritems()):
+        size = sum(tree.GetBranch(b).GetZipBytes("*") for b in branches)
+        tree.SetBranchStatus("*", 0)
+        for b in branches: tree.SetBranchStatus(b, 1)
+        t0 = time.time()
+        for i in xrange(tree.GetEntries()):
+            tree.GetEntry(i)
+        ret[group] = { 'size':size, 'readTime':time.time()-t0 }
+    tfile.Close()
+    return ret
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] inputFile")
+    parser.add_option("-c", "--compressions", dest="compressions", type="string", default="LZMA:9,LZMA:4,ZLIB:6,ZLIB:1,LZ4:4,LZ4:1,ZSTD:5,ZSTD:1", help="Comma-separated list of (algo):(level) to test (default: %default)")
+    parser.add_option("-o", "--outdir", dest="outdir", type="string", default=".", help="Directory for the test output files (default: %default)")
+    parser.add_option("-n", "--max-entries", dest="maxEntries", type="int", default=-1, help="Number of entries to copy (default: all)")
+    parser.add_option("-g", "--groups", dest="groups", action="store_true", default=False, help="Also print the size and read time of each group of branches")
+    parser.add_option("--json", dest="json", type="string", default=None, help="Write the results to this JSON file")
+    parser.add_option("--keep", dest="keep", action="store_true", default=False, help="Keep the test output files")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    inputFile = args[0]
+
+    results = {}
+    for compression in options.compressions.split(","):
+        try:
+            compressionSettings(compression)
+        except RuntimeError, e:
+            print "Skipping %s: %s" % (compression, e)
+            continue
+        outputFile = os.path.join(options.outdir, "compression_%s.root" % compression.replace(":","_"))
+        writeTime = writeTree(inputFile, outputFile, compression, options.maxEntries)
+        fileGroups = readGroups(outputFile)
+        results[compression] = { 'fileSize':os.path.getsize(outputFile), 'writeTime':writeTime,
+                                 'readTime':sum(g['readTime'] for g in fileGroups.itervalues()), 'groups':fileGroups }
+        print "%-10s size %10.2f MB, write time %8.2f s, read time %8.2f s" % (compression, results[compression]['fileSize']/1024./1024., writeTime, results[compression]['readTime'])
+        if not options.keep: os.remove(outputFile)
+
+    compressions = [ c for c in options.compressions.split(",") if c in results ]
+    print
+    print "%-10s %12s %12s %12s" % ("Algo:level", "Size [MB]", "Write [s]", "Read [s]")
+    for c in compressions:
+        r = results[c]
+        print "%-10s %12.2f %12.2f %12.2f" % (c, r['fileSize']/1024./1024., r['writeTime'], r['readTime'])
+    if options.groups and compressions:
+        groups = sorted(results[compressions[0]]['groups'].iterkeys())
+        print
+        print "%-25s" % "Size [kB] / read [s]" + "".join("%22s" % c for c in compressions)
+        for g in groups:
+            print "%-25s" % g + "".join("%12.1f /%8.3f" % (results[c]['groups'][g]['size']/1024., results[c]['groups'][g]['readTime']) for c in compressions)
+    if options.json:
+        json.dump(results, open(options.json, "w"), indent=1)
@@ -17,10 +17,35 @@ if __name__ == "__main__":
     parser.add_option("--noout",  dest="noOut", action="store_true",  default=False, help="Do not produce output, just run modules")
     parser.add_option("--justcount",   dest="justcount", default=False, action="store_true",  help="Just report the number of selected events") 
     parser.add_option("-I", "--import", dest="imports",  type="string", default=[], action="append", nargs=2, help="Import modules (python package, comma-separated list of ");
-    parser.add_option("-z", "--compression",  dest="compression", type="string", default=("LZMA:9"), help="Compression: none, or (algo):(level) ")
+    parser.add_option("-z", "--compression",  dest="compression", type="string", default=("LZMA:9"), help="Compression: none, or (algo):(level) with algo LZMA, ZLIB, LZ4 or ZSTD (if supported by ROOT) ")
+    parser.add_option("-j", "--jobs",  dest="jobs", type="int", default=1, help="Number of worker processes used to process the input files in parallel (default: %default)")
+    parser.add_option("-t", "--threads",  dest="threads", type="int", default=1, help="Number of threads used by ROOT in each worker process to decompress the input and compress the output (default: %default)")
+    parser.add_option("--autoflush-entries",  dest="autoFlushEntries", type="int", default=None, help="Write the output tree in clusters of this number of entries")
+    parser.add_option("--autoflush-mb",  dest="autoFlushMB", type="float", default=None, help="Write the output tree in clusters of this size in MB (before compression)")
+    parser.add_option("--optimize-baskets",  dest="optimizeBaskets", action="store_true", default=False, help="Optimise the basket sizes of the output tree after writing the first cluster")
+    parser.add_option("--max-basket-memory",  dest="maxBasketMemory", type="float", default=None, help="Limit to this number of MB the memory used by the baskets of the output tree being filled")
+    parser.add_option("--entrylist-cache",  dest="entryListCache", type="string", default=None, help="Directory where the entry lists selected by the cut and JSON are cached, to skip the selection when processing again the same files")
+    parser.add_option("--entrylist-cache-size",  dest="entryListCacheSize", type="int", default=1000, help="Maximum size of the entry list cache in MB; the least recently used entries are removed (default: %default)")
+    parser.add_option("--branch-profile",  dest="branchProfile", type="string", default=None, help="Directory of the profiles of the branches read by modules that do not declare their inputs, learned in the first events of a job and used by the following ones")
+    parser.add_option("--branch-profile-events",  dest="branchProfileEvents", type="int", default=1000, help="Number of events used to learn the branches read by the modules (default: %default)")
+    parser.add_option("--timing",  dest="timing", action="store_true", default=False, help="Measure and print the time spent in each module, in reading the input and in filling the output")
+    parser.add_option("--timing-json",  dest="timingJSON", type="string", default=None, help="Write the timing information (implies --timing) to this JSON file")
+    parser.add_option("--hadd",  dest="haddFileName", type="string", default=None, help="Merge the output files into this file")
+    parser.add_option("--hadd-in-process",  dest="haddInProcess", action="store_true", default=False, help="With --hadd and without --friend, write the selected events of all the input files directly to the merged file, instead of merging the output files with haddnano.py")
+    parser.add_option("--prefetch",  dest="prefetch", action="store_true", default=False, help="Open the next input file, and read its first entries, in the background while the current one is processed")
+    parser.add_option("--prefetch-dir",  dest="prefetchDir", type="string", default=None, help="Copy the next remote input file to this directory in the background while the current one is processed (implies --prefetch)")
+    parser.add_option("--prefetch-entries",  dest="prefetchEntries", type="int", default=1000, help="Number of entries of the next input file read in the background with --prefetch (default: %default)")
+    parser.add_option("--cache-size",  dest="cacheSize", type="float", default=None, help="Size in MB of the TTreeCache of the input tree")
+    parser.add_option("--cache-learn-entries",  dest="cacheLearnEntries", type="int", default=None, help="Number of entries used by the TTreeCache to learn the branches that are read")
+    parser.add_option("--async-prefetch",  dest="asyncPrefetch", action="store_true", default=False, help="Fill the next block of the TTreeCache asynchronously while the current one is read")
+    parser.add_option("--preskim-rdf",  dest="preskimRDF", action="store_true", default=False, help="Select the entries passing the cut and JSON with a RDataFrame, using the threads given with --threads")
+    parser.add_option("--split-files",  dest="splitFiles", action="store_true", default=False, help="With more than one worker, also split each input file in ranges of entries processed in parallel, and merge the partial outputs")
 
     (options, args) = parser.parse_args()
 
+    if options.autoFlushEntries and options.autoFlushMB: raise RuntimeError("Can't give both --autoflush-entries and --autoflush-mb")
+    autoFlush = options.autoFlushEntries if options.autoFlushEntries else (-int(options.autoFlushMB*1024*1024) if options.autoFlushMB else None)
+
     if options.friend:
         if options.cut or options.json: raise RuntimeError("Can't apply JSON or cut selection when producing friends")
 
@@ -38,10 +63,18 @@ if __name__ == "__main__":
             if name[0] == "_": continue
             if name in selnames:
                 print "Loading %s from %s " % (name, mod)
-                modules.append(getattr(obj,name)())
+                # with several workers, each of them builds its own instances from the constructor
+                modules.append(getattr(obj,name) if options.jobs > 1 else getattr(obj,name)())
     if options.noOut:
         if len(modules) == 0: 
             raise RuntimeError("Running with --noout and no modules does nothing!")
-    p=PostProcessor(outdir,args,options.cut,options.branchsel,modules,options.compression,options.friend,options.postfix,options.json,options.noOut,options.justcount)
+    p=PostProcessor(outdir,args,options.cut,options.branchsel,modules,options.compression,options.friend,options.postfix,options.json,options.noOut,options.justcount,haddFileName=options.haddFileName,haddInProcess=options.haddInProcess,nWorkers=options.jobs,splitFiles=options.splitFiles,
+                  entryListCache=options.entryListCache,entryListCacheSize=options.entryListCacheSize,
+                  branchProfile=options.branchProfile,branchProfileEvents=options.branchProfileEvents,
+                  timing=options.timing,timingJSON=options.timingJSON,nThreads=options.threads,
+                  autoFlush=autoFlush,optimizeBaskets=options.optimizeBaskets,maxBasketMemory=options.maxBasketMemory,
+                  prefetch=options.prefetch,prefetchDir=options.prefetchDir,prefetchEntries=options.prefetchEntries,
+                  cacheSize=options.cacheSize,cacheLearnEntries=options.cacheLearnEntries,asyncPrefetch=options.asyncPrefetch,
+                  preskimRDF=options.preskimRDF)
     p.run()
 
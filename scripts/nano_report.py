@@ -1,53 +1,112 @@
 #!/usr/bin/env python
 # imported from https://github.com/CERN-PH-CMG/cmg-cmssw/blob/0c11a5a0a15c4c3e1a648c9707b06b08b747b0c0/PhysicsTools/Heppy/scripts/heppy_report.py
 from optparse import OptionParser
+import os
 import json
+import hashlib
+import multiprocessing
+import numpy as np
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
-def root2map(tree):
-    tree.SetBranchStatus("*",0)
-    tree.SetBranchStatus("run",1)
-    tree.SetBranchStatus("luminosityBlock",1)
-    jsonind = {}
-    for e in xrange(tree.GetEntries()):
-        tree.GetEntry(e)
-        run,lumi = tree.run, tree.luminosityBlock
-        if run not in jsonind:
-            jsonind[run] = [lumi]
-        else:
-            jsonind[run].append(lumi)
-    # remove duplicates
-    for run in jsonind:
-        jsonind[run] =  list(set(jsonind[run]))
-
-    nruns = len(jsonind)
-    nlumis = sum(len(v) for v in jsonind.itervalues())
+def runLumiKeys(tree):
+    """Return the sorted unique run<<32|luminosityBlock keys of the entries of a tree, reading the two columns at once"""
+    nEntries = tree.GetEntries()
+    if nEntries == 0: return np.empty(0, dtype=np.uint64)
+    tree.SetEstimate(nEntries+1)
+    if tree.Draw("run:luminosityBlock", "", "goff") < 0:
+        raise RuntimeError("Failed to read the run and luminosityBlock branches of %s" % tree.GetName())
+    nRows = tree.GetSelectedRows()
+    columns = []
+    for i in xrange(2):
+        val = tree.GetVal(i)
+        val.SetSize(nRows)
+        columns.append(np.frombuffer(val, dtype=np.float64, count=nRows).astype(np.uint64))
+    return np.unique((columns[0] << np.uint64(32)) | columns[1])
+
+def keys2map(keys):
+    """Convert sorted unique run<<32|lumi keys to a map of run to ranges of consecutive lumis, as in the CMS JSON files"""
+    runs = keys >> np.uint64(32)
+    lumis = keys & np.uint64(0xffffffff)
+    # a range ends where the run changes or the lumis are not consecutive
+    breaks = np.flatnonzero((np.diff(runs) != 0) | (np.diff(lumis) != 1)) + 1
+    starts = np.concatenate(([0], breaks)).astype(np.int64)
+    ends = np.concatenate((breaks, [len(keys)])).astype(np.int64) - 1
     jsonmap = {}
-    for r,lumis in jsonind.iteritems():
-        if len(lumis) == 0: continue # shouldn't happen
-        lumis.sort()
-        ranges = [ [ lumis[0], lumis[0] ] ]
-        for lumi in lumis[1:]:
-            if lumi == ranges[-1][1] + 1:
-                ranges[-1][1] = lumi
-            else:
-                ranges.append([lumi,lumi])
-        jsonmap[r] = ranges
-    return (jsonmap, nruns, nlumis)
+    for s,e in zip(starts, ends):
+        jsonmap.setdefault(int(runs[s]), []).append([ int(lumis[s]), int(lumis[e]) ])
+    return jsonmap
+
+def root2map(tree):
+    keys = runLumiKeys(tree)
+    jsonmap = keys2map(keys) if len(keys) else {}
+    return (jsonmap, len(jsonmap), len(keys))
+
+class SummaryCache:
+    """Run and lumi keys of each input file, saved as small .npy files in directory.
+
+       Local files are identified by their path, size and modification time; remote ones only by their name"""
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory): os.makedirs(directory)
+    def fileName(self, inputFile, treeName):
+        ident = [ inputFile, treeName ]
+        if os.path.exists(inputFile):
+            st = os.stat(inputFile)
+            ident = [ os.path.abspath(inputFile), treeName, st.st_size, int(st.st_mtime) ]
+        return os.path.join(self.directory, "lumis_%s.npy" % hashlib.sha1(repr(ident)).hexdigest())
+    def get(self, inputFile, treeName):
+        try:
+            return np.load(self.fileName(inputFile, treeName))
+        except (IOError, ValueError):
+            return None
+    def put(self, inputFile, treeName, keys):
+        fileName = self.fileName(inputFile, treeName)
+        tmpFileName = "%s.%d.tmp" % (fileName, os.getpid())
+        with open(tmpFileName, "wb") as cacheFile:
+            np.save(cacheFile, keys)
+        os.rename(tmpFileName, fileName)
+
+def fileKeys(args):
+    """Return the run and lumi keys of a file, from the cache if available"""
+    (inputFile, treeName, cacheDir) = args
+    cache = SummaryCache(cacheDir) if cacheDir else None
+    keys = cache.get(inputFile, treeName) if cache else None
+    if keys is None:
+        tfile = ROOT.TFile.Open(inputFile)
+        if not tfile or tfile.IsZombie(): raise RuntimeError("Can't open %s" % inputFile)
+        tree = tfile.Get(treeName)
+        if not tree: raise RuntimeError("No %s tree in %s" % (treeName, inputFile))
+        keys = runLumiKeys(tree)
+        tfile.Close()
+        if cache: cache.put(inputFile, treeName, keys)
+    return keys
+
+def files2map(inputFiles, treeName="LuminosityBlocks", nJobs=1, cacheDir=None):
+    """Summarise the runs and lumis of the input files, reading them in nJobs processes"""
+    tasks = [ (f, treeName, cacheDir) for f in inputFiles ]
+    if nJobs > 1:
+        pool = multiprocessing.Pool(nJobs)
+        allKeys = pool.map(fileKeys, tasks, chunksize=max(1, len(tasks)/(4*nJobs)))
+        pool.close()
+    else:
+        allKeys = map(fileKeys, tasks)
+    keys = np.unique(np.concatenate(allKeys)) if allKeys else np.empty(0, dtype=np.uint64)
+    jsonmap = keys2map(keys) if len(keys) else {}
+    return (jsonmap, len(jsonmap), len(keys))
 
 if __name__ == '__main__':
     parser = OptionParser(usage='%prog [options] nanoAOD-files',
                           description='Check the output of the LuminosityBlocks and produce a json file of the processed runs and lumisections')
     parser.add_option("-t", "--tree", dest="treeName", default="LuminosityBlocks", help="Name of the TTree with the luminosity blocks")
     parser.add_option("-o", "--out", dest="outputFile", default="lumiSummary.json", help="Name of the output file")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1, help="Number of processes used to read the input files in parallel (default: %default)")
+    parser.add_option("-c", "--cache", dest="cacheDir", default=None, help="Directory where the runs and lumis of each file are cached, so that only new or modified files are read again")
     (options,args) = parser.parse_args()
     if len(args)==0:
         print 'provide at least one input file in argument. Use -h to display help'
         exit()
-    chain = ROOT.TChain(options.treeName)
-    for a in args: chain.Add(a)
-    summary = root2map(chain)
+    summary = files2map(args, options.treeName, options.jobs, options.cacheDir)
     if summary:
         jmap, runs, lumis = summary
         json.dump(jmap,open(options.outputFile,'w'))
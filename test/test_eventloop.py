@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+import unittest
+import numpy as np
+import treeFactory
+from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import InputTree, JaggedArray
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
+from PhysicsTools.NanoAODTools.postprocessing.framework.output import OutputTree
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module, _analyzeChunk
+from PhysicsTools.NanoAODTools.postprocessing.tools import deltaPhi
+
+def makeTree(jets):
+    """In-memory Events tree with a branch x (the entry number) and the Jet_pt of each entry"""
+    return treeFactory.makeTree([ ("x", "F"), ("nJet", "I"), ("Jet_pt", "F", "nJet") ], [ { "x": i, "Jet_pt": pts } for i, pts in enumerate(jets) ])
+
+class eventProducer(Module):
+    """Per-event module producing a value and an array, and rejecting the entries with an odd x"""
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.out = wrappedOutputTree
+        self.out.branch("y", "F")
+        self.out.branch("Jet_y", "F", lenVar="nJet")
+    def analyze(self, event):
+        self.out.fillBranch("y", 2*event.x)
+        self.out.fillBranch("Jet_y", [ pt+event.x for pt in event.Jet_pt ])
+        return int(event.x) % 2 == 0
+
+class batchConsumer(Module):
+    """Batch module reading the outputs of eventProducer"""
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        wrappedOutputTree.branch("z", "F")
+        self.seen = {}
+    def analyzeBatch(self, chunk):
+        y, jetY = chunk["y"], chunk["Jet_y"]
+        self.seen = { 'y':np.array(y), 'counts':np.array(jetY.counts), 'content':np.array(jetY.content) }
+        return (None, { 'z': y + np.array([ jetY[i].sum() for i in xrange(len(jetY)) ]) })
+
+class batchProducer(Module):
+    """Batch module producing a value and an array"""
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        wrappedOutputTree.branch("w", "F")
+        wrappedOutputTree.branch("Jet_w", "F", lenVar="nJet")
+    def analyzeBatch(self, chunk):
+        jetPt = chunk["Jet_pt"]
+        return (None, { 'w': np.array(chunk["x"])*3, 'Jet_w': JaggedArray(jetPt.content*2, jetPt.offsets) })
+
+class eventConsumer(Module):
+    """Per-event module reading the outputs of batchProducer through the Event and the Objects"""
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.seen = []
+    def analyze(self, event):
+        jets = Collection(event, "Jet")
+        self.seen.append((event.w, list(event.Jet_w), [ j.w for j in jets ], deltaPhi(event.w, 0.)))
+        return True
+
+class TestMixedChunk(unittest.TestCase):
+    def testEventThenBatch(self):
+        jets = [ [ 10. ], [ 20., 30. ], [], [ 40., 50., 60. ] ]
+        inTree = InputTree(makeTree(jets))
+        outTree = inTree.CloneTree(0)
+        out = OutputTree(None, outTree, inTree)
+        modules = [ eventProducer(), batchConsumer() ]
+        for m in modules: m.beginFile(None, None, inTree, out)
+        accepted = _analyzeChunk(modules, inTree, out, 0, len(jets), True)
+        self.assertEqual(accepted, 2)
+        seen = modules[1].seen
+        # rejected entries (odd x) get default values
+        self.assertEqual(list(seen['y']), [ 0., 0., 4., 0. ])
+        self.assertEqual(list(seen['counts']), [ 1, 0, 0, 0 ])
+        self.assertEqual(list(seen['content']), [ 10. ])
+        self.assertEqual(outTree.GetEntries(), 2)
+        zs = []
+        for i in xrange(outTree.GetEntries()):
+            outTree.GetEntry(i)
+            zs.append(outTree.z)
+        self.assertEqual(zs, [ 10., 4. ])
+
+    def testBatchThenEvent(self):
+        jets = [ [ 10. ], [ 20., 30. ], [] ]
+        inTree = InputTree(makeTree(jets))
+        out = OutputTree(None, inTree.CloneTree(0), inTree)
+        modules = [ batchProducer(), eventConsumer() ]
+        for m in modules: m.beginFile(None, None, inTree, out)
+        _analyzeChunk(modules, inTree, out, 0, len(jets), True)
+        seen = modules[1].seen
+        self.assertEqual([ w for (w, jetW, objW, dphi) in seen ], [ 0., 3., 6. ])
+        self.assertEqual([ objW for (w, jetW, objW, dphi) in seen ], [ [ 20. ], [ 40., 60. ], [] ])
+        # the values are Python floats and lists, as the ones produced by per-event modules
+        for (w, jetW, objW, dphi) in seen:
+            self.assertEqual(type(w), float)
+            self.assertEqual(type(jetW), list)
+            for v in jetW + objW: self.assertEqual(type(v), float)
+
+if __name__ == "__main__":
+    unittest.main()
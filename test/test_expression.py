@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import unittest
+import numpy as np
+from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import JaggedArray
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Chunk
+from PhysicsTools.NanoAODTools.postprocessing.framework.expression import Expression, ExpressionError
+
+# four entries, with a jet without eta in the third one; the expected results are the ones of TTreeFormula
+_jetPt = [ [ 50., 20. ], [], [ 15., 40., 60. ], [ 35. ] ]
+_jetEta = [ [ 0.5, 3.0 ], [], [ 1.0, -2.0 ], [ 0.1 ] ]
+_columns = { 'nJet': [ 2, 0, 3, 1 ], 'MET_pt': [ 10., 0., 30., 5. ], 'Jet_pt': _jetPt, 'Jet_eta': _jetEta }
+
+def makeChunk():
+    chunk = Chunk(None, 0, 4)
+    chunk.addColumns({
+        'nJet': np.array(_columns['nJet'], dtype=np.int32),
+        'MET_pt': np.array(_columns['MET_pt'], dtype=np.float32),
+        'Jet_pt': JaggedArray.fromCounts(np.array(sum(_jetPt, []), dtype=np.float32), [ len(v) for v in _jetPt ]),
+        'Jet_eta': JaggedArray.fromCounts(np.array(sum(_jetEta, []), dtype=np.float32), [ len(v) for v in _jetEta ]),
+        })
+    return chunk
+
+class _Entry:
+    """The values of an entry, read as by Event.eval (lists for the arrays)"""
+    def __init__(self, i):
+        self._tree = self
+        self._i = i
+    def readColumn(self, name):
+        return _columns[name][self._i]
+
+class TestExpression(unittest.TestCase):
+    def assertSelects(self, text, expected):
+        self.assertEqual(list(Expression(text).select(makeChunk())), expected)
+    def assertValues(self, text, expected):
+        self.assertEqual(list(Expression(text).values(makeChunk())), expected)
+    def assertEvalEvent(self, text, expected):
+        found = [ Expression(text).evalEvent(_Entry(i)) for i in xrange(4) ]
+        self.assertEqual(found, expected)
+        for val in found: self.assertEqual(type(val), float) # as TTreeFormula::EvalInstance
+
+    def testArraySelection(self):
+        # an entry is selected if any instance passes
+        self.assertSelects("Jet_pt > 30", [ True, False, True, True ])
+    def testUnequalLengths(self):
+        # arrays are paired up to the shortest length: the third jet of the third entry has no eta, and is not considered
+        self.assertSelects("Jet_pt > 45 && abs(Jet_eta) < 2.4", [ True, False, False, False ])
+        self.assertSelects("Jet_pt > 45 && Jet_eta < 2", [ True, False, False, False ])
+    def testSingleValueAndArray(self):
+        self.assertSelects("Jet_pt > MET_pt*2", [ True, False, False, True ])
+    def testOutOfRangeIndex(self):
+        self.assertSelects("Jet_pt[2] > 10", [ False, False, True, False ])
+        self.assertSelects("Jet_pt[nJet-1] > 30", [ False, False, True, True ])
+        self.assertValues("Jet_pt[1]", [ 20., 0., 40., 0. ])
+        self.assertEvalEvent("Jet_pt[1]", [ 20., 0., 40., 0. ])
+    def testReductions(self):
+        self.assertValues("Sum$(Jet_pt > 30)", [ 1, 0, 2, 1 ])
+        self.assertValues("Sum$(Jet_pt)", [ 70., 0., 115., 35. ])
+        self.assertValues("Length$(Jet_pt)", [ 2, 0, 3, 1 ])
+        self.assertValues("Length$(Jet_pt[1])", [ 1, 0, 1, 0 ])
+    def testMaxMinOfEmpty(self):
+        # Max$ and Min$ of no values are 0
+        self.assertValues("Max$(Jet_pt)", [ 50., 0., 60., 35. ])
+        self.assertValues("Min$(Jet_pt)", [ 20., 0., 15., 35. ])
+        self.assertSelects("Max$(Jet_pt) < 1", [ False, True, False, False ])
+        self.assertEvalEvent("Max$(Jet_pt)", [ 50., 0., 60., 35. ])
+    def testDivisionByZero(self):
+        self.assertValues("MET_pt/nJet", [ 5., 0., 10., 5. ])
+        self.assertValues("nJet % 0", [ 0, 0, 0, 0 ])
+        self.assertEvalEvent("MET_pt/nJet", [ 5., 0., 10., 5. ])
+    def testPrecedence(self):
+        # && binds more tightly than ||
+        self.assertSelects("nJet == 0 || nJet >= 2 && MET_pt > 20", [ False, True, True, False ])
+        self.assertSelects("(nJet == 0 || nJet >= 2) && MET_pt > 20", [ False, False, True, False ])
+        self.assertValues("1 + 2*3 - 4/2", [ 5., 5., 5., 5. ])
+        self.assertSelects("!(nJet > 1) && MET_pt > 1", [ False, False, False, True ])
+    def testEvalEvent(self):
+        # the first instance of an array expression, or 0 if there is none
+        self.assertEvalEvent("Jet_pt", [ 50., 0., 15., 35. ])
+        self.assertEvalEvent("nJet*2", [ 4., 0., 6., 2. ])
+        self.assertEvalEvent("nJet", [ 2., 0., 3., 1. ])
+        self.assertEvalEvent("Jet_pt > 30 && abs(Jet_eta) < 2.4", [ 1., 0., 0., 1. ])
+    def testUnsupported(self):
+        for text in [ "Jet_pt[0][1]", "Iteration$", "foo(Jet_pt)", "Jet_pt >", "" ]:
+            self.assertRaises(ExpressionError, Expression, text)
+
+if __name__ == "__main__":
+    unittest.main()
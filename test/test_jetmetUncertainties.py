@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+import os
+import unittest
+import numpy as np
+import treeFactory
+from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import InputTree
+from PhysicsTools.NanoAODTools.postprocessing.framework.output import OutputTree
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module, _analyzeChunk
+
+def makeTree(nEvents=20, seed=1):
+    """In-memory Events tree with random jets, generator level jets (matched to some of the jets) and MET"""
+    rnd = np.random.RandomState(seed)
+    branches = [ ("nJet", "I"), ("nGenJet", "I") ]
+    for coll in "Jet", "GenJet":
+        branches += [ ("%s_%s" % (coll, var), "F", "n"+coll) for var in ("pt", "eta", "phi") ]
+    branches += [ ("MET_"+var, "F") for var in ("pt", "phi", "MetUnclustEnUpDeltaX", "MetUnclustEnUpDeltaY") ] + [ ("fixedGridRhoFastjetAll", "F") ]
+    entries = []
+    for i in xrange(nEvents):
+        nJet = rnd.randint(0, 6)
+        pt, eta, phi = rnd.uniform(10, 200, nJet), rnd.uniform(-4.7, 4.7, nJet), rnd.uniform(-np.pi, np.pi, nJet)
+        matched = rnd.uniform(size=nJet) < 0.5
+        entry = {}
+        for var, values in ("pt", pt), ("eta", eta), ("phi", phi):
+            entry["Jet_"+var] = values
+            entry["GenJet_"+var] = values[matched]*(rnd.uniform(0.8, 1.2, np.count_nonzero(matched)) if var == "pt" else 1.)
+        entry["MET_pt"] = rnd.uniform(0, 100)
+        entry["MET_phi"] = rnd.uniform(-np.pi, np.pi)
+        entry["MET_MetUnclustEnUpDeltaX"] = rnd.uniform(-5, 5)
+        entry["MET_MetUnclustEnUpDeltaY"] = rnd.uniform(-5, 5)
+        entry["fixedGridRhoFastjetAll"] = rnd.uniform(0, 30)
+        entries.append(entry)
+    return treeFactory.makeTree(branches, entries)
+
+class oddEventFilter(Module):
+    """Per-event module rejecting every other event, before the module under test"""
+    def analyze(self, event):
+        return event._entry % 2 == 0
+
+class perEventOnly(Module):
+    """The per-event implementation of a module that also has analyzeBatch"""
+    def __init__(self, module):
+        self.module = module
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.module.beginFile(inputFile, outputFile, inputTree, wrappedOutputTree)
+    def analyze(self, event):
+        return self.module.analyze(event)
+
+def runModules(modules, tree):
+    """Run the modules on all the entries of a tree, in a single chunk, and return the output values of the accepted events"""
+    inTree = InputTree(tree)
+    out = OutputTree(None, inTree.CloneTree(0), inTree)
+    for m in modules: m.beginFile(None, None, inTree, out)
+    _analyzeChunk(modules, inTree, out, 0, inTree.entries, True)
+    outTree = out.tree()
+    ret = []
+    for i in xrange(outTree.GetEntries()):
+        outTree.GetEntry(i)
+        ret.append(dict((name, np.array([ outTree.GetLeaf(name).GetValue(j) for j in xrange(outTree.GetLeaf(name).GetLen()) ]))
+                        for name in sorted(out._branches.iterkeys())))
+    return ret
+
+@unittest.skipUnless(os.environ.get('CMSSW_BASE'), "needs the JME text files and libraries of CMSSW")
+class TestJetmetUncertaintiesBatch(unittest.TestCase):
+    def testBatchSameAsPerEvent(self):
+        from PhysicsTools.NanoAODTools.postprocessing.modules.jme.jetmetUncertainties import jetmetUncertaintiesProducer
+        results = []
+        for batch in True, False:
+            module = jetmetUncertaintiesProducer("Summer16_23Sep2016V4_MC", [ "Total" ])
+            module.beginJob()
+            results.append(runModules([ oddEventFilter(), module if batch else perEventOnly(module) ], makeTree()))
+        (batchValues, eventValues) = results
+        self.assertEqual(len(batchValues), 10)
+        self.assertEqual(len(batchValues), len(eventValues))
+        for i, (found, expected) in enumerate(zip(batchValues, eventValues)):
+            self.assertEqual(sorted(found.iterkeys()), sorted(expected.iterkeys()))
+            for name in expected:
+                self.assertTrue(np.allclose(found[name], expected[name], rtol=1e-4, atol=1e-4),
+                                "%s of event %d: %s (batch) vs %s (per event)" % (name, i, found[name], expected[name]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from array import array
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.modules.common.lepSFProducer import LeptonSFMaps
+
+_helpers = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python", "postprocessing", "helpers")
+
+def makeMaps(fileName):
+    """Write small scale factor maps: in (pt, |eta|) for muons and (eta, pt) for electrons, with fixed-size and variable bins"""
+    tfile = ROOT.TFile.Open(fileName, "RECREATE")
+    ptBins = array('d', [ 20., 30., 50., 100. ])
+    muon = ROOT.TH2F("muon", "muon", 3, ptBins, 3, 0., 2.4)
+    electron = ROOT.TH2F("electron", "electron", 4, -2.5, 2.5, 3, ptBins)
+    for hist in muon, electron:
+        for i in xrange(1, hist.GetNbinsX()+1):
+            for j in xrange(1, hist.GetNbinsY()+1):
+                hist.SetBinContent(i, j, 0.9 + 0.01*i + 0.001*j)
+                hist.SetBinError(i, j, 0.01*i + 0.002*j)
+        # the under/overflow bins must not be used
+        hist.SetBinContent(0, 0, 5.)
+        hist.SetBinContent(hist.GetNbinsX()+1, hist.GetNbinsY()+1, 5.)
+        hist.Write()
+    tfile.Close()
+
+class TestLeptonSFMaps(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.fileName = os.path.join(cls.directory, "maps.root")
+        makeMaps(cls.fileName)
+        if "/LeptonEfficiencyCorrector_cc.so" not in ROOT.gSystem.GetLibraries():
+            ROOT.gSystem.SetBuildDir(cls.directory, True)
+            ROOT.gROOT.ProcessLine(".L %s+" % os.path.join(_helpers, "LeptonEfficiencyCorrector.cc"))
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def compare(self, hname, pdgId, pts, etas):
+        files, histos = [ self.fileName ]*2, [ hname ]*2 # the same map twice, to test the combination of the uncertainties
+        maps = LeptonSFMaps(files, histos)
+        vfiles, vhistos = ROOT.std.vector(str)(), ROOT.std.vector(str)()
+        for f, h in zip(files, histos): vfiles.push_back(f); vhistos.push_back(h)
+        corrector = ROOT.LeptonEfficiencyCorrector(vfiles, vhistos)
+        pts, etas = [ pt for pt in pts for eta in etas ], [ eta for pt in pts for eta in etas ]
+        sf, sfErr = maps.getSF(np.full(len(pts), pdgId), pts, etas)
+        for i, (pt, eta) in enumerate(zip(pts, etas)):
+            self.assertAlmostEqual(sf[i], corrector.getSF(pdgId, pt, eta), places=6, msg="SF for pt %s, eta %s" % (pt, eta))
+            self.assertAlmostEqual(sfErr[i], corrector.getSFErr(pdgId, pt, eta), places=6, msg="SF uncertainty for pt %s, eta %s" % (pt, eta))
+
+    def testMuon(self):
+        # bin edges, under- and overflows, negative eta (the maps are in |eta|)
+        self.compare("muon", 13, [ 5., 20., 25., 30., 49.9, 50., 100., 500. ], [ -3., -2.4, -0.8, 0., 0.5, 0.8, 1.6, 2.4, 3. ])
+    def testElectron(self):
+        self.compare("electron", -11, [ 5., 20., 25., 30., 50., 100., 500. ], [ -3., -2.5, -1.25, -0.1, 0., 1.25, 2.4999, 2.5, 3. ])
+
+if __name__ == "__main__":
+    unittest.main()
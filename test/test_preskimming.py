@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+import os
+import json
+import tempfile
+import unittest
+import treeFactory
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.framework.preskimming import JSONFilter
+
+# unsorted, overlapping and adjacent ranges, single lumis, a run without lumis
+_json1 = { "1": [ [ 5, 10 ], [ 1, 2 ], [ 3, 3 ], [ 8, 12 ], [ 20, 20 ] ], "3": [ [ 100, 200 ] ], "4": [] }
+_json2 = { "2": [ [ 1, 1 ], [ 7, 9 ] ], "3": [ [ 150, 250 ] ] }
+_runs = [ 0, 1, 2, 3, 4, 5 ]
+_lumis = range(0, 25) + [ 99, 100, 101, 149, 150, 199, 200, 201, 250, 251 ]
+
+def baselinePass(runsAndLumis, run, lumi):
+    """The original JSON filter: a linear search in the ranges of the run, as given in the JSON"""
+    for (l1, l2) in runsAndLumis.get(str(run), []):
+        if l1 <= lumi and lumi <= l2: return True
+    return False
+
+def makeTree():
+    """In-memory Events tree with an entry for each (run, lumi) to test"""
+    return treeFactory.makeTree([ ("run", "i"), ("luminosityBlock", "i") ], [ { "run": r, "luminosityBlock": l } for r in _runs for l in _lumis ])
+
+def selected(tree, cut):
+    """Indices of the entries of the tree passing the cut, with TTree::Draw"""
+    tree.Draw(">>selectedList", cut, "entrylist")
+    elist = ROOT.gDirectory.Get("selectedList")
+    return set(elist.GetEntry(i) for i in xrange(elist.GetN()))
+
+class TestJSONFilter(unittest.TestCase):
+    def testFilterRunLumi(self):
+        for runsAndLumis in _json1, _json2:
+            jsonFilter = JSONFilter(runsAndLumis=runsAndLumis)
+            for run in _runs:
+                self.assertEqual(jsonFilter.filterRunOnly(run), bool(runsAndLumis.get(str(run))), "run %d" % run)
+                for lumi in _lumis:
+                    self.assertEqual(jsonFilter.filterRunLumi(run, lumi), baselinePass(runsAndLumis, run, lumi), "run %d, lumi %d" % (run, lumi))
+
+    def testLumiCut(self):
+        tree = makeTree()
+        expected = [ (r, l) for r in _runs for l in _lumis ]
+        # several JSON files in the same process, with different or identical content
+        filters = []
+        for runsAndLumis in [ _json1, _json2, dict(_json1) ]:
+            (fd, fname) = tempfile.mkstemp(suffix=".json")
+            with os.fdopen(fd, "w") as jsonFile: json.dump(runsAndLumis, jsonFile)
+            filters.append((runsAndLumis, JSONFilter(fname)))
+            os.remove(fname)
+        self.assertEqual(filters[0][1]._compiledMask(), filters[2][1]._compiledMask())
+        self.assertNotEqual(filters[0][1]._compiledMask(), filters[1][1]._compiledMask())
+        for runsAndLumis, jsonFilter in filters:
+            self.assertEqual(selected(tree, jsonFilter.lumiCut()),
+                             set(i for i, (r, l) in enumerate(expected) if baselinePass(runsAndLumis, r, l)))
+            self.assertEqual(selected(tree, jsonFilter.runOnlyCut()),
+                             set(i for i, (r, l) in enumerate(expected) if runsAndLumis.get(str(r))))
+
+    def testAlternatingMasks(self):
+        # the compiled mask caches the last matching range: alternate between the masks at each call
+        filters = [ (runsAndLumis, JSONFilter(runsAndLumis=runsAndLumis)) for runsAndLumis in [ _json1, _json2 ] ]
+        for run in _runs:
+            for lumi in _lumis:
+                for runsAndLumis, jsonFilter in filters:
+                    self.assertEqual(bool(ROOT.nanoaodLumiMaskPass(jsonFilter._compiledMask(), run, lumi)), baselinePass(runsAndLumis, run, lumi),
+                                     "run %d, lumi %d" % (run, lumi))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import numpy as np
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+_rootType2NumpyType = { 'F':np.float32, 'D':np.float64, 'I':np.int32, 'i':np.uint32, 'L':np.int64, 'l':np.uint64, 'O':np.bool_, 'b':np.uint8, 'B':np.int8 }
+
+def makeTree(branches, entries, name="Events"):
+    """In-memory tree for the tests.
+
+       branches is a list of (name, ROOT type code) for single values and (name, ROOT type code, counter branch)
+       for variable-length arrays, entries a list with a dictionary of branch name -> value (a list for arrays)
+       for each entry. Counters that are not given are set to the length of their arrays, other missing values to 0
+       (no values for arrays)."""
+    counters = {} # counter branch -> its arrays
+    for branch in branches:
+        if len(branch) > 2: counters.setdefault(branch[2], []).append(branch[0])
+    arrays = set(a for l in counters.itervalues() for a in l)
+    def count(entry, counter):
+        return entry[counter] if counter in entry else max(len(entry.get(a, [])) for a in counters[counter])
+    ROOT.gROOT.cd()
+    tree = ROOT.TTree(name, name)
+    buffers = {}
+    for branch in branches:
+        (bname, typ), lenVar = branch[:2], (branch[2] if len(branch) > 2 else None)
+        size = max([ count(e, lenVar) for e in entries ] + [ 1 ]) if lenVar else 1
+        buffers[bname] = np.zeros(size, dtype=_rootType2NumpyType[typ])
+        tree.Branch(bname, buffers[bname], ("%s[%s]/%s" % (bname, lenVar, typ)) if lenVar else ("%s/%s" % (bname, typ)))
+    for entry in entries:
+        for bname, buff in buffers.iteritems():
+            if bname in counters:
+                buff[0] = count(entry, bname)
+            elif bname in arrays:
+                val = entry.get(bname, [])
+                buff[:] = 0
+                buff[:len(val)] = val
+            else:
+                buff[0] = entry.get(bname, 0)
+        tree.Fill()
+    tree.ResetBranchAddresses()
+    return tree